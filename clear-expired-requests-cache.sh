@@ -7,6 +7,11 @@ source venv/bin/activate
 output_path=$(echo 'from article_metrics import handler
 print(handler.clear_expired())' | ./src/manage.py shell)
 
+# the 'filesystem' backend has no db to shrink
+if [ ! -f "$output_path" ]; then
+    exit 0
+fi
+
 # call VACUUM on the sqlite db to shrink it
 printf "before: "
 du -sh "$output_path"
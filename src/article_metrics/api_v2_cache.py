@@ -0,0 +1,76 @@
+"""a cache of API responses shared between processes, built on Django's cache framework (`settings.CACHES['api']`).
+
+cached responses belong to a namespace and are invalidated by changing the namespace's version.
+imports change the version once their results have been committed."""
+
+from functools import wraps
+import json
+import uuid
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework.response import Response
+import logging
+
+LOG = logging.getLogger(__name__)
+
+ARTICLE_METRICS, NON_ARTICLE_METRICS = 'article-metrics', 'non-article-metrics'
+
+def api_cache():
+    return caches['api']
+
+def version_key(namespace):
+    return 'version:%s' % namespace
+
+def version(namespace):
+    "returns the current version of the given `namespace`, creating a new version if one doesn't exist."
+    cache = api_cache()
+    val = cache.get(version_key(namespace))
+    if val is None:
+        # another process may get there first. `add` won't replace it's version.
+        cache.add(version_key(namespace), uuid.uuid4().hex, timeout=None)
+        val = cache.get(version_key(namespace))
+    return val
+
+def invalidate(namespace):
+    "invalidates every cached response in the given `namespace`."
+    api_cache().set(version_key(namespace), uuid.uuid4().hex, timeout=None)
+    LOG.info("invalidated cached %s responses" % namespace)
+
+def invalidate_on_commit(namespace):
+    """invalidates every cached response in the given `namespace` once the current transaction is committed.
+    invalidates immediately when not inside a transaction."""
+    transaction.on_commit(lambda: invalidate(namespace))
+
+def get_or_set(namespace, key, fn):
+    "returns the value of `key` in the given `namespace`, calling `fn` and caching the result if it's not present."
+    return api_cache().get_or_set(key, fn, version=version(namespace))
+
+def cache_key(fn, request_args, kwargs):
+    # `separators` removes whitespace, see `django.core.cache.backends.base.memcache_key_warnings`
+    return '%s:%s' % (fn.__name__, json.dumps([kwargs, request_args], sort_keys=True, separators=(',', ':')))
+
+def cached(namespace, request_args_fn):
+    """view decorator that caches successful responses in the given `namespace`.
+    cache keys are built from the URL kwargs and the request arguments parsed by `request_args_fn`.
+    requests with bad arguments are passed through to the view to handle."""
+    def wrap(fn):
+        @wraps(fn)
+        def wrapper(request, **kwargs):
+            try:
+                key = cache_key(fn, request_args_fn(request), kwargs)
+            except AssertionError:
+                return fn(request, **kwargs)
+
+            cache = api_cache()
+            ver = version(namespace)
+            hit = cache.get(key, version=ver)
+            if hit is not None:
+                data, content_type = hit
+                return Response(data, content_type=content_type)
+
+            response = fn(request, **kwargs)
+            if response.status_code == 200:
+                cache.set(key, (response.data, response.content_type), version=ver)
+            return response
+        return wrapper
+    return wrap
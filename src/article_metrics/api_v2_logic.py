@@ -1,31 +1,44 @@
 import cachetools
-import os
 from collections import OrderedDict
+import hashlib
 
 import requests
 from . import models
-from . import utils
+from . import utils, api_v2_cache
 from .utils import ensure, rest, lmap
 from kids.cache import cache
-from django.db.models import Sum, F, Max
+from django.db.models import Sum, F, Max, Count, Subquery
 import logging
 import metrics.models
 import article_metrics.crossref.citations as crossref
-from django.db import connection
 from django.conf import settings
-from psycopg2.extensions import AsIs
 
 LOG = logging.getLogger(__name__)
 
-def chop(q, page, per_page, order):
-    """orders and chops a query into pages, returning the total of the original query and a query object"""
-    total = q.count()
+NON_ARTICLE_MODELS = [metrics.models.PageCount, metrics.models.PageCountMonth]
+
+def count(q):
+    "returns the number of results in query `q`, caching the result until the next import."
+    namespace = api_v2_cache.NON_ARTICLE_METRICS if q.model in NON_ARTICLE_MODELS else api_v2_cache.ARTICLE_METRICS
+    key = 'count:%s' % hashlib.md5(str(q.query).encode('utf-8')).hexdigest()
+    return api_v2_cache.get_or_set(namespace, key, q.count)
+
+# models that can be paged through using a cursor.
+# their ordering fields are unique within a query.
+KEYSET_MODELS = [models.Metric, metrics.models.PageCount, metrics.models.PageCountMonth]
+
+def chop(q, page, per_page, order, cursor=None):
+    """orders and chops a query into pages, returning the total of the original query and a query object.
+    if a `cursor` is given, the page of results *after* the cursor is returned rather than page number `page`.
+    a cursor is the 'period' of the last result of the previous page. an empty cursor is the first page."""
+    total = count(q)
 
     order_by_idx = {
         models.Article: 'doi',
         models.Metric: 'date',
         models.Citation: 'num',
         metrics.models.PageCount: 'date_field',
+        metrics.models.PageCountMonth: 'date_field',
     }
     order_by = order_by_idx[q.model]
 
@@ -41,6 +54,9 @@ def chop(q, page, per_page, order):
 
     q = q.order_by(*order_by)
 
+    if cursor is not None:
+        return total, _keyset(q, per_page, order, cursor)
+
     # a per-page = 0 means 'all results'
     if per_page > 0:
         start = (page - 1) * per_page
@@ -49,6 +65,24 @@ def chop(q, page, per_page, order):
 
     return total, q
 
+def _keyset(q, per_page, order, cursor):
+    "returns the page of results from ordered query `q` after the `cursor`, without an OFFSET scan."
+    ensure(q.model in KEYSET_MODELS, "cursors are not supported here")
+    if cursor:
+        field = 'date'
+        if q.model in NON_ARTICLE_MODELS:
+            field = 'date_field'
+            # monthly periods are truncated to the first day of the month
+            cursor = cursor if len(cursor) == len('YYYY-MM-DD') else cursor + '-01'
+        op = 'lt' if order == 'DESC' else 'gt'
+        q = q.filter(**{'%s__%s' % (field, op): cursor})
+    return q[:per_page] if per_page > 0 else q
+
+def next_cursor(serialized_periods, per_page):
+    "returns the cursor for the page of results after the given page of `serialized_periods` or `None` if there are no more results."
+    if serialized_periods and len(serialized_periods) == per_page:
+        return serialized_periods[-1]['period']
+
 def pad_citations(serialized_citation_response):
     cr = serialized_citation_response
     missing_sources = set(models.SOURCE_LABELS) - set([cite['service'] for cite in cr])
@@ -107,6 +141,21 @@ def article_views(msid, period):
 #
 #
 
+def article_metrics_last_modified(msid, metric):
+    """returns a pair of `(datetime, count)` for the rows backing the given article `metric`,
+    where `datetime` is the most recent time any of them were modified or `None` if there are no rows."""
+    model = models.Citation if metric == 'citations' else models.Metric
+    # a single query. the article is looked up by it's exact doi so the doi index is used.
+    article_id = models.Article.objects.filter(doi=utils.msid2doi(msid)).values('id')
+    sums = model.objects \
+        .filter(article_id=Subquery(article_id)) \
+        .aggregate(Max('datetime_record_updated'), Count('id'))
+    return sums['datetime_record_updated__max'], sums['id__count']
+
+#
+#
+#
+
 def summary_by_msid(msid):
     views, downloads, _ = article_stats(msid, models.DAY)
     row = OrderedDict([
@@ -133,14 +182,6 @@ def summary_by_obj(artobj):
 #
 
 
-def dictfetchall(cursor):
-    "Return all rows from a cursor as a dict"
-    columns = [col[0] for col in cursor.description]
-    return [
-        dict(zip(columns, row))
-        for row in cursor.fetchall()
-    ]
-
 def coerce_summary_row(row):
     "post-processing of rows from `summary`, because we can't do everything in SQL"
     try:
@@ -149,32 +190,32 @@ def coerce_summary_row(row):
     except Exception:
         LOG.warning("bad data, skipping article: %s", row)
 
-SUMMARY_SQL_ALL = open(os.path.join(settings.SQL_PATH, 'metrics-summary.sql'), 'r').read()
-TWO_MIN_CACHE = cachetools.TTLCache(maxsize=1, ttl=120 if not settings.TESTING else 0)
+# excludes articles whose DOI can't be converted to a msid by `coerce_summary_row` so they aren't counted.
+# for example: '10.7554/eLife.00000' and '10.7554/eLife.e30552'
+VALID_DOI_REGEX = r'^10\.7554/elife\.0*[1-9][0-9]*(\.|$)'
 
-@cache(use=TWO_MIN_CACHE)
-def _summary(order):
-    """an optimised query for returning article metric summaries.
-    execution time is the same for all results or just one, so pagination is skipped."""
-    with connection.cursor() as cursor:
-        cursor.execute(SUMMARY_SQL_ALL, [AsIs(order)])
-        rows = dictfetchall(cursor)
-    return list(filter(None, map(coerce_summary_row, rows)))
+TWO_MIN_CACHE = cachetools.TTLCache(maxsize=1, ttl=120 if not settings.TESTING else 0)
 
 def summary(page, per_page, order):
-    """an optimised query for returning article metric summaries.
-    execution time is the same for all results or just one, so pagination uses list slices."""
-    rows = _summary(order) # pylint: disable=E1111
+    """returns a page of article metric summaries and the total number of summaries.
+    summaries are maintained during import, see `logic.refresh_article_summaries`."""
+    qobj = models.ArticleSummary.objects \
+        .filter(article__doi__iregex=VALID_DOI_REGEX) \
+        .order_by('-article_id' if order == 'DESC' else 'article_id')
+    total = qobj.count()
     # ?per-page=100&page=1 = 0:100
     # ?per-page=100&page=2 = 100:200
     start_pos = per_page * (page - 1) # slices are 0-based
     offset = start_pos + per_page
-    return len(rows), rows[start_pos:offset]
+    fields = ['article__doi', 'views', 'downloads', models.SCOPUS, models.PUBMED, models.CROSSREF]
+    rows = [OrderedDict(zip(['id'] + fields[1:], row)) for row in qobj.values_list(*fields)[start_pos:offset]]
+    return total, list(filter(None, map(coerce_summary_row, rows)))
 
 
 @cache(use=TWO_MIN_CACHE)
 def citations_by_version(msid, version):
     doi = f"{utils.msid2doi(msid)}.{version}"
+    # a plain session, the citations are pulled dynamically and must not come from the requests cache.
     with requests.Session() as requests_session:
         crossref_citations = crossref.parse(crossref.fetch(doi, requests_session=requests_session), doi)
 
@@ -1,8 +1,11 @@
 import cProfile, pstats
+import hashlib
+import re
 from article_metrics import models
 from django.shortcuts import get_object_or_404
 from django.http import Http404
 from django.conf import settings
+from django.views.decorators.http import condition
 from django.db import connection
 from rest_framework.decorators import api_view, renderer_classes
 from rest_framework.renderers import StaticHTMLRenderer
@@ -10,7 +13,7 @@ from et3.render import render_item
 from et3.extract import path as p
 from et3.utils import uppercase, lowercase
 from .utils import isint, ensure, exsubdict, lmap, lfilter, msid2doi
-from . import api_v2_logic as logic
+from . import api_v2_logic as logic, api_v2_cache
 from rest_framework.response import Response
 from rest_framework.exceptions import ValidationError
 
@@ -68,7 +71,9 @@ def transactions(fn):
 
     return wrapper
 
-def request_args(request, **overrides):
+def request_args(request, with_cursor=False, **overrides):
+    """parses and validates the arguments common to all views.
+    the `cursor` argument is only parsed `with_cursor`, for views that can be paged through with a cursor."""
     opts = {}
     opts.update(settings.API_OPTS)
     opts.update(overrides)
@@ -89,6 +94,12 @@ def request_args(request, **overrides):
             return val
         return fn
 
+    def iscursor(v):
+        # a cursor is optional and may be empty
+        if v:
+            ensure(re.match(r'^\d{4}-\d{2}(-\d{2})?$', v), "expecting a 'YYYY-MM-DD' or 'YYYY-MM' cursor, got: %s" % v)
+        return v
+
     desc = {
         'page': [p('page', opts['page_num']), ispositiveint],
         'per_page': [p('per-page', opts['per_page']), ispositiveint, inrange(opts['min_per_page'], opts['max_per_page'])],
@@ -96,8 +107,14 @@ def request_args(request, **overrides):
 
         'period': [p('by', 'day'), lowercase, isin(['day', 'month'])],
     }
+    if with_cursor:
+        desc['cursor'] = [p('cursor', None), iscursor]
     return render_item(desc, request.GET)
 
+def cursor_request_args(request, **overrides):
+    "like `request_args` but also parses the `cursor`, see `logic.chop`."
+    return request_args(request, with_cursor=True, **overrides)
+
 #
 #
 #
@@ -130,15 +147,32 @@ def serialize(total_results, sum_value, obj_list, metric):
         return serialize_citations(obj_list)
     return serialize_views_downloads(metric, total_results, sum_value, obj_list)
 
+def article_metrics_etag(request, msid, metric):
+    """returns a strong ETag for an article metrics response that changes whenever the article's metrics change.
+    the request path, arguments and requested content type are part of the tag.
+    returns `None` (no ETag) if the article has no metrics or the request is bad."""
+    try:
+        cursor_request_args(request)
+    except AssertionError:
+        return None # let the view respond
+    latest, count = logic.article_metrics_last_modified(msid, metric)
+    if not latest:
+        return None
+    bits = [latest.isoformat(), str(count), request.get_full_path(), request.META.get('HTTP_ACCEPT', '')]
+    return hashlib.md5('|'.join(bits).encode('utf-8')).hexdigest()
+
 #
 #
 #
 
+# `condition` responds with a '304 Not Modified' when the ETag in the request's `If-None-Match` header matches.
+@condition(etag_func=article_metrics_etag)
 @api_view(['GET'])
+@api_v2_cache.cached(api_v2_cache.ARTICLE_METRICS, cursor_request_args)
 def article_metrics(request, msid, metric):
     try:
         # /metrics/article/12345/downloads?by=month
-        kwargs = request_args(request) # parse args first ...
+        kwargs = cursor_request_args(request) # parse args first ...
         get_object_or_404(models.Article, doi=msid2doi(msid)) # ... then a db lookup
         idx = {
             'citations': logic.article_citations,
@@ -155,6 +189,9 @@ def article_metrics(request, msid, metric):
         # citations have to return zeroes for any missing sources
         payload = logic.pad_citations(payload) if metric == 'citations' else payload
 
+        if kwargs['cursor'] is not None:
+            payload['nextCursor'] = logic.next_cursor(payload['periods'], kwargs['per_page'])
+
         # respond
         return Response(payload, content_type=CTYPE_IDX[metric])
 
@@ -183,6 +220,7 @@ def ping(request):
 #
 
 @api_view(['GET'])
+@api_v2_cache.cached(api_v2_cache.ARTICLE_METRICS, request_args)
 def summary(request, msid=None):
     "returns the final totals for all articles with no finer grained information"
     try:
@@ -220,6 +258,7 @@ def summary(request, msid=None):
 
 
 @api_view(['GET'])
+@api_v2_cache.cached(api_v2_cache.ARTICLE_METRICS, request_args)
 def summary2(request):
     "returns the final totals for all articles with no finer grained information"
     try:
@@ -1,10 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import requests
 from dateutil.relativedelta import relativedelta
 from article_metrics import models, utils, handler
 from django.conf import settings
 import logging
 
-from xml.dom.minidom import parseString
+import io
+from xml.etree import ElementTree
 from typing import Optional
 
 LOG = logging.getLogger(__name__)
@@ -39,29 +41,46 @@ def fetch(doi, requests_session: Optional[requests.Session] = None):
     except requests.exceptions.RequestException:
         raise FetchCrossrefCitationsError(f'failled to fetch crossref citation for {doi}')
 
+def count_forward_links(xmlbytes):
+    """returns the number of `forward_link` elements within the `body` of a 'getForwardLinks' response.
+    elements are counted as they are parsed and then discarded, so memory use doesn't grow with the number of citations."""
+    if isinstance(xmlbytes, str):
+        xmlbytes = xmlbytes.encode('utf-8')
+    body = None
+    num = 0
+    for event, elem in ElementTree.iterparse(io.BytesIO(xmlbytes), events=('start', 'end')):
+        tag = elem.tag.rsplit('}', 1)[-1] # '{http://www.crossref.org/qrschema/2.0}body' => 'body'
+        if event == 'start':
+            if tag == 'body' and body is None:
+                body = elem
+        elif elem is body:
+            return num
+        elif body is not None and tag == 'forward_link':
+            num += 1
+            # the parser holds references to any elements still being parsed
+            body.clear()
+    raise utils.ParseError("no 'body' element found")
+
 @handler.capture_parse_error
 def parse(xmlbytes, doi):
     if not xmlbytes:
         # nothing to parse, carry on
         return None
-    dom = parseString(xmlbytes)
-    body = dom.getElementsByTagName('body')[0]
-    citations = body.getElementsByTagName('forward_link')
     return {
         'doi': doi,
-        'num': len(citations),
+        'num': count_forward_links(xmlbytes),
         'source': models.CROSSREF,
         'source_id': 'https://doi.org/' + doi
     }
 
-def count_for_doi(doi, include_all_versions=False):
+def count_for_doi(doi, include_all_versions=False, requests_session: Optional[requests.Session] = None):
     try:
-        results = parse(fetch(doi), doi)
+        results = parse(fetch(doi, requests_session), doi)
         if results and include_all_versions:
             count_for_versions = 0
-            for version in utils.get_article_versions(utils.doi2msid(doi)):
+            for version in utils.get_article_versions(utils.doi2msid(doi), requests_session=requests_session):
                 v_doi = f"{doi}.{version}"
-                v_results = parse(fetch(v_doi), v_doi)
+                v_results = parse(fetch(v_doi, requests_session), v_doi)
 
                 if v_results:
                     count_for_versions += v_results['num']
@@ -77,15 +96,34 @@ def count_for_doi(doi, include_all_versions=False):
 def count_for_msid(msid):
     return count_for_doi(utils.msid2doi(msid))
 
-def count_for_qs(qs):
-    for art in qs:
-        yield count_for_doi(art.doi, include_all_versions=True)
+def count_for_qs(qs, num_workers=1):
+    """yields the citation count for each article in `qs`.
+    articles are fetched `num_workers` at a time using the shared session for each host, see `handler.host_session`.
+    when fetched concurrently, results are yielded in the order they complete.
+    no more than two articles per-worker are fetched or waiting to be yielded at once."""
+    doi_list = [art.doi for art in qs]
+    if num_workers <= 1:
+        for doi in doi_list:
+            yield count_for_doi(doi, include_all_versions=True)
+        return
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        # futures, and their results, are dropped once yielded.
+        pending = set()
+        for doi in doi_list:
+            pending.add(executor.submit(count_for_doi, doi, True))
+            if len(pending) >= num_workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in as_completed(pending):
+            yield future.result()
 
 #
 #
 #
 
-def citations_for_articles(msid: Optional[str] = None):
+def citations_for_articles(msid: Optional[str] = None, num_workers=1):
     if msid:
-        return count_for_qs(models.Article.objects.filter(doi=utils.msid2doi(msid)))
-    return count_for_qs(models.Article.objects.all())
+        return count_for_qs(models.Article.objects.filter(doi=utils.msid2doi(msid)), num_workers)
+    return count_for_qs(models.Article.objects.all(), num_workers)
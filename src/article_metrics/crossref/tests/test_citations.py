@@ -29,7 +29,7 @@ class TestCitationsForAllArticles:
     ):
         citations_for_articles()
         count_for_qs_mock.assert_called_with(
-            models_mock.Article.objects.all.return_value
+            models_mock.Article.objects.all.return_value, 1
         )
 
     def test_should_pass_a_requested_article_to_count_for_qs(
@@ -39,5 +39,18 @@ class TestCitationsForAllArticles:
     ):
         citations_for_articles('12345')
         count_for_qs_mock.assert_called_with(
-            models_mock.Article.objects.filter(doi=utils.msid2doi('12345'))
+            models_mock.Article.objects.filter(doi=utils.msid2doi('12345')), 1
         )
+
+
+class TestCountForQs:
+    def test_should_fetch_articles_concurrently(self):
+        article_list = [MagicMock(doi=utils.msid2doi(msid)) for msid in range(1, 11)]
+
+        def count_for_doi(doi, include_all_versions, requests_session=None):
+            return {'doi': doi, 'num': 1}
+
+        with patch.object(citations, 'count_for_doi', side_effect=count_for_doi):
+            results = list(citations.count_for_qs(article_list, num_workers=4))
+
+        assert sorted(result['doi'] for result in results) == sorted(art.doi for art in article_list)
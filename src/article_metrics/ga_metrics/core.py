@@ -5,7 +5,9 @@
 # https://developers.google.com/analytics/devguides/reporting/core/v3/reference
 
 from os.path import join
-import os, json, time, random
+import os, time, random, threading, math
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from datetime import datetime, timedelta
 from googleapiclient import errors
 from googleapiclient.discovery import build
@@ -13,11 +15,10 @@ from oauth2client.client import AccessTokenRefreshError
 from oauth2client.service_account import ServiceAccountCredentials
 from httplib2 import Http
 from .utils import ymd, month_min_max, ensure
-from kids.cache import cache
 import logging
 from django.conf import settings
 from . import elife_v1, elife_v2, elife_v3, elife_v4, elife_v5, elife_v6, elife_vX, elife_v7, elife_v8
-from . import utils, ga4
+from . import utils, ga4, store
 from article_metrics.utils import todt_notz, datetime_now
 
 LOG = logging.getLogger(__name__)
@@ -154,8 +155,16 @@ def sanitize_ga_response(ga_response):
         del ga_response['query']['ids']
     return ga_response
 
-@cache
+# `httplib2.Http` is not thread-safe, each thread gets it's own service object.
+# thread-local, so a thread's service object is discarded with the thread.
+_local = threading.local()
+
 def ga_service():
+    if not hasattr(_local, 'service'):
+        _local.service = _ga_service()
+    return _local.service
+
+def _ga_service():
     service_name = 'analytics'
     settings_file = settings.GA_SECRETS_LOCATION
     scope = 'https://www.googleapis.com/auth/analytics.readonly'
@@ -204,7 +213,9 @@ def _query_ga(query_map, num_attempts=5):
                 LOG.info("query attempt %r" % (n + 1))
             else:
                 LOG.info("querying ...")
-            return query.execute()
+            ga4.rate_limit()
+            with ga4.concurrency_limit:
+                return query.execute()
 
         except TypeError as error:
             # Handle errors in constructing a query.
@@ -241,27 +252,31 @@ def _query_ga(query_map, num_attempts=5):
     raise AssertionError("Failed to execute query after %s attempts" % num_attempts)
 
 # copied from non-article metrics logic.py
-def query_ga(query, num_attempts=5):
-    """performs given query and fetches any further pages.
+def query_ga(query, num_attempts=5, num_workers=ga4.MAX_PAGE_WORKERS):
+    """performs given query and fetches any further pages, up to `num_workers` pages at a time.
     concatenated results are returned in the response dict as `rows`."""
 
     results_pp = query.get('max_results', MAX_GA_RESULTS)
     query['max_results'] = results_pp
     query['start_index'] = 1
 
-    page, results = 1, []
-    while True:
-        LOG.info("requesting page %s for query %s" % (page, query['filters']))
-        response = _query_ga(query, num_attempts)
-        results.extend(response.get('rows') or [])
-        if (results_pp * page) >= response['totalResults']:
-            break # no more pages to fetch
-        query['start_index'] += results_pp # 1, 2001, 4001, etc
-        page += 1
+    LOG.info("requesting page 1 for query %s" % (query['filters'],))
+    response = _query_ga(query, num_attempts)
+    results = list(response.get('rows') or [])
+
+    # the first response tells us how many results there are in total, fetch the remaining pages concurrently.
+    num_pages = max(1, math.ceil(response['totalResults'] / results_pp))
+    query_list = [dict(query, start_index=1 + results_pp * n) for n in range(1, num_pages)] # 2001, 4001, etc
+    if query_list:
+        LOG.info("requesting pages 2 to %s for query %s" % (num_pages, query['filters']))
+    response_list = ga4.fetch_pages(lambda q: _query_ga(q, num_attempts), query_list, num_workers)
+    for response_n in response_list:
+        results.extend(response_n.get('rows') or [])
 
     # use the last response given but with all of the results
+    response = (response_list or [response])[-1]
     response['rows'] = results
-    response['totalPages'] = page
+    response['totalPages'] = num_pages
 
     return response
 
@@ -308,8 +323,7 @@ def write_results(results, path):
     if not os.path.exists(dirname):
         assert os.system("mkdir -p %s" % dirname) == 0, "failed to make output dir %r" % dirname
     LOG.info("writing %r", path)
-    with open(path, 'w') as fh:
-        json.dump(sanitize_ga_response(results), fh, indent=4, sort_keys=True)
+    store.write(path, sanitize_ga_response(results))
 
 def query_ga_write_results(query, num_attempts=5):
     "convenience. queries GA then writes the results, returning both the original response and the path to results"
@@ -366,21 +380,17 @@ def load_cache(results_type, from_date, to_date, cached, only_cached):
     returns `None` when given date range is not cachable."""
     if cached and cacheable(to_date):
         path = output_path_v2(results_type, from_date, to_date)
-        has_cache = path and os.path.exists(path)
-        if has_cache:
-            with open(path, 'r') as fh:
-                return json.load(fh)
-        elif only_cached:
+        results = store.read(path) if path else None
+        if results is not None:
+            return results
+        if only_cached:
             # no cache exists and we've been told to only use cache.
             return {}
 
 def write_results_v2(results, path):
-    """writes `results` as json to the given `path`.
+    """stores `results` for the given cache file `path`, see `store.py`.
     like v1, but expects output directory to exist and will not create it if it doesn't."""
-    dirname = os.path.dirname(path)
-    ensure(os.path.exists(dirname), "output directory does not exist: %s" % path)
-    LOG.debug("writing %r", path)
-    json.dump(results, open(path, 'w'), indent=4, sort_keys=True)
+    store.write(path, results)
 
 def query_ga_write_results_v2(query_map, from_date_dt, to_date_dt, results_type, **kwargs):
     if guess_era_from_query(query_map) == GA3:
@@ -398,15 +408,17 @@ def query_ga_write_results_v2(query_map, from_date_dt, to_date_dt, results_type,
 #
 #
 
-def article_views(table_id, from_date, to_date, cached=False, only_cached=False):
-    "returns article view data either from the cache or from talking to google"
+def article_views(table_id, from_date, to_date, cached=False, only_cached=False, raw_data=None):
+    """returns article view data either from the cache or from talking to google.
+    `raw_data` is an optional response already fetched from google, see `batch_query_ga`."""
     if not valid_view_dt_pair((from_date, to_date)):
         LOG.warning("given date range %r for views is older than known inception %r, skipping", (ymd(from_date), ymd(to_date)), VIEWS_INCEPTION)
         return {}
 
     elife_module = module_picker(from_date, to_date)
 
-    raw_data = load_cache('views', from_date, to_date, cached, only_cached)
+    if raw_data is None:
+        raw_data = load_cache('views', from_date, to_date, cached, only_cached)
     if raw_data is None:
         # talk to google
         query_map = elife_module.path_counts_query(table_id, from_date, to_date)
@@ -414,15 +426,17 @@ def article_views(table_id, from_date, to_date, cached=False, only_cached=False)
 
     return elife_module.path_counts(raw_data.get('rows', []))
 
-def article_downloads(table_id, from_date, to_date, cached=False, only_cached=False):
-    "returns article download data either from the cache or from talking to google"
+def article_downloads(table_id, from_date, to_date, cached=False, only_cached=False, raw_data=None):
+    """returns article download data either from the cache or from talking to google.
+    `raw_data` is an optional response already fetched from google, see `batch_query_ga`."""
     if not valid_downloads_dt_pair((from_date, to_date)):
         LOG.warning("given date range %r for downloads is older than known inception %r, skipping", (ymd(from_date), ymd(to_date)), DOWNLOADS_INCEPTION)
         return {}
 
     elife_module = module_picker(from_date, to_date)
 
-    raw_data = load_cache('downloads', from_date, to_date, cached, only_cached)
+    if raw_data is None:
+        raw_data = load_cache('downloads', from_date, to_date, cached, only_cached)
     if raw_data is None:
         # talk to google
         query_map = elife_module.event_counts_query(table_id, from_date, to_date)
@@ -430,27 +444,156 @@ def article_downloads(table_id, from_date, to_date, cached=False, only_cached=Fa
 
     return elife_module.event_counts(raw_data.get('rows', []))
 
-def article_metrics(table_id, from_date, to_date, cached=False, only_cached=False):
-    "returns a dictionary of article metrics, combining both article views and pdf downloads"
+def query_ga_views_downloads(table_id, from_date, to_date, cached=False, only_cached=False, raw_data=None):
+    """returns a map of `{'views': raw-data, 'downloads': raw-data}` for the given date range.
+    results missing from `raw_data` are read from the cache and any that aren't cached are queried for together,
+    GA4 queries with a single `batchRunReports` request and GA3 queries concurrently."""
+    raw_data = dict(raw_data or {})
+    elife_module = module_picker(from_date, to_date)
+    query_fns = [
+        ('views', valid_view_dt_pair, elife_module.path_counts_query),
+        ('downloads', valid_downloads_dt_pair, elife_module.event_counts_query),
+    ]
+    pending = {}
+    for results_type, valid, query_fn in query_fns:
+        if raw_data.get(results_type) is not None or not valid((from_date, to_date)):
+            continue
+        results = load_cache(results_type, from_date, to_date, cached, only_cached)
+        if results is not None:
+            raw_data[results_type] = results
+        else:
+            pending[results_type] = query_fn(table_id, from_date, to_date)
+
+    if not pending:
+        return raw_data
+
+    if len(pending) == 1:
+        [(results_type, query_map)] = pending.items()
+        raw_data[results_type], _ = query_ga_write_results_v2(query_map, from_date, to_date, results_type)
+
+    elif all(guess_era_from_query(query_map) == GA4 for query_map in pending.values()):
+        response_list = ga4.query_ga_many(list(pending.values()))
+        for results_type, response in zip(pending.keys(), response_list):
+            path = output_path_v2(results_type, from_date, to_date)
+            if path:
+                write_results_v2(response, path)
+            raw_data[results_type] = response
+
+    else:
+        with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+            future_list = [(results_type, executor.submit(query_ga_write_results_v2, query_map, from_date, to_date, results_type))
+                           for results_type, query_map in pending.items()]
+            for results_type, future in future_list:
+                raw_data[results_type], _ = future.result()
+
+    return raw_data
+
+def article_metrics(table_id, from_date, to_date, cached=False, only_cached=False, raw_data=None):
+    """returns a dictionary of article metrics, combining both article views and pdf downloads.
+    `raw_data` is an optional map of responses already fetched from google, ll: `{'views': {...}, 'downloads': {...}}`"""
+    raw_data = query_ga_views_downloads(table_id, from_date, to_date, cached, only_cached, raw_data)
     return {
-        'views': article_views(table_id, from_date, to_date, cached, only_cached),
-        'downloads': article_downloads(table_id, from_date, to_date, cached, only_cached),
+        'views': article_views(table_id, from_date, to_date, cached, only_cached, raw_data.get('views')),
+        'downloads': article_downloads(table_id, from_date, to_date, cached, only_cached, raw_data.get('downloads')),
     }
 
-def metrics_for_range(table_id, dt_range_list, cached=False, only_cached=False):
+def is_cached(results_type, from_date, to_date, cached):
+    "returns `True` if `cached` is `True` and results for the given `results_type` and date range are cached."
+    if cached and cacheable(to_date):
+        path = output_path_v2(results_type, from_date, to_date)
+        return bool(path) and store.exists(path)
+    return False
+
+def batch_query_ga(table_id, dt_range_list, cached=False, only_cached=False, num_workers=1, batch_size=ga4.MAX_DATE_RANGES):
+    """queries GA4 for the views and downloads of up to `batch_size` date ranges in a single request.
+    date ranges that are cached or that precede GA4 are skipped and left to `article_metrics`.
+    the results for each date range are cached as if it had been queried on it's own.
+    returns a map of `{(from-date, to-date): {'views': raw-data, 'downloads': raw-data}}`"""
+    results = {}
+    if only_cached:
+        return results
+
+    # group the queries that differ only by their date range
+    groups = {}
+    for from_date, to_date in dt_range_list:
+        elife_module = module_picker(from_date, to_date)
+        query_fns = [
+            ('views', valid_view_dt_pair, elife_module.path_counts_query),
+            ('downloads', valid_downloads_dt_pair, elife_module.event_counts_query),
+        ]
+        for results_type, valid, query_fn in query_fns:
+            if not valid((from_date, to_date)) or is_cached(results_type, from_date, to_date, cached):
+                continue
+            query_map = query_fn(table_id, from_date, to_date)
+            if guess_era_from_query(query_map) != GA4:
+                continue
+            group_key = (results_type, elife_module.__name__)
+            groups.setdefault(group_key, []).append((from_date, to_date, query_map))
+
+    batch_list = []
+    for (results_type, _), item_list in groups.items():
+        for i in range(0, len(item_list), batch_size):
+            batch_list.append((results_type, item_list[i:i + batch_size]))
+
+    def query_batch(results_type, item_list):
+        query_map = ga4.batch_query([query_map for _, _, query_map in item_list])
+        response_list = ga4.split_response(ga4.query_ga(query_map), query_map)
+        for (from_date, to_date, _), response in zip(item_list, response_list):
+            path = output_path_v2(results_type, from_date, to_date)
+            if path:
+                write_results_v2(response, path)
+            results.setdefault((ymd(from_date), ymd(to_date)), {})[results_type] = response
+
+    if num_workers <= 1:
+        for results_type, item_list in batch_list:
+            query_batch(results_type, item_list)
+    else:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            future_list = [executor.submit(query_batch, results_type, item_list) for results_type, item_list in batch_list]
+            for future in future_list:
+                future.result()
+
+    return results
+
+def metrics_for_range(table_id, dt_range_list, cached=False, only_cached=False, num_workers=1, batch_size=1):
     """query each `(from-date, to-date)` pair in `dt_range_list`.
+    when `num_workers` is greater than 1 the pairs are queried concurrently using a pool of threads,
+    with no more than two pairs per-worker queued at once.
+    GA requests across all threads are subject to the same rate limit (`ga4.rate_limit`).
+    when `batch_size` is greater than 1, up to `batch_size` GA4 date ranges are queried per request, see `batch_query_ga`.
     returns a map of `{(from-date, to-date): {'views': {...}, 'downloads': {...}}`"""
+    raw_data = {}
+    if batch_size > 1:
+        raw_data = batch_query_ga(table_id, dt_range_list, cached, only_cached, num_workers, batch_size)
+
+    if num_workers <= 1:
+        results = {}
+        for from_date, to_date in dt_range_list:
+            key = (ymd(from_date), ymd(to_date))
+            results[key] = article_metrics(table_id, from_date, to_date, cached, only_cached, raw_data.get(key))
+        return results
+
     results = {}
-    for from_date, to_date in dt_range_list:
-        res = article_metrics(table_id, from_date, to_date, cached, only_cached)
-        results[(ymd(from_date), ymd(to_date))] = res
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        # no more than two date ranges per-worker are queued at once.
+        # results are collected in the same order they were given.
+        pending = deque()
+        for from_date, to_date in dt_range_list:
+            key = (ymd(from_date), ymd(to_date))
+            pending.append((key, executor.submit(article_metrics, table_id, from_date, to_date, cached, only_cached, raw_data.get(key))))
+            if len(pending) >= num_workers * 2:
+                key, future = pending.popleft()
+                results[key] = future.result()
+        while pending:
+            key, future = pending.popleft()
+            results[key] = future.result()
     return results
 
-def daily_metrics_between(table_id, from_date, to_date, cached=True, only_cached=False):
+def daily_metrics_between(table_id, from_date, to_date, cached=True, only_cached=False, num_workers=1, batch_size=1):
     "does a DAILY query between two dates, NOT a single query within a date range."
     date_range = utils.dt_range(from_date, to_date)
-    return metrics_for_range(table_id, date_range, cached, only_cached)
+    return metrics_for_range(table_id, date_range, cached, only_cached, num_workers, batch_size)
 
-def monthly_metrics_between(table_id, from_date, to_date, cached=True, only_cached=False):
+def monthly_metrics_between(table_id, from_date, to_date, cached=True, only_cached=False, num_workers=1, batch_size=1):
     date_range = utils.dt_month_range(from_date, to_date)
-    return metrics_for_range(table_id, date_range, cached, only_cached)
+    return metrics_for_range(table_id, date_range, cached, only_cached, num_workers, batch_size)
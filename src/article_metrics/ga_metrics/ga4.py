@@ -1,20 +1,54 @@
-from kids.cache import cache
-import time, random
+import time, random, threading
+import math
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
 import googleapiclient, oauth2client
 import googleapiclient.discovery
 import oauth2client.service_account
 import httplib2
 import logging
 from django.conf import settings
-from ..utils import ensure
+from ..utils import ensure, rate_limiter
 
 LOG = logging.getLogger(__name__)
 
 # Analytics API:
 # https://developers.google.com/analytics/devguides/reporting/data/v1/rest
 
-@cache
+# GA4 allows 10 concurrent requests per property and has hourly and daily token quotas.
+# - https://developers.google.com/analytics/devguides/reporting/data/v1/quotas
+# this limit is shared by every thread in the process querying GA.
+MAX_QUERIES_PER_SECOND = 5
+rate_limit = rate_limiter(MAX_QUERIES_PER_SECOND)
+
+# maximum number of requests to GA in-flight at once, across all threads.
+MAX_CONCURRENT_QUERIES = 10
+concurrency_limit = threading.BoundedSemaphore(MAX_CONCURRENT_QUERIES)
+
+# maximum number of `dateRanges` in a single query.
+# - https://developers.google.com/analytics/devguides/reporting/data/v1/rest/v1beta/properties/runReport
+MAX_DATE_RANGES = 4
+
+# maximum number of pages of a single report to fetch concurrently.
+# kept below GA4's limit of 10 concurrent requests per property so concurrent reports don't exceed it.
+MAX_PAGE_WORKERS = 4
+
+# maximum number of reports in a single `batchRunReports` request.
+# - https://developers.google.com/analytics/devguides/reporting/data/v1/rest/v1beta/properties/batchRunReports
+MAX_BATCH_REPORTS = 5
+
+RESULTS_PP = 10000 # 100k max
+
+# `httplib2.Http` is not thread-safe, each thread gets it's own service object.
+# thread-local, so a thread's service object is discarded with the thread.
+_local = threading.local()
+
 def ga_service():
+    if not hasattr(_local, 'service'):
+        _local.service = _ga_service()
+    return _local.service
+
+def _ga_service():
     service_name = 'analyticsdata'
     service_version = 'v1beta'
     scope = 'https://www.googleapis.com/auth/analytics.readonly'
@@ -39,15 +73,27 @@ def _query_ga(query_map, num_attempts=5):
 
     property_id = 'properties/' + settings.GA4_TABLE_ID
     query = ga_service().properties().runReport(property=property_id, body=query_map)
+    return _execute(query, num_attempts)
 
-    # execute it
+# pylint: disable=E1101
+def _batch_query_ga(query_map_list, num_attempts=5):
+    """talks to GA, executing each query in `query_map_list` as a single `batchRunReports` request.
+    returns a list of responses in the same order as the queries were given."""
+    property_id = 'properties/' + settings.GA4_TABLE_ID
+    query = ga_service().properties().batchRunReports(property=property_id, body={'requests': query_map_list})
+    return _execute(query, num_attempts)['reports']
+
+def _execute(query, num_attempts):
+    "executes the given `query`, applying exponential back-off if rate limited or when service is unavailable."
     for n in range(0, num_attempts):
         try:
             if n > 1:
                 LOG.info("query attempt %r" % (n + 1))
             else:
                 LOG.info("querying ...")
-            return query.execute()
+            rate_limit()
+            with concurrency_limit:
+                return query.execute()
 
         except TypeError as error:
             # Handle errors in constructing a query.
@@ -89,26 +135,93 @@ def _query_ga(query_map, num_attempts=5):
 
     raise AssertionError("Failed to execute query after %s attempts" % num_attempts)
 
-def query_ga(query, **kwargs):
-    """performs given `query` and fetches any further pages.
-    results are concatenated and returned as part of the last response dict as `rows`."""
+def fetch_pages(fetch_fn, query_list, num_workers=MAX_PAGE_WORKERS):
+    """calls `fetch_fn` with each query in `query_list`, up to `num_workers` at a time.
+    responses are returned in the same order as the queries were given."""
+    if num_workers <= 1 or len(query_list) <= 1:
+        return [fetch_fn(query) for query in query_list]
+    with ThreadPoolExecutor(max_workers=min(num_workers, len(query_list))) as executor:
+        return list(executor.map(fetch_fn, query_list))
 
-    results_pp = query['limit'] = 10000 # 100k max
-    query['offset'] = 0
-
-    page, results = 1, []
-    while True:
-        LOG.info("requesting page %s for query %s" % (page, query))  # ['filters']))
-        response = _query_ga(query, **kwargs)
-        if not response.get('rows'):
-            break # empty response
-        results.extend(response['rows'])
-        if (results_pp * page) >= response['rowCount']:
-            break # no more pages to fetch
-        query['offset'] += results_pp # 0, 1000, 2000, 3000, etc
-        page += 1
+def fetch_remaining_pages(query, response, num_workers=MAX_PAGE_WORKERS, **kwargs):
+    """fetches any further pages for the first `response` to `query`, up to `num_workers` pages at a time.
+    results are concatenated and returned as part of the last response dict as `rows`."""
+    results = response.get('rows') or []
+    page = 1
+
+    if results:
+        # the first response tells us how many rows there are in total, fetch the remaining pages concurrently.
+        num_pages = math.ceil(response['rowCount'] / RESULTS_PP)
+        query_list = [dict(query, offset=RESULTS_PP * n) for n in range(1, num_pages)] # 10000, 20000, 30000, etc
+        LOG.info("requesting pages 2 to %s for query %s" % (num_pages, query))
+        response_list = fetch_pages(lambda q: _query_ga(q, **kwargs), query_list, num_workers)
+        for response_n in response_list:
+            results.extend(response_n.get('rows') or [])
+        page += len(response_list)
+        response = (response_list or [response])[-1]
 
     # use the last response given but with all of the results
     response['rows'] = results
     response['-total-pages'] = page
     return response
+
+def query_ga(query, num_workers=MAX_PAGE_WORKERS, **kwargs):
+    """performs given `query` and fetches any further pages, up to `num_workers` pages at a time.
+    results are concatenated and returned as part of the last response dict as `rows`."""
+    query['limit'] = RESULTS_PP
+    query['offset'] = 0
+
+    LOG.info("requesting page 1 for query %s" % (query,))
+    response = _query_ga(query, **kwargs)
+    return fetch_remaining_pages(query, response, num_workers, **kwargs)
+
+def query_ga_many(query_list, num_workers=MAX_PAGE_WORKERS, **kwargs):
+    """performs each query in `query_list` with a single `batchRunReports` request and fetches any further pages of each.
+    returns a list of responses like those from `query_ga`, in the same order as the queries were given."""
+    ensure(0 < len(query_list) <= MAX_BATCH_REPORTS, "between 1 and %s queries can be requested together" % MAX_BATCH_REPORTS)
+    for query in query_list:
+        query['limit'] = RESULTS_PP
+        query['offset'] = 0
+
+    LOG.info("requesting page 1 for %s queries %s" % (len(query_list), query_list))
+    response_list = _batch_query_ga(query_list, **kwargs)
+    return [fetch_remaining_pages(query, response, num_workers, **kwargs) for query, response in zip(query_list, response_list)]
+
+def batch_query(query_list):
+    """returns a single query for all of the date ranges in the given `query_list`.
+    queries must be identical except for their single date range.
+    see `split_response`."""
+    ensure(0 < len(query_list) <= MAX_DATE_RANGES, "between 1 and %s queries can be batched" % MAX_DATE_RANGES)
+
+    def strip(query):
+        return {key: val for key, val in query.items() if key != 'dateRanges'}
+
+    query = deepcopy(query_list[0])
+    ensure(all(strip(q) == strip(query) for q in query_list), "only queries that differ by date range can be batched")
+    ensure(all(len(q['dateRanges']) == 1 for q in query_list), "only queries with a single date range can be batched")
+    # date ranges are left unnamed. GA names them after their position: 'date_range_0', 'date_range_1', etc
+    query['dateRanges'] = [q['dateRanges'][0] for q in query_list]
+    return query
+
+def split_response(response, query):
+    """splits the `response` to a `query` with many date ranges into a list of responses, one per date range,
+    as if each date range had been queried separately."""
+    num_ranges = len(query['dateRanges'])
+    header_names = [header['name'] for header in response.get('dimensionHeaders', [])]
+    if num_ranges == 1 and 'dateRange' not in header_names:
+        return [response]
+
+    # GA adds a 'dateRange' dimension when more than one date range is given
+    idx = header_names.index('dateRange')
+    dimension_headers = [header for i, header in enumerate(response['dimensionHeaders']) if i != idx]
+
+    rows_by_range = {'date_range_%s' % i: [] for i in range(num_ranges)}
+    for row in response.get('rows', []):
+        values = row['dimensionValues']
+        rows_by_range[values[idx]['value']].append(dict(row, dimensionValues=values[:idx] + values[idx + 1:]))
+
+    response_list = []
+    for i in range(num_ranges):
+        rows = rows_by_range['date_range_%s' % i]
+        response_list.append(dict(response, dimensionHeaders=dimension_headers, rows=rows, rowCount=len(rows)))
+    return response_list
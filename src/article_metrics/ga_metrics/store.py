@@ -0,0 +1,132 @@
+"""storage for cached GA responses.
+
+a response is identified by the path `core.output_path` or `core.output_path_v2` gives it, ll:
+    output/ga/views/2014-04-01.json
+    output/ga/views/2014-01-01_2014-01-31.json
+
+the 'json' backend writes the response to that path as JSON.
+the 'sqlite' backend stores the response as compressed JSON in a single SQLite database (`settings.GA_CACHE_DB`),
+keyed by the `(results_type, from_date, to_date)` parsed from the path.
+
+responses not found in the configured backend are read from any JSON file at the path,
+so existing cache files remain readable until they are migrated with `./manage.sh migrate_ga_cache`."""
+
+import os
+import json
+import sqlite3
+import threading
+import zlib
+from django.conf import settings
+from article_metrics.utils import ensure
+import logging
+
+LOG = logging.getLogger(__name__)
+
+JSON, SQLITE = 'json', 'sqlite'
+
+#
+# json
+#
+
+def json_exists(path):
+    return os.path.exists(path)
+
+def json_read(path):
+    if os.path.exists(path):
+        with open(path, 'r') as fh:
+            return json.load(fh)
+
+def json_write(path, results):
+    dirname = os.path.dirname(path)
+    ensure(os.path.exists(dirname), "output directory does not exist: %s" % path)
+    with open(path, 'w') as fh:
+        json.dump(results, fh, indent=4, sort_keys=True)
+
+#
+# sqlite
+#
+
+CREATE_SQL = """
+CREATE TABLE IF NOT EXISTS ga_results (
+    results_type TEXT NOT NULL,
+    from_date TEXT NOT NULL,
+    to_date TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (results_type, from_date, to_date)
+) WITHOUT ROWID
+"""
+
+def path_key(path):
+    """returns a triple of `(results_type, from_date, to_date)` for the given cache file `path`.
+    'output/ga/views/2014-04-01.json' => ('views', '2014-04-01', '2014-04-01')"""
+    results_type = os.path.basename(os.path.dirname(path))
+    dt_str = os.path.splitext(os.path.basename(path))[0]
+    from_date, _, to_date = dt_str.partition('_')
+    return results_type, from_date, to_date or from_date
+
+# each thread keeps it's own connection, sqlite connections can't be shared between threads.
+_local = threading.local()
+
+def connect():
+    """returns this thread's connection to `settings.GA_CACHE_DB`, connecting and creating the schema on first use.
+    a process forked from this one, or a different `settings.GA_CACHE_DB`, gets a new connection."""
+    key = (os.getpid(), settings.GA_CACHE_DB)
+    if getattr(_local, 'key', None) != key:
+        if getattr(_local, 'key', (None,))[0] == os.getpid():
+            # `settings.GA_CACHE_DB` has changed. a connection inherited from the parent process is left alone.
+            _local.conn.close()
+        conn = sqlite3.connect(settings.GA_CACHE_DB, timeout=30)
+        # readers don't block the writer and the writer doesn't block readers
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(CREATE_SQL)
+        _local.key, _local.conn = key, conn
+    return _local.conn
+
+def compress(results):
+    return zlib.compress(json.dumps(results, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+
+def decompress(data):
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+def sqlite_exists(path):
+    row = connect().execute("SELECT 1 FROM ga_results WHERE results_type = ? AND from_date = ? AND to_date = ?", path_key(path)).fetchone()
+    return row is not None
+
+def sqlite_read(path):
+    row = connect().execute("SELECT data FROM ga_results WHERE results_type = ? AND from_date = ? AND to_date = ?", path_key(path)).fetchone()
+    if row:
+        return decompress(row[0])
+
+def sqlite_write(path, results):
+    conn = connect()
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO ga_results (results_type, from_date, to_date, data) VALUES (?, ?, ?, ?)", path_key(path) + (compress(results),))
+
+#
+#
+#
+
+BACKENDS = {
+    JSON: {'exists': json_exists, 'read': json_read, 'write': json_write},
+    SQLITE: {'exists': sqlite_exists, 'read': sqlite_read, 'write': sqlite_write},
+}
+
+def backend():
+    ensure(settings.GA_CACHE_BACKEND in BACKENDS, "unknown GA cache backend %r" % settings.GA_CACHE_BACKEND)
+    return BACKENDS[settings.GA_CACHE_BACKEND]
+
+def exists(path):
+    "returns `True` if results for the given cache file `path` exist."
+    return backend()['exists'](path) or json_exists(path)
+
+def read(path):
+    "returns the results stored for the given cache file `path` or `None` if there are none."
+    results = backend()['read'](path)
+    if results is None and settings.GA_CACHE_BACKEND != JSON:
+        results = json_read(path)
+    return results
+
+def write(path, results):
+    "stores the `results` for the given cache file `path`."
+    LOG.debug("writing %r", path)
+    backend()['write'](path, results)
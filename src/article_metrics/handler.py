@@ -3,7 +3,9 @@ from os.path import join
 from django.conf import settings
 import inspect
 import uuid
-from article_metrics import utils
+import threading
+from urllib.parse import urlparse
+from article_metrics import utils, http_cache
 import requests, requests_cache
 import logging
 
@@ -12,8 +14,9 @@ from typing import Optional
 LOG = logging.getLogger('debugger') # ! logs to a different file at a finer level
 
 def clear_expired():
-    requests_cache.remove_expired_responses()
-    return settings.CACHE_NAME
+    "removes expired responses from the requests cache. returns the path to the cache."
+    http_cache.remove_expired()
+    return settings.CACHE_NAME if settings.CACHE_BACKEND == http_cache.SQLITE else settings.CACHE_DIR
 
 def clear_cache():
     # completely empties the requests-cache database, probably not what you intended
@@ -80,6 +83,93 @@ DEFAULT_HANDLER = raise_handler
 
 MAX_RETRIES = 5
 
+def no_rate_limit():
+    "the rate limit of an adapter without a `max_per_second`"
+    pass
+
+class RetryingHTTPAdapter(requests.adapters.HTTPAdapter):
+    """an `HTTPAdapter` that retries failed requests.
+    `max_per_second` optionally limits the rate of requests sent through the adapter.
+    responses served from a `requests_cache` session never reach the adapter and are not limited."""
+    def __init__(self, max_per_second=None, **kwargs):
+        # lsh@2023-07-28: handle network errors better
+        # - https://github.com/elifesciences/issues/issues/8386
+        # - https://urllib3.readthedocs.io/en/stable/user-guide.html#retrying-requests
+        # - https://urllib3.readthedocs.io/en/stable/reference/urllib3.util.html#urllib3.util.Retry
+        kwargs['max_retries'] = Retry(**{
+            'total': MAX_RETRIES,
+            'connect': MAX_RETRIES,
+            'read': MAX_RETRIES,
+            # How many times to retry on bad status codes.
+            # These are retries made on responses, where status code matches status_forcelist.
+            'status': MAX_RETRIES,
+            'status_forcelist': [413, 429, 503, # defaults
+                                500, 502, 504],
+            # {backoff factor} * (2 ** {number of previous retries})
+            # 0.5 => 1.0, 2.0, 4.0, 8.0, 16
+            'backoff_factor': 0.5,
+        })
+        super().__init__(**kwargs)
+        self.rate_limit = utils.rate_limiter(max_per_second) if max_per_second else no_rate_limit
+
+    def send(self, *args, **kwargs):
+        self.rate_limit()
+        return super().send(*args, **kwargs)
+
+def pooled_session(pool_maxsize, rate_limits=None, host=None):
+    """returns a session whose connections can be shared between `pool_maxsize` threads.
+    `rate_limits` is an optional map of `{url-prefix: max-requests-per-second}`, ll:
+    {'https://doi.crossref.org/': 10}
+    `host` is the host all requests using the session will be sent to, if known."""
+    session = requests.Session() if settings.TESTING else utils.create_caching_session(host)
+    session.mount('https://', RetryingHTTPAdapter(pool_maxsize=pool_maxsize))
+    for prefix, max_per_second in (rate_limits or {}).items():
+        session.mount(prefix, RetryingHTTPAdapter(max_per_second=max_per_second, pool_maxsize=pool_maxsize))
+    return session
+
+#
+# sessions
+#
+
+# maximum number of connections to a single host kept alive between requests.
+SESSION_POOL_SIZE = 20
+
+# maximum requests per-second to url prefixes.
+# responses served from the cache are not limited.
+RATE_LIMITS = {
+    "https://doi.crossref.org/": 10,
+    settings.LAX_URL: 10,
+}
+
+_host_sessions = {}
+_host_sessions_lock = threading.Lock()
+
+def host_key(url):
+    "'https://example.org/foo?bar=baz' => 'https://example.org/'"
+    bits = urlparse(url)
+    return '%s://%s/' % (bits.scheme, bits.netloc)
+
+def host_session(url):
+    """returns the session shared by all requests in this process to the host of the given `url`.
+    sessions are created on first use and keep up to `SESSION_POOL_SIZE` connections alive between requests."""
+    key = host_key(url)
+    with _host_sessions_lock:
+        if key not in _host_sessions:
+            rate_limits = {prefix: max_per_second for prefix, max_per_second in RATE_LIMITS.items() if prefix.startswith(key)}
+            _host_sessions[key] = pooled_session(SESSION_POOL_SIZE, rate_limits, urlparse(url).netloc)
+        return _host_sessions[key]
+
+def close_host_sessions():
+    "closes all host sessions and their connections. new sessions are created on next use."
+    with _host_sessions_lock:
+        for session in _host_sessions.values():
+            session.close()
+        _host_sessions.clear()
+
+#
+#
+#
+
 def http_get_using_session(*args, session: requests.Session, **kwargs):
     xid = kwargs.pop('opid', opid())
     ctx = {
@@ -112,25 +202,9 @@ def http_get_using_session(*args, session: requests.Session, **kwargs):
     final_kwargs = utils.merge(default_kwargs, kwargs, {'headers': final_headers})
 
     try:
-        # lsh@2023-07-28: handle network errors better
-        # - https://github.com/elifesciences/issues/issues/8386
-        # - https://urllib3.readthedocs.io/en/stable/user-guide.html#retrying-requests
-        # - https://urllib3.readthedocs.io/en/stable/reference/urllib3.util.html#urllib3.util.Retry
-        max_retries_obj = Retry(**{
-            'total': MAX_RETRIES,
-            'connect': MAX_RETRIES,
-            'read': MAX_RETRIES,
-            # How many times to retry on bad status codes.
-            # These are retries made on responses, where status code matches status_forcelist.
-            'status': MAX_RETRIES,
-            'status_forcelist': [413, 429, 503, # defaults
-                                500, 502, 504],
-            # {backoff factor} * (2 ** {number of previous retries})
-            # 0.5 => 1.0, 2.0, 4.0, 8.0, 16
-            'backoff_factor': 0.5,
-        })
-        adaptor = requests.adapters.HTTPAdapter(max_retries=max_retries_obj)
-        session.mount('https://', adaptor)
+        # sessions from `pooled_session` already have their adapters, replacing them would discard their connections.
+        if not isinstance(session.adapters.get('https://'), RetryingHTTPAdapter):
+            session.mount('https://', RetryingHTTPAdapter())
         resp = session.get(*args, **final_kwargs)
         resp.raise_for_status()
         return resp
@@ -174,14 +248,14 @@ def http_get_using_session(*args, session: requests.Session, **kwargs):
         raise
 
 def requests_get(*args, requests_session: Optional[requests.Session] = None, **kwargs):
-    if requests_session is not None:
-        return http_get_using_session(*args, session=requests_session, **kwargs)
-    if not settings.TESTING:
-        session = utils.create_caching_session()
-    else:
-        session = requests.Session()
-    with session:
-        return http_get_using_session(*args, session=session, **kwargs)
+    "fetches the url using `requests_session` or the shared session for the url's host, see `host_session`."
+    if requests_session is None:
+        requests_session = host_session(args[0] if args else kwargs['url'])
+    return http_get_using_session(*args, session=requests_session, **kwargs)
+
+#
+#
+#
 
 def capture_parse_error(fn):
     """wrapper around a parse function that captures any errors to a special log for debugging.
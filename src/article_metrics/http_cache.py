@@ -0,0 +1,159 @@
+"""storage for cached responses to outbound HTTP requests, see `utils.create_caching_session`.
+
+the 'sqlite' backend stores the responses for all hosts in a single SQLite database (`settings.CACHE_NAME`).
+the database is in WAL mode so readers don't block the writer and the writer doesn't block readers.
+the expiry time of each response is kept in an indexed column so expired responses can be removed
+in batches without reading every response in the cache.
+
+the 'filesystem' backend stores each response in a file, in a directory per host under `settings.CACHE_DIR`.
+hosts don't share a lock.
+
+responses expire after `settings.CACHE_EXPIRY` days unless their url matches a pattern in `settings.CACHE_URL_EXPIRY`."""
+
+import os
+import time
+import calendar
+import sqlite3
+from datetime import timedelta
+import requests_cache
+# requests-cache is pinned to 0.9 in the Pipfile, the sqlite backend is extended below.
+from requests_cache.backends.sqlite import SQLiteCache, SQLitePickleDict
+from requests_cache.backends.filesystem import FileCache
+from django.conf import settings
+from article_metrics.utils import ensure
+import logging
+
+LOG = logging.getLogger(__name__)
+
+SQLITE, FILESYSTEM = 'sqlite', 'filesystem'
+
+#
+# sqlite
+#
+
+def expires_timestamp(response):
+    "returns the expiry time of a cached `response` as seconds since the epoch or `None` if it never expires."
+    expires = getattr(response, 'expires', None)
+    if expires is not None:
+        # `expires` is a naive UTC datetime
+        return calendar.timegm(expires.utctimetuple())
+
+class ExpiringSQLiteDict(SQLitePickleDict):
+    "stores the expiry time of each response in an indexed `expires` column."
+
+    def init_db(self):
+        super().init_db()
+        with self._lock, self.connection(commit=True) as con:
+            con.execute("PRAGMA journal_mode=WAL")
+            columns = [row[1] for row in con.execute("PRAGMA table_info(%s)" % self.table_name)]
+            if 'expires' not in columns:
+                con.execute("ALTER TABLE %s ADD COLUMN expires REAL" % self.table_name)
+                self.backfill_expires(con)
+            con.execute("CREATE INDEX IF NOT EXISTS %s_expires ON %s (expires)" % (self.table_name, self.table_name))
+
+    def backfill_expires(self, con, batch_size=1000):
+        """sets the expiry time of responses cached before the `expires` column existed, `batch_size` at a time.
+        this happens once."""
+        LOG.info("backfilling expiry times of responses in %s", self.db_path)
+        query = "SELECT rowid, key, value FROM %s WHERE rowid > ? ORDER BY rowid LIMIT ?" % self.table_name
+        last_rowid = 0
+        while True:
+            row_list = con.execute(query, (last_rowid, batch_size)).fetchall()
+            if not row_list:
+                break
+            for last_rowid, key, value in row_list:
+                try:
+                    expires = expires_timestamp(self.serializer.loads(value))
+                except Exception:
+                    # can't be deserialized, expire it now
+                    expires = 0
+                con.execute("UPDATE %s SET expires = ? WHERE key = ?" % self.table_name, (expires, key))
+
+    def __setitem__(self, key, value):
+        serialized_value = self.serializer.dumps(value)
+        if isinstance(serialized_value, bytes):
+            serialized_value = sqlite3.Binary(serialized_value)
+        with self.connection(commit=True) as con:
+            con.execute("INSERT OR REPLACE INTO %s (key, value, expires) VALUES (?, ?, ?)" % self.table_name,
+                        (key, serialized_value, expires_timestamp(value)))
+
+    def expired_keys(self, now, limit):
+        "returns up to `limit` keys of responses that expired before `now`, using the `expires` index."
+        with self.connection() as con:
+            query = "SELECT key FROM %s WHERE expires < ? LIMIT ?" % self.table_name
+            return [row[0] for row in con.execute(query, (now, limit))]
+
+class ExpiringSQLiteCache(SQLiteCache):
+    def __init__(self, db_path, **kwargs):
+        super().__init__(db_path, **kwargs)
+        self.responses = ExpiringSQLiteDict(db_path, table_name='responses', **kwargs)
+
+def sqlite_backend(host):
+    # all hosts share the one database
+    return ExpiringSQLiteCache(settings.CACHE_NAME, timeout=30)
+
+def sqlite_remove_expired(batch_size=1000):
+    """removes expired responses and their redirects, `batch_size` at a time.
+    each batch is a short write, so requests using the cache aren't blocked for long."""
+    cache = sqlite_backend(None)
+    now = time.time()
+    num_removed = 0
+    while True:
+        key_list = cache.responses.expired_keys(now, batch_size)
+        if not key_list:
+            break
+        cache.responses.bulk_delete(keys=key_list)
+        cache.redirects.bulk_delete(values=key_list)
+        num_removed += len(key_list)
+    return num_removed
+
+#
+# filesystem
+#
+
+def filesystem_backend(host):
+    return FileCache(os.path.join(settings.CACHE_DIR, host or 'default'))
+
+def filesystem_remove_expired():
+    "removes expired responses from each host's directory in turn."
+    num_removed = 0
+    if not os.path.isdir(settings.CACHE_DIR):
+        return num_removed
+    for host in sorted(os.listdir(settings.CACHE_DIR)):
+        cache = filesystem_backend(host)
+        num_before = len(cache.responses)
+        cache.delete(expired=True, invalid=True)
+        num_removed += num_before - len(cache.responses)
+    return num_removed
+
+#
+#
+#
+
+BACKENDS = {
+    SQLITE: {'backend': sqlite_backend, 'remove-expired': sqlite_remove_expired},
+    FILESYSTEM: {'backend': filesystem_backend, 'remove-expired': filesystem_remove_expired},
+}
+
+def backend_fns():
+    ensure(settings.CACHE_BACKEND in BACKENDS, "unknown requests cache backend %r" % settings.CACHE_BACKEND)
+    return BACKENDS[settings.CACHE_BACKEND]
+
+def url_expiry():
+    "returns a map of url patterns to their expiry, see `settings.CACHE_URL_EXPIRY`."
+    return {pattern: timedelta(days=days) for pattern, days in settings.CACHE_URL_EXPIRY.items()}
+
+def create_session(host=None):
+    """returns a session that caches responses using the configured backend.
+    `host` is the host all requests using the session will be sent to, if known."""
+    return requests_cache.CachedSession(
+        backend=backend_fns()['backend'](host),
+        expire_after=timedelta(days=settings.CACHE_EXPIRY),
+        urls_expire_after=url_expiry(),
+    )
+
+def remove_expired():
+    "removes expired responses from the configured backend, returning the number removed."
+    num_removed = backend_fns()['remove-expired']()
+    LOG.info("removed %s expired responses from the %r requests cache", num_removed, settings.CACHE_BACKEND)
+    return num_removed
@@ -1,10 +1,14 @@
 from functools import partial
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import multiprocessing
+from itertools import chain
 from datetime import timedelta
 from typing import Optional
-from . import ga_metrics, models, utils, events
+from . import ga_metrics, models, utils, events, api_v2_cache
+import os
 from django.conf import settings
-from django.db import transaction
-from .utils import first, create_or_update, ensure, splitfilter, comp, run, lfilter, datetime_now
+from django.db import transaction, connection, connections
+from .utils import first, second, create_or_update, ensure, splitfilter, comp, run, lfilter, datetime_now
 import logging
 
 LOG = logging.getLogger(__name__)
@@ -69,8 +73,108 @@ def get_create_article(data):
         # it shouldn't get to this point!
         LOG.warning("refusing to fetch/create bad article: %s" % err, extra={'article-data': data})
 
-def _insert_row(data):
-    "creates or updates a `models.Metric` in the database using `data`."
+def article_id_map():
+    """returns a map of `{doi: article-id}` for every known article using a single query.
+    create one per-import and pass it to anything accepting an `id_map`, it's updated as articles are created."""
+    return dict(models.Article.objects.values_list('doi', 'id'))
+
+def get_create_article_ids(doi_list, id_map):
+    """returns a map of `{doi: article-id}` for each DOI in `doi_list`.
+    articles missing from the given `id_map` are fetched or created in bulk and added to it.
+    bad DOIs are excluded from the result."""
+    norm_idx = {}
+    for doi in doi_list:
+        try:
+            norm_idx[doi] = utils.msid2doi(utils.doi2msid(doi, allow_subresource=False))
+        except AssertionError as err:
+            LOG.warning("refusing to fetch/create bad article: %s" % err, extra={'article-data': {'doi': doi}})
+
+    missing = set(norm_idx.values()) - set(id_map.keys())
+    if missing:
+        # DOIs are validated above, `full_clean` would only duplicate that work.
+        models.Article.objects.bulk_create([models.Article(doi=doi) for doi in missing], ignore_conflicts=True)
+        id_map.update(models.Article.objects.filter(doi__in=missing).values_list('doi', 'id'))
+
+    return {doi: id_map[norm_doi] for doi, norm_doi in norm_idx.items()}
+
+def get_create_article_id(doi, id_map):
+    "convenience. like `get_create_article_ids` but for a single DOI. returns None on bad data"
+    return get_create_article_ids([doi], id_map).get(doi)
+
+#
+# article summaries
+#
+
+SUMMARY_REFRESH_SQL = open(os.path.join(settings.SQL_PATH, 'metrics-summary.sql'), 'r').read()
+
+def refresh_article_summaries(article_id_list=None):
+    """recalculates the `models.ArticleSummary` for each article in `article_id_list` from it's metrics and citations.
+    all summaries are recalculated if no `article_id_list` is given."""
+    params = {'all': article_id_list is None, 'article_id_list': list(article_id_list or [])}
+    with transaction.atomic():
+        if article_id_list is None:
+            # summaries for articles that no longer have any metrics would otherwise linger.
+            models.ArticleSummary.objects.all().delete()
+        with connection.cursor() as cursor:
+            cursor.execute(SUMMARY_REFRESH_SQL, params)
+
+# any summary for the given article ids that doesn't exist is created with it's citation totals.
+CREATE_SUMMARY_SQL = """
+INSERT INTO metrics_article_summary
+    (article_id, views, downloads, scopus, pubmed, crossref, datetime_record_updated)
+SELECT
+    ma.id,
+    0,
+    0,
+    coalesce(sum(mc.num) filter (where mc.source = 'scopus'), 0),
+    coalesce(sum(mc.num) filter (where mc.source = 'pubmed'), 0),
+    coalesce(sum(mc.num) filter (where mc.source = 'crossref'), 0),
+    now()
+FROM
+    metrics_article ma
+LEFT JOIN
+    metrics_citation mc ON mc.article_id = ma.id
+WHERE
+    ma.id = any(%s)
+GROUP BY
+    ma.id
+ON CONFLICT (article_id) DO NOTHING
+"""
+
+# the change in each article's totals is applied to it's summary
+UPDATE_SUMMARY_SQL = """
+UPDATE metrics_article_summary AS mas SET
+    views = mas.views + delta.views,
+    downloads = mas.downloads + delta.downloads,
+    datetime_record_updated = now()
+FROM
+    (VALUES %s) AS delta (article_id, views, downloads)
+WHERE
+    mas.article_id = delta.article_id
+"""
+
+def _update_article_summaries(new_article_ids, delta_idx):
+    """creates any missing `models.ArticleSummary` for the articles in `new_article_ids` and then
+    applies the change in views and downloads in `delta_idx` to each article's summary.
+    `delta_idx` is a map of `{article-id: [views, downloads]}`."""
+    with connection.cursor() as cursor:
+        if new_article_ids:
+            cursor.execute(CREATE_SUMMARY_SQL, [list(new_article_ids)])
+        delta_idx = {article_id: delta for article_id, delta in delta_idx.items() if delta != [0, 0]}
+        if delta_idx:
+            params = []
+            for article_id, (views, downloads) in delta_idx.items():
+                params.extend([article_id, views, downloads])
+            values = ", ".join(["(%s, %s, %s)"] * len(delta_idx))
+            cursor.execute(UPDATE_SUMMARY_SQL % values, params)
+
+#
+#
+#
+
+def _insert_row(data, summary_article_ids):
+    """creates or updates a `models.Metric` in the database using `data`.
+    the article id is added to the set `summary_article_ids` if the article's summary needs refreshing."""
     article_obj = get_create_article({'doi': data['doi']})
     if not article_obj:
         LOG.warning("refusing to insert bad metric", extra={'row-data': data})
@@ -78,18 +182,148 @@ def _insert_row(data):
     row = utils.exsubdict(data, ['doi'])
     row['article'] = article_obj
     key = utils.subdict(row, ['article', 'date', 'period', 'source'])
-    return first(create_or_update(models.Metric, row, key, create=True, update=True, update_check=True))
+    metric, created, updated = create_or_update(models.Metric, row, key, create=True, update=True, update_check=True)
+    if (created or updated) and (metric.period, metric.source) == (models.DAY, models.GA):
+        summary_article_ids.add(article_obj.id)
+    return metric
 
 @transaction.atomic
 def insert_row(data):
     """inserts a metric dict into the database using a single transaction.
     DO NOT USE when inserting many objects. Use `insert_many_rows` or your performance will suffer greatly."""
-    return _insert_row(data)
+    summary_article_ids = set()
+    metric = _insert_row(data, summary_article_ids)
+    if summary_article_ids:
+        refresh_article_summaries(summary_article_ids)
+    return metric
 
 @transaction.atomic
 def insert_many_rows(data_list):
-    "inserts all items in given `data_list` using a single transaction."
-    run(_insert_row, data_list)
+    """inserts all items in given `data_list` using a single transaction.
+    article summaries are refreshed once, after all items are inserted."""
+    summary_article_ids = set()
+    run(partial(_insert_row, summary_article_ids=summary_article_ids), data_list)
+    if summary_article_ids:
+        refresh_article_summaries(summary_article_ids)
+
+# metrics are upserted in two statements, an insert of the new rows followed by an update of the existing rows.
+# each statement returns the change to the views and downloads of the rows it wrote.
+# summaries are updated with these changes, so they must be exact when rows are written concurrently.
+
+# new rows. rows that exist are left to the update.
+INSERT_METRIC_SQL = """
+INSERT INTO metrics_metric
+    (article_id, date, period, source, "full", abstract, digest, pdf, datetime_record_created, datetime_record_updated)
+VALUES
+    %s
+ON CONFLICT (article_id, date, period, source) DO NOTHING
+RETURNING id, article_id, period, source, "full" + abstract + digest, pdf
+"""
+
+# existing rows are only updated if one of their values has changed, leaving `datetime_record_updated` untouched otherwise.
+# `FOR UPDATE` locks the existing rows and reads their latest values, even if they were changed by another
+# transaction after this statement began.
+# - https://www.postgresql.org/docs/current/sql-select.html#SQL-FOR-UPDATE-SHARE
+UPDATE_METRIC_SQL = """
+UPDATE metrics_metric AS mm SET
+    "full" = new."full",
+    abstract = new.abstract,
+    digest = new.digest,
+    pdf = new.pdf,
+    datetime_record_updated = new.datetime_record_updated
+FROM
+    (VALUES %(values)s) AS new (article_id, date, period, source, "full", abstract, digest, pdf, datetime_record_updated),
+    (SELECT
+        m.id, m.article_id, m.date, m.period, m.source, m."full", m.abstract, m.digest, m.pdf
+    FROM
+        metrics_metric m
+    WHERE
+        (m.article_id, m.date, m.period, m.source) IN (VALUES %(keys)s)
+    ORDER BY
+        m.id
+    FOR UPDATE) AS old
+WHERE
+    mm.id = old.id
+    AND (old.article_id, old.date, old.period, old.source) = (new.article_id, new.date, new.period, new.source)
+    AND (old."full", old.abstract, old.digest, old.pdf) IS DISTINCT FROM (new."full", new.abstract, new.digest, new.pdf)
+RETURNING
+    mm.id, mm.article_id, mm.period, mm.source,
+    (new."full" + new.abstract + new.digest) - (old."full" + old.abstract + old.digest),
+    new.pdf - old.pdf
+"""
+
+def _upsert_rows(data_list, id_map=None):
+    """creates or updates a `models.Metric` in the database for each row in `data_list` using two statements.
+    `id_map` is an optional map of `{doi: article-id}`, see `article_id_map`.
+    returns a list of `(metric-id, created, updated)` triples for just those rows that were created or updated."""
+    now = utils.utcnow()
+    id_map = {} if id_map is None else id_map
+    article_id_idx = get_create_article_ids([data['doi'] for data in data_list], id_map)
+    row_idx = {}
+    for data in data_list:
+        article_id = article_id_idx.get(data['doi'])
+        if not article_id:
+            LOG.warning("refusing to insert bad metric", extra={'row-data': data})
+            continue
+        row = utils.exsubdict(data, ['doi'])
+        # `models.pre_save_handler` isn't called for bulk inserts.
+        # `clean_fields` validates the row without the database lookups `full_clean` would do.
+        # the article has already been validated.
+        models.Metric(article_id=article_id, **row).clean_fields(exclude=['article'])
+        # a row may only be upserted once per-statement, last row wins.
+        key = (article_id, row['date'], row['period'], row['source'])
+        row_idx[key] = row
+
+    if not row_idx:
+        return []
+
+    params = []
+    for (article_id, date, period, source), row in row_idx.items():
+        params.extend([article_id, date, period, source, row['full'], row['abstract'], row['digest'], row['pdf'], now, now])
+
+    results = []
+    new_article_ids = set()
+    delta_idx = {}
+
+    def add_delta(article_id, period, source, views, downloads):
+        if (period, source) == (models.DAY, models.GA):
+            delta = delta_idx.setdefault(article_id, [0, 0])
+            delta[0] += views
+            delta[1] += downloads
+
+    with connection.cursor() as cursor:
+        values = ", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"] * len(row_idx))
+        cursor.execute(INSERT_METRIC_SQL % values, params)
+        for metric_id, article_id, period, source, views, downloads in cursor.fetchall():
+            results.append((metric_id, True, False))
+            if (period, source) == (models.DAY, models.GA):
+                new_article_ids.add(article_id)
+            add_delta(article_id, period, source, views, downloads)
+
+        if len(results) < len(row_idx):
+            update_params = [param for i, param in enumerate(params) if i % 10 != 8] # created date isn't updated
+            key_params = [param for i, param in enumerate(params) if i % 10 < 4]
+            sql = UPDATE_METRIC_SQL % {
+                'values': ", ".join(["(%s::integer, %s::varchar, %s::varchar, %s::varchar, %s::integer, %s::integer, %s::integer, %s::integer, %s::timestamptz)"] * len(row_idx)),
+                'keys': ", ".join(["(%s::integer, %s::varchar, %s::varchar, %s::varchar)"] * len(row_idx)),
+            }
+            cursor.execute(sql, update_params + key_params)
+            for metric_id, article_id, period, source, views, downloads in cursor.fetchall():
+                results.append((metric_id, False, True))
+                add_delta(article_id, period, source, views, downloads)
+
+    _update_article_summaries(new_article_ids, delta_idx)
+
+    num_created = len(lfilter(second, results))
+    LOG.info("%s metrics created, %s changed and were updated, %s unchanged" % (
+        num_created, len(results) - num_created, len(row_idx) - len(results)))
+    return results
+
+@transaction.atomic
+def upsert_many_rows(data_list, id_map=None):
+    """creates or updates all items in given `data_list` using a single transaction and at most two statements.
+    much faster than `insert_many_rows`."""
+    return _upsert_rows(data_list, id_map)
 
 def create_row(doi, period, views, downloads):
     "wrangles the data into a format suitable for `insert_row`"
@@ -105,49 +339,138 @@ def create_row(doi, period, views, downloads):
     row.update(views)
     return row
 
-def import_ga_metrics(metrics_type='daily', from_date=None, to_date=None, use_cached=True, use_only_cached=False):
-    "import metrics from GA between the two given dates or from the inception date in `settings.py`"
-    ensure(metrics_type in ['daily', 'monthly'], 'metrics type must be either "daily" or "monthly"')
-
-    table_id = 'ga:%s' % settings.GA3_TABLE_ID
-    the_beginning = ga_metrics.core.VIEWS_INCEPTION
-    yesterday = datetime_now() - timedelta(days=1)
-
+def ga_dates(from_date=None, to_date=None):
+    "returns the pair of `from_date` and `to_date`, defaulting to the inception date in `settings.py` and yesterday."
     if not from_date:
-        from_date = the_beginning
+        from_date = ga_metrics.core.VIEWS_INCEPTION
 
     if not to_date:
         # don't import today's partial results. they're available but lets wait until tomorrow
-        to_date = yesterday
+        to_date = datetime_now() - timedelta(days=1)
+
+    return from_date, to_date
+
+def ga_rows(period, metrics):
+    "returns a list of rows suitable for `insert_row` from the GA `metrics` for the given `period`."
+    views, downloads = metrics['views'], metrics['downloads']
+    # there is often a disjoint between articles that have been viewed and those downloaded within a period
+    # what we do is create a record for *all* articles seen, even if their views or downloads may not exist
+    doi_list = set(views.keys()).union(list(downloads.keys()))
+    return [create_row(doi, period, views.get(doi), downloads.get(doi)) for doi in doi_list]
+
+def import_ga_metrics(metrics_type='daily', from_date=None, to_date=None, use_cached=True, use_only_cached=False, num_workers=1, bulk=True, batch_size=1):
+    """import metrics from GA between the two given dates or from the inception date in `settings.py`.
+    `num_workers` is the number of date ranges to query GA for concurrently.
+    `bulk` upserts each batch of rows with a single statement rather than row by row.
+    `batch_size` is the number of GA4 date ranges to query GA for in a single request."""
+    ensure(metrics_type in ['daily', 'monthly'], 'metrics type must be either "daily" or "monthly"')
+
+    table_id = 'ga:%s' % settings.GA3_TABLE_ID
+    from_date, to_date = ga_dates(from_date, to_date)
 
     f = {
         'daily': ga_metrics.core.daily_metrics_between,
         'monthly': ga_metrics.core.monthly_metrics_between,
     }
-    results = f[metrics_type](table_id, from_date, to_date, use_cached, use_only_cached)
+    results = f[metrics_type](table_id, from_date, to_date, use_cached, use_only_cached, num_workers, batch_size)
+
+    insert_fn = partial(upsert_many_rows, id_map=article_id_map()) if bulk else insert_many_rows
 
     for period, metrics in results.items():
-        views, downloads = metrics['views'], metrics['downloads']
-        # there is often a disjoint between articles that have been viewed and those downloaded within a period
-        # what we do is create a record for *all* articles seen, even if their views or downloads may not exist
-        doi_list = set(views.keys()).union(list(downloads.keys()))
-        row_list = [create_row(doi, period, views.get(doi), downloads.get(doi)) for doi in doi_list]
+        row_list = ga_rows(period, metrics)
         # insert rows in batches of 1000
-        run(insert_many_rows, utils.partition(row_list, 1000))
+        run(insert_fn, utils.partition(row_list, 1000))
+
+    api_v2_cache.invalidate(api_v2_cache.ARTICLE_METRICS)
+
+# rows are passed between processes as tuples of these fields
+GA_ROW_FIELDS = ('doi', 'period', 'date', 'full', 'abstract', 'digest', 'pdf')
+
+def _cached_ga_rows(table_id, from_date, to_date):
+    """returns the rows for the cached GA results between `from_date` and `to_date` as tuples of `GA_ROW_FIELDS`.
+    called in a separate process by `rebuild_ga_metrics`, it must not touch the database."""
+    metrics = ga_metrics.core.article_metrics(table_id, from_date, to_date, cached=True, only_cached=True)
+    period = (ga_metrics.utils.ymd(from_date), ga_metrics.utils.ymd(to_date))
+    return [tuple(row[field] for field in GA_ROW_FIELDS) for row in ga_rows(period, metrics)]
+
+def rebuild_ga_metrics(metrics_type='daily', from_date=None, to_date=None, num_processes=None):
+    """like `import_ga_metrics` but uses *only* cached GA results, never querying GA.
+    date ranges too recent to have been cached are skipped, see `ga_metrics.core.cacheable`.
+    the cached results for each date range are parsed in a pool of `num_processes` processes (default: one per CPU)
+    and then upserted by this process as they arrive.
+    no more than two date ranges per-process are parsed or waiting to be upserted at once."""
+    ensure(metrics_type in ['daily', 'monthly'], 'metrics type must be either "daily" or "monthly"')
+
+    table_id = 'ga:%s' % settings.GA3_TABLE_ID
+    from_date, to_date = ga_dates(from_date, to_date)
+
+    f = {
+        'daily': ga_metrics.utils.dt_range,
+        'monthly': ga_metrics.utils.dt_month_range,
+    }
+    # `ga_metrics.core.load_cache` ignores `only_cached` for date ranges that can't be cached and GA would be queried.
+    dt_range_list = [(from_dt, to_dt) for from_dt, to_dt in f[metrics_type](from_date, to_date)
+                     if ga_metrics.core.cacheable(to_dt)]
+
+    insert_fn = partial(upsert_many_rows, id_map=article_id_map())
+    num_processes = num_processes or os.cpu_count()
+
+    def upsert_completed(pending):
+        "waits for at least one of the `pending` futures, upserting it's rows and returning those still pending."
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            row_list = [dict(zip(GA_ROW_FIELDS, row), source=models.GA) for row in future.result()]
+            run(insert_fn, utils.partition(row_list, 1000))
+        return pending
+
+    # forked workers would otherwise share this process's database connection.
+    # it's re-opened by the next query. closing it within a transaction would abort the transaction.
+    if not connection.in_atomic_block:
+        connections.close_all()
+
+    # 'fork' so workers inherit the configured Django settings
+    mp_context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=num_processes, mp_context=mp_context) as executor:
+        # futures, and the rows they hold, are dropped once upserted.
+        pending = set()
+        for from_dt, to_dt in dt_range_list:
+            pending.add(executor.submit(_cached_ga_rows, table_id, from_dt, to_dt))
+            if len(pending) >= num_processes * 2:
+                pending = upsert_completed(pending)
+        while pending:
+            pending = upsert_completed(pending)
+
+    api_v2_cache.invalidate(api_v2_cache.ARTICLE_METRICS)
 
 #
 # citations
 #
 
-def insert_citation(data, aid='doi'):
-    article_obj = get_create_article({aid: data[aid]})
-    if not article_obj:
+def insert_citation(data, aid='doi', id_map=None):
+    """creates or updates a `models.Citation` using `data`.
+    `id_map` is an optional map of `{doi: article-id}` used when the article identifier `aid` is a 'doi'.
+    for any other `aid`, `id_map` is a map of known `{aid: article-id}`."""
+    if aid == 'doi' and id_map is not None:
+        article = get_create_article_id(data[aid], id_map)
+        article_key = 'article_id'
+    elif id_map is not None and data[aid] in id_map:
+        article = id_map[data[aid]]
+        article_key = 'article_id'
+    else:
+        article = get_create_article({aid: data[aid]})
+        article_key = 'article'
+    if not article:
         LOG.warning("refusing to insert bad citation", extra={'citation-data': data})
         return
     row = utils.exsubdict(data, [aid])
-    row['article'] = article_obj
-    key = utils.subdict(row, ['article', 'source'])
-    return create_or_update(models.Citation, row, key, create=True, update=True, update_check=True)
+    row[article_key] = article
+    key = utils.subdict(row, [article_key, 'source'])
+    triple = create_or_update(models.Citation, row, key, create=True, update=True, update_check=True)
+    citation, created, updated = triple
+    if created or updated:
+        # citation sources are also the names of the summary fields
+        models.ArticleSummary.objects.filter(article_id=citation.article_id).update(**{citation.source: citation.num, 'datetime_record_updated': utils.utcnow()})
+    return triple
 
 def countable(triple):
     "if the citation has been created or modified, return the object"
@@ -161,14 +484,26 @@ def import_scopus_citations():
     results = all_todays_entries()
     good_eggs, bad_eggs = splitfilter(lambda e: 'bad' not in e, results)
     LOG.warning("refusing to insert %s bad entries", len(bad_eggs), extra={'bad-entries': bad_eggs})
-    run(comp(insert_citation, countable), good_eggs)
+    run(comp(partial(insert_citation, id_map=article_id_map()), countable), good_eggs)
+    api_v2_cache.invalidate(api_v2_cache.ARTICLE_METRICS)
 
-def import_pmc_citations():
-    from .pm.citations import citations_for_all_articles
-    results = citations_for_all_articles()
-    run(comp(partial(insert_citation, aid='pmcid'), countable), results)
+def import_pmc_citations(num_workers=4):
+    """imports PMC citations for all articles, see `pm.citations.citation_pages`.
+    each page of results is inserted in a single transaction."""
+    from .pm.citations import citation_pages_for_all_articles
+    for results in citation_pages_for_all_articles(num_workers):
+        pmcid_list = [result['pmcid'] for result in results]
+        with transaction.atomic():
+            id_map = dict(models.Article.objects.filter(pmcid__in=pmcid_list).values_list('pmcid', 'id'))
+            run(comp(partial(insert_citation, aid='pmcid', id_map=id_map), countable), results)
+    api_v2_cache.invalidate(api_v2_cache.ARTICLE_METRICS)
 
-def import_crossref_citations(msid: Optional[str] = None):
+def import_crossref_citations(msid: Optional[str] = None, num_workers=1):
+    """fetches and inserts crossref citations for all articles or just the given `msid`.
+    citations are inserted as they are fetched, `num_workers` articles at a time."""
     from .crossref.citations import citations_for_articles
-    results = citations_for_articles(msid=msid)
-    run(comp(insert_citation, countable), lfilter(None, results))
+    results = filter(None, citations_for_articles(msid=msid, num_workers=num_workers))
+    first_result = next(results, None)
+    if first_result:
+        run(comp(partial(insert_citation, id_map=article_id_map()), countable), chain([first_result], results))
+        api_v2_cache.invalidate(api_v2_cache.ARTICLE_METRICS)
@@ -5,6 +5,7 @@ from typing import Callable, Mapping, Tuple
 from dateutil.relativedelta import relativedelta
 from django.core.management.base import BaseCommand
 from article_metrics import logic, models
+from article_metrics.ga_metrics import ga4
 import metrics.logic
 import logging
 
@@ -44,6 +45,8 @@ def get_sources(options: dict) -> Mapping[str, Tuple[Callable, ...]]:
     n_months_ago = today - relativedelta(months=options['months'])
     use_cached = options['cached']
     use_only_cached = options['only_cached']
+    num_workers = options['workers']
+    batch_size = options['batch_size']
     article_id = options['article_id']
     selected_source = options['source']
 
@@ -57,14 +60,13 @@ def get_sources(options: dict) -> Mapping[str, Tuple[Callable, ...]]:
     # date ranges and caching arguments don't matter to citations right now
     # caching is feasible, but only crossref supports querying citations by date range
     sources = OrderedDict([
-        # lsh@2023-08-14: `logic.update_all_ptypes_latest_frame` queries on frame boundaries.
-        # Because the frame boundary extends to 'today' a cache file will not be generated.
-        # This is what we want. For now it avoids accumulating files and partial results at the
-        # expense of daily queries with larger results (<10MB).
-        (NA_METRICS, (timeit("non-article-metrics")(metrics.logic.update_all_ptypes_latest_frame),)),
-        (GA_DAILY, (timeit("article-metrics-daily")(logic.import_ga_metrics), 'daily', from_date, to_date, use_cached, use_only_cached)),
-        (GA_MONTHLY, (timeit("article-metrics-monthly")(logic.import_ga_metrics), 'monthly', n_months_ago, to_date, use_cached, use_only_cached)),
-        # (models.CROSSREF, (timeit("crossref-citations")(logic.import_crossref_citations), article_id)),
+        # `metrics.logic.update_all_ptypes_incremental` queries each page type from the day it was last
+        # updated, less a few days of potentially partial results, split into months.
+        # closed months are cached, so daily queries stay small rather than growing with the frame.
+        (NA_METRICS, (timeit("non-article-metrics")(metrics.logic.update_all_ptypes_incremental),)),
+        (GA_DAILY, (timeit("article-metrics-daily")(logic.import_ga_metrics), 'daily', from_date, to_date, use_cached, use_only_cached, num_workers, True, batch_size)),
+        (GA_MONTHLY, (timeit("article-metrics-monthly")(logic.import_ga_metrics), 'monthly', n_months_ago, to_date, use_cached, use_only_cached, num_workers, True, batch_size)),
+        # (models.CROSSREF, (timeit("crossref-citations")(logic.import_crossref_citations), article_id, num_workers)),
         # (models.SCOPUS, (timeit("scopus-citations")(logic.import_scopus_citations),)),
         # (models.PUBMED, (timeit("pmc-citations")(logic.import_pmc_citations),)),
     ])
@@ -110,6 +112,11 @@ class Command(BaseCommand):
         parser.add_argument('--cached', dest='cached', action="store_true", default=True)
         # import *only* from cached results, don't try to fetch from remote
         parser.add_argument('--only-cached', dest='only_cached', action="store_true", default=False)
+        # number of date ranges to query GA for concurrently.
+        # all workers share the same GA rate limit.
+        parser.add_argument('--workers', nargs='?', type=int, default=1)
+        # number of GA4 date ranges to query GA for in a single request.
+        parser.add_argument('--batch-size', nargs='?', type=int, default=ga4.MAX_DATE_RANGES)
 
     @timeit("overall")
     def handle(self, *args, **options):
@@ -0,0 +1,40 @@
+"""copies the cached GA responses in JSON files under `settings.GA_OUTPUT_SUBDIR` into the configured GA cache backend.
+
+    ./manage.sh migrate_ga_cache
+    ./manage.sh migrate_ga_cache --delete # remove each JSON file once it has been stored
+"""
+import os
+import glob
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from article_metrics.ga_metrics import store
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delete', action='store_true', default=False, help="delete each JSON file once it has been stored and read back")
+
+    def handle(self, *args, **options):
+        if settings.GA_CACHE_BACKEND == store.JSON:
+            raise CommandError("the GA cache backend is 'json', there is nothing to migrate to.")
+
+        path_list = sorted(glob.glob(os.path.join(settings.GA_OUTPUT_SUBDIR, '*', '*.json')))
+        self.stdout.write("migrating %s files to the %r backend" % (len(path_list), settings.GA_CACHE_BACKEND))
+
+        num_bytes = 0
+        for i, path in enumerate(path_list, start=1):
+            results = store.json_read(path)
+            store.write(path, results)
+            num_bytes += os.path.getsize(path)
+            if options['delete']:
+                if store.backend()['read'](path) != results:
+                    raise CommandError("stored results for %s differ from the file, refusing to delete it" % path)
+                os.remove(path)
+            if i % 1000 == 0:
+                self.stdout.write("%s of %s" % (i, len(path_list)))
+
+        self.stdout.write("migrated %s files (%.1fMB)" % (len(path_list), num_bytes / 1024 / 1024))
+        if os.path.exists(settings.GA_CACHE_DB):
+            self.stdout.write("%s is %.1fMB" % (settings.GA_CACHE_DB, os.path.getsize(settings.GA_CACHE_DB) / 1024 / 1024))
+        self.stdout.flush()
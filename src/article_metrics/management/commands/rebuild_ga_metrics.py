@@ -0,0 +1,28 @@
+"""rebuilds article metrics from cached GA results only, parsing the cached results in parallel processes.
+useful after changing the patterns used to match article paths in an `elife_v*` module.
+
+    ./manage.sh rebuild_ga_metrics
+    ./manage.sh rebuild_ga_metrics --type monthly --from 2016-01-01 --to 2016-12-31 --processes 4
+"""
+from datetime import datetime
+from django.core.management.base import BaseCommand
+from article_metrics import logic
+
+def ymd(string):
+    return datetime.strptime(string, "%Y-%m-%d")
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument('--type', choices=['daily', 'monthly'], action='append', dest='types', help="default is both daily and monthly")
+        parser.add_argument('--from', type=ymd, dest='from_date', help="YYYY-MM-DD, default is the inception date")
+        parser.add_argument('--to', type=ymd, dest='to_date', help="YYYY-MM-DD, default is yesterday")
+        parser.add_argument('--processes', type=int, default=None, help="default is one per CPU")
+
+    def handle(self, *args, **options):
+        for metrics_type in options['types'] or ['daily', 'monthly']:
+            self.stdout.write("rebuilding %s article metrics" % metrics_type)
+            logic.rebuild_ga_metrics(metrics_type, options['from_date'], options['to_date'], options['processes'])
+        self.stdout.write("...done\n")
+        self.stdout.flush()
@@ -0,0 +1,19 @@
+"""looks up the pmid and pmcid of every article missing a pmcid using the PMC ID converter API.
+ids are looked up in batches, so a new machine can be bootstrapped without `download-pmcids.sh`.
+
+    ./manage.sh resolve_pmcids
+"""
+from django.core.management.base import BaseCommand
+from article_metrics.pm import citations
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=citations.MAX_IDS_PER_LOOKUP,
+                            help="number of articles to look up per-request, no more than %s" % citations.MAX_IDS_PER_LOOKUP)
+
+    def handle(self, *args, **options):
+        num_updated = citations.resolve_missing_pmcids(options['chunk_size'])
+        self.stdout.write("updated %s articles\n" % num_updated)
+        self.stdout.flush()
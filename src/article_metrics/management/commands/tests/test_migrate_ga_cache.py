@@ -0,0 +1,47 @@
+import os
+import json
+import shutil
+import tempfile
+import pytest
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from article_metrics.ga_metrics import store
+
+
+@pytest.fixture(name='ga_output_dir')
+def _ga_output_dir(settings):
+    name = tempfile.mkdtemp()
+    settings.GA_OUTPUT_SUBDIR = name
+    settings.GA_CACHE_DB = os.path.join(name, 'ga-cache.sqlite3')
+    settings.GA_CACHE_BACKEND = store.SQLITE
+    yield name
+    shutil.rmtree(name)
+
+
+def _write_json(ga_output_dir, results_type, fname, results):
+    os.makedirs(os.path.join(ga_output_dir, results_type), exist_ok=True)
+    path = os.path.join(ga_output_dir, results_type, fname)
+    with open(path, 'w') as fh:
+        json.dump(results, fh, indent=4)
+    return path
+
+
+class TestMigrateGACache:
+    def test_should_copy_json_files_into_the_backend(self, ga_output_dir: str):
+        path1 = _write_json(ga_output_dir, 'views', '2014-04-01.json', {'rows': [['/foo', '1']]})
+        path2 = _write_json(ga_output_dir, 'event', '2018-01-01_2018-01-31.json', {'rows': []})
+        call_command('migrate_ga_cache')
+        assert store.sqlite_read(path1) == {'rows': [['/foo', '1']]}
+        assert store.sqlite_read(path2) == {'rows': []}
+        assert os.path.exists(path1)
+
+    def test_should_delete_json_files(self, ga_output_dir: str):
+        path = _write_json(ga_output_dir, 'views', '2014-04-01.json', {'rows': [['/foo', '1']]})
+        call_command('migrate_ga_cache', delete=True)
+        assert not os.path.exists(path)
+        assert store.read(path) == {'rows': [['/foo', '1']]}
+
+    def test_should_refuse_to_migrate_to_json(self, ga_output_dir: str, settings):
+        settings.GA_CACHE_BACKEND = store.JSON
+        with pytest.raises(CommandError):
+            call_command('migrate_ga_cache')
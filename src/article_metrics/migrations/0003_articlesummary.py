@@ -0,0 +1,70 @@
+# Generated by Django 3.2.25 on 2026-10-18 04:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# populate the new table from existing metrics and citations.
+# a copy of `schema/sql/metrics-summary.sql` as it was when this migration was written, for all articles.
+POPULATE_SQL = """
+INSERT INTO metrics_article_summary
+    (article_id, views, downloads, scopus, pubmed, crossref, datetime_record_updated)
+SELECT
+    mm.article_id,
+    mm.views,
+    mm.downloads,
+    coalesce(mc.scopus, 0) AS scopus,
+    coalesce(mc.pubmed, 0) AS pubmed,
+    coalesce(mc.crossref, 0) AS crossref,
+    now()
+FROM
+    (SELECT
+        mm.article_id,
+        sum(mm.full + mm.abstract + mm.digest) AS views,
+        sum(mm.pdf) AS downloads
+    FROM
+        metrics_metric mm
+    WHERE
+        mm.source = 'ga'
+        AND mm.period = 'day'
+    GROUP BY
+        mm.article_id) AS mm
+LEFT JOIN LATERAL
+    (SELECT
+        sum(num) FILTER (WHERE source = 'scopus') AS scopus,
+        sum(num) FILTER (WHERE source = 'pubmed') AS pubmed,
+        sum(num) FILTER (WHERE source = 'crossref') AS crossref
+    FROM
+        metrics_citation AS mc
+    WHERE
+        mc.article_id = mm.article_id) AS mc ON true
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('article_metrics', '0002_alter_article_pmcid'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArticleSummary',
+            fields=[
+                ('article', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='article_metrics.article')),
+                ('views', models.PositiveBigIntegerField(default=0)),
+                ('downloads', models.PositiveBigIntegerField(default=0)),
+                ('crossref', models.PositiveIntegerField(default=0)),
+                ('pubmed', models.PositiveIntegerField(default=0)),
+                ('scopus', models.PositiveIntegerField(default=0)),
+                ('datetime_record_updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'metrics_article_summary',
+                'ordering': ('article',),
+            },
+        ),
+        migrations.RunSQL(
+            sql=POPULATE_SQL,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
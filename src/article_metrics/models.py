@@ -1,5 +1,5 @@
 from django.db import models
-from django.db.models import DateTimeField, PositiveIntegerField, ForeignKey, CharField
+from django.db.models import DateTimeField, PositiveIntegerField, PositiveBigIntegerField, ForeignKey, OneToOneField, CharField
 from django.conf import settings
 from django.core.exceptions import ValidationError
 
@@ -128,3 +128,31 @@ class Citation(models.Model):
 
     def __repr__(self):
         return '<Citation %s>' % self
+
+#
+#
+#
+
+class ArticleSummary(models.Model):
+    """the final totals for an article: the sum of it's daily GA views and downloads and it's citations from each source.
+    maintained as metrics and citations are imported."""
+    # when an Article is deleted, delete it's summary
+    article = OneToOneField(Article, primary_key=True, on_delete=models.CASCADE)
+    views = PositiveBigIntegerField(default=0)
+    downloads = PositiveBigIntegerField(default=0)
+    crossref = PositiveIntegerField(default=0)
+    pubmed = PositiveIntegerField(default=0)
+    scopus = PositiveIntegerField(default=0)
+
+    datetime_record_updated = DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'metrics_article_summary'
+        ordering = ('article',)
+
+    def __str__(self):
+        # ll: 123,227913,16498
+        return '%s,%s,%s' % (self.article_id, self.views, self.downloads)
+
+    def __repr__(self):
+        return '<ArticleSummary %s>' % self
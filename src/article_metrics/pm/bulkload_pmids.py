@@ -2,18 +2,24 @@
 If the `import_metrics` management command cannot find a PMID for an article it will go fetch it.
 The number of fetches can be amortised by bulk loading this CSV file.
 See `download-pmcids.sh` to download *and* populate the database.
+Alternatively, `./manage.sh resolve_pmcids` looks up the missing ids in batches, see `citations.resolve_missing_pmcids`.
 """
 
-from article_metrics import models, utils
+from article_metrics import models, utils, logic
 from article_metrics.utils import create_or_update, lmap, ensure
 from django.conf import settings
 from django.db import transaction
+from functools import partial
 import csv
 import logging
 
 LOG = logging.getLogger(__name__)
 
-def update_article(row):
+def update_article(row, id_map=None):
+    """creates or updates an article using a row from the PMC CSV file.
+    `id_map` is an optional map of `{doi: article-id}`, see `logic.article_id_map`.
+    when given, known articles are updated with a single query.
+    returns a triple of `(article-id, created, updated)`."""
     data = {
         'doi': row['DOI'],
         'pmcid': row['PMCID'],
@@ -25,13 +31,29 @@ def update_article(row):
 
     # the doi values in the csv data look perfect and I've never had a problem with them
     # however
-    # we only do it once per new production machine and it doesn't hurt to check
-    utils.doi2msid(data['doi'], allow_subresource=False)
+    # we only do it once per new production machine and it doesn't hurt to check.
+    # the doi is normalised so it matches the dois in `id_map`.
+    data['doi'] = utils.msid2doi(utils.doi2msid(data['doi'], allow_subresource=False))
 
-    return create_or_update(models.Article, data, ['doi'], create=True, update=True, update_check=True)
+    if id_map is not None and data['doi'] in id_map:
+        article_id = id_map[data['doi']]
+        # `.update` doesn't validate, `create_or_update` does.
+        art = models.Article(id=article_id, **data)
+        art.clean_fields()
+        updated = models.Article.objects \
+            .filter(id=article_id) \
+            .exclude(pmid=art.pmid, pmcid=art.pmcid) \
+            .update(pmid=art.pmid, pmcid=art.pmcid)
+        return (article_id, False, bool(updated))
+
+    art, created, updated = create_or_update(models.Article, data, ['doi'], create=True, update=True, update_check=True)
+    if id_map is not None:
+        id_map[data['doi']] = art.id
+    return (art.id, created, updated)
 
 @transaction.atomic
 def load_csv(path):
+    id_map = logic.article_id_map()
     with open(path, 'r') as fh:
         reader = csv.DictReader(fh)
-        return lmap(update_article, reader)
+        return lmap(partial(update_article, id_map=id_map), reader)
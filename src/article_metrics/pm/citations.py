@@ -1,7 +1,10 @@
+import queue
+import threading
 from article_metrics import models, utils, handler
 from article_metrics.utils import ensure, lmap, subdict, first, lfilter
 import requests
 from django.conf import settings
+from django.db.models import Q
 import logging
 
 LOG = logging.getLogger(__name__)
@@ -11,6 +14,15 @@ PMID_URL = "https://www.ncbi.nlm.nih.gov/pmc/utils/idconv/v1.0/"
 
 MAX_PER_PAGE = 200 # we can actually go as high as ~800
 
+# the ID converter accepts up to 200 ids per-request.
+MAX_IDS_PER_LOOKUP = 200
+
+# number of concurrent elink requests when fetching citations for many articles.
+NUM_FETCH_WORKERS = 4
+
+# maximum number of pages waiting between stages of the pipeline, see `citation_pages`.
+PIPELINE_QUEUE_SIZE = 8
+
 def norm_pmcid(pmcid):
     "returns the integer form of a pmc id, stripping any leading 'pmc' prefix."
     if pmcid is None or not str(pmcid).strip():
@@ -30,8 +42,7 @@ def _fetch_pmids(doi):
         'email': settings.CONTACT_EMAIL,
         'format': 'json',
     }
-    resp = requests.get(PMID_URL, params=params)
-    resp.raise_for_status()
+    resp = handler.requests_get(PMID_URL, params=params)
 
     data = resp.json()
     # {
@@ -55,6 +66,28 @@ def _fetch_pmids(doi):
     ensure(data['status'] == 'ok', "response is not ok! %s" % data)
     return subdict(data['records'][0], ['pmid', 'pmcid'])
 
+def _fetch_pmids_many(doi_list):
+    """like `_fetch_pmids` but looks up to `MAX_IDS_PER_LOOKUP` DOIs with a single request.
+    returns a map of `{doi: {'pmid': ..., 'pmcid': ...}}` for each DOI with a pmcid."""
+    ensure(len(doi_list) <= MAX_IDS_PER_LOOKUP,
+           "no more than %s ids can be looked up per-request. requested: %s" % (MAX_IDS_PER_LOOKUP, len(doi_list)))
+    LOG.info("fetching pmcids for %s dois" % len(doi_list))
+    params = {
+        'ids': ','.join(doi_list),
+        'tool': 'elife-metrics',
+        'email': settings.CONTACT_EMAIL,
+        'format': 'json',
+    }
+    resp = handler.requests_get(PMID_URL, params=params)
+    data = resp.json()
+    ensure(data['status'] == 'ok', "response is not ok! %s" % data)
+    # DOIs that can't be found are returned with a "status": "error" and no pmcid.
+    # DOIs are case insensitive, match them to those requested by their lowercase form.
+    requested = {doi.lower(): doi for doi in doi_list}
+    return {requested[record['doi'].lower()]: subdict(record, ['pmid', 'pmcid'])
+            for record in data['records']
+            if record.get('pmcid') and record.get('doi', '').lower() in requested}
+
 def resolve_pmcid(artobj):
     pmcid = artobj.pmcid
     if pmcid:
@@ -182,9 +215,129 @@ def count_for_qs(qs):
     and yielding a list of maps behind it.
 
     `fetch_parse_v2` will consume this list in batches of `MAX_PER_PAGE`,
-    processing each search result in the page before yielding them individually to logic.import_pmc_citations,
-    that will upsert (or not) each result into the db individually."""
+    processing each search result in the page before yielding them individually.
+
+    see `citation_pages` for a pipelined version that doesn't wait on each lookup and fetch in turn."""
     return process_results_v2(fetch_parse_v2(map(resolve_pmcid, qs)))
 
 def citations_for_all_articles():
     return count_for_qs(models.Article.objects.all().iterator())
+
+#
+# pipelined results for many articles
+#
+
+_DONE = object()
+
+def _put(q, item, stop):
+    "puts `item` on queue `q`, waiting for space unless the pipeline is stopped. returns `False` if stopped."
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _lookup_stage(chunk_iter, lookup_q, result_q, stop, num_workers):
+    """stage 1. resolves the missing pmcids in each chunk of `(doi, pmcid)` pairs with a single ID converter request.
+    puts a pair of `(pmcid-list, {doi: {'pmid': ..., 'pmcid': ...}})` on `lookup_q` for each chunk."""
+    try:
+        for chunk in chunk_iter:
+            missing = [doi for doi, pmcid in chunk if not pmcid]
+            resolved = _fetch_pmids_many(missing) if missing else {}
+            pmcid_list = [pmcid or resolved.get(doi, {}).get('pmcid') for doi, pmcid in chunk]
+            if not _put(lookup_q, (lfilter(None, pmcid_list), resolved), stop):
+                return
+    except BaseException as exc:
+        _put(result_q, exc, stop)
+    finally:
+        for _ in range(num_workers):
+            _put(lookup_q, _DONE, stop)
+
+def _fetch_stage(lookup_q, result_q, stop):
+    """stage 2. fetches and parses the citations for each list of pmcids on `lookup_q`.
+    puts a pair of `(resolved-ids, results)` on `result_q` for each list."""
+    try:
+        while not stop.is_set():
+            try:
+                item = lookup_q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                break
+            pmcid_list, resolved = item
+            results = list(process_results_v2(fetch_parse_v2(pmcid_list))) if pmcid_list else []
+            if not _put(result_q, (resolved, results), stop):
+                return
+    except BaseException as exc:
+        _put(result_q, exc, stop)
+    finally:
+        _put(result_q, _DONE, stop)
+
+def update_pmids(resolved):
+    """stage 3. updates the pmid and pmcid of articles in `resolved`, a map of `{doi: {'pmid': ..., 'pmcid': ...}}`.
+    returns the number of articles updated."""
+    if not resolved:
+        return 0
+    art_list = list(models.Article.objects.filter(doi__in=list(resolved.keys())))
+    for art in art_list:
+        art.pmid = resolved[art.doi].get('pmid')
+        art.pmcid = resolved[art.doi]['pmcid']
+        # `bulk_update` doesn't validate, `create_or_update` did.
+        art.clean_fields()
+    models.Article.objects.bulk_update(art_list, ['pmid', 'pmcid'])
+    return len(art_list)
+
+def citation_pages(doi_pmcid_pairs, num_workers=NUM_FETCH_WORKERS):
+    """yields a list of citation results for each page of `MAX_PER_PAGE` `(doi, pmcid)` pairs.
+    fetching is pipelined, network and database latency overlap:
+    1. missing pmcids are looked up a page at a time in a separate thread,
+    2. citations are fetched for up to `num_workers` pages at a time in separate threads,
+    3. looked up pmcids are saved in bulk in the calling thread, as each page of results is yielded.
+    stages are connected by queues of at most `PIPELINE_QUEUE_SIZE` pages.
+    pages are yielded in the order they complete."""
+    lookup_q = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    result_q = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    stop = threading.Event()
+
+    chunk_iter = utils.paginate_v2(iter(doi_pmcid_pairs), min(MAX_PER_PAGE, MAX_IDS_PER_LOOKUP))
+    thread_list = [threading.Thread(target=_lookup_stage, args=(chunk_iter, lookup_q, result_q, stop, num_workers), daemon=True)]
+    thread_list += [threading.Thread(target=_fetch_stage, args=(lookup_q, result_q, stop), daemon=True) for _ in range(num_workers)]
+    for thread in thread_list:
+        thread.start()
+
+    try:
+        num_done = 0
+        while num_done < num_workers:
+            item = result_q.get()
+            if item is _DONE:
+                num_done += 1
+                continue
+            if isinstance(item, BaseException):
+                raise item
+            resolved, results = item
+            update_pmids(resolved)
+            yield results
+    finally:
+        # stops the other stages if the consumer stops early or an error is raised
+        stop.set()
+
+def resolve_missing_pmcids(chunk_size=MAX_IDS_PER_LOOKUP):
+    """looks up the pmid and pmcid of every article missing a pmcid, `chunk_size` articles per-request,
+    updating each chunk of articles in bulk. returns the number of articles updated.
+    an alternative to bulk loading the PMC CSV file with `download-pmcids.sh`."""
+    doi_list = list(models.Article.objects.filter(Q(pmcid__isnull=True) | Q(pmcid='')).order_by('id').values_list('doi', flat=True))
+    LOG.info("resolving pmcids for %s articles", len(doi_list))
+    num_updated = 0
+    for page, chunk in enumerate(utils.paginate(doi_list, chunk_size)):
+        LOG.debug("page %s, %s per-page", page + 1, chunk_size)
+        num_updated += update_pmids(_fetch_pmids_many(chunk))
+    LOG.info("resolved pmcids for %s of %s articles", num_updated, len(doi_list))
+    return num_updated
+
+def citation_pages_for_all_articles(num_workers=NUM_FETCH_WORKERS):
+    "convenience. like `citations_for_all_articles` but yields pages of results using the `citation_pages` pipeline."
+    # articles are read up front in this thread, only network requests happen in the other stages.
+    doi_pmcid_pairs = list(models.Article.objects.values_list('doi', 'pmcid').order_by('id'))
+    return citation_pages(doi_pmcid_pairs, num_workers)
@@ -1,8 +1,10 @@
 import requests
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
 from article_metrics import models, handler, utils
-from article_metrics.utils import first, flatten, simple_rate_limiter, lfilter, isint, ParseError, ensure
+from article_metrics.utils import first, flatten, lfilter, isint, ParseError, ensure
 
 LOG = logging.getLogger(__name__)
 
@@ -10,9 +12,17 @@ URL = "https://api.elsevier.com/content/search/scopus"
 
 MAX_PER_SECOND = 3
 
-@simple_rate_limiter(MAX_PER_SECOND) # no more than this per second
+# number of pages of search results requested at once.
+# requests are still made no more than `MAX_PER_SECOND`, the window lets them overlap when scopus is slow to respond.
+PAGE_WINDOW = 4
+
+# shared by all threads. the lock isn't held while waiting or during the request.
+# scopus has no entry in `handler.RATE_LIMITS`, so this is the only limit on requests to it.
+rate_limit = utils.rate_limiter(MAX_PER_SECOND) # no more than this per second
+
 def fetch_page(api_key, doi_prefix, page=0, per_page=25):
     "fetches a page of scopus search results"
+    rate_limit()
     params = {
         'query': 'DOI("%s/*")' % doi_prefix,
         # 'query': 'DOI("10.7554/eLife.00471")',
@@ -35,9 +45,19 @@ def fetch_page(api_key, doi_prefix, page=0, per_page=25):
         LOG.warning("failed to fetch a page of SCOPUS search results: page=%s, per_page=%s" % (page, per_page))
         return None
 
-def search(api_key=settings.SCOPUS_KEY, doi_prefix=settings.DOI_PREFIX):
+def first_citation_count(search_results):
+    """returns the 'citedby-count' of the first entry in the `search_results` that has one.
+    this is typically the first but we have results where it's missing."""
+    fltrfn = lambda d: 'citedby-count' in d and isint(d['citedby-count'])
+    entry = first(lfilter(fltrfn, search_results.get('entry', [])))
+    if entry:
+        return int(entry['citedby-count'])
+
+def search(api_key=settings.SCOPUS_KEY, doi_prefix=settings.DOI_PREFIX, window=PAGE_WINDOW):
     """searches scopus, returning a generator that will iterate through each page
     of results until all pages have been consumed.
+    up to `window` pages are requested at once and pages are yielded in order.
+    results are sorted by citation count, iteration stops at the first page whose citation count is zero.
     results are cached and expire daily"""
 
     page = 0
@@ -60,33 +80,56 @@ def search(api_key=settings.SCOPUS_KEY, doi_prefix=settings.DOI_PREFIX):
     # figure out where to stop
     end_page = max_pages if total_pages > max_pages else total_pages
 
-    try:
-        for page in range(page + 1, end_page):
-            try:
-                data = fetch_page(api_key, doi_prefix, page=page, per_page=per_page)
-                if data is None:
-                    continue
-                data = data.json()
-                yield data['search-results']
+    page_iter = iter(range(page + 1, end_page))
+    executor = ThreadPoolExecutor(max_workers=max(1, window))
+    in_flight = deque()
 
-                # find the first entry in the search results with a 'citedby-count'.
-                # this is typically the first but we have results where it's missing
-                fltrfn = lambda d: 'citedby-count' in d and isint(d['citedby-count'])
-                entry = first(lfilter(fltrfn, data['search-results']['entry']))
+    def submit_next():
+        "requests the next page, if there is one, returning `False` when there isn't"
+        next_page = next(page_iter, None)
+        if next_page is None:
+            return False
+        in_flight.append((next_page, executor.submit(fetch_page, api_key, doi_prefix, page=next_page, per_page=per_page)))
+        return True
 
-                # exit early if we start hitting 0 results
-                if entry and int(entry['citedby-count']) == 0:
-                    raise GeneratorExit("no more articles with citations")
-
-                # every ten pages print out our progress
-                if page % 10 == 0:
-                    LOG.info("page %s of %s, last citation count: %s" % (page, end_page, entry['citedby-count']))
+    try:
+        while len(in_flight) < window and submit_next():
+            pass
 
+        while in_flight:
+            page, future = in_flight.popleft()
+            try:
+                data = future.result()
             except requests.HTTPError as err:
-                raise GeneratorExit(str(err))
-
-    except GeneratorExit:
-        return
+                LOG.warning("stopping SCOPUS search at page %s: %s" % (page, err))
+                return
+
+            if data is None:
+                submit_next()
+                continue
+
+            data = data.json()
+            yield data['search-results']
+
+            # exit early if we start hitting 0 results.
+            # pages already in-flight are discarded.
+            citation_count = first_citation_count(data['search-results'])
+            if citation_count == 0:
+                LOG.info("no more articles with citations after page %s" % page)
+                return
+
+            # every ten pages print out our progress
+            if page % 10 == 0:
+                LOG.info("page %s of %s, last citation count: %s" % (page, end_page, citation_count))
+
+            submit_next()
+
+    finally:
+        # also reached when the caller stops iterating early.
+        # pages not yet requested are cancelled, pages being requested are left to finish in the background.
+        for _, future in in_flight:
+            future.cancel()
+        executor.shutdown(wait=False)
 
 @handler.capture_parse_error
 def parse_entry(entry):
@@ -2,10 +2,12 @@ import pathlib
 from unittest import mock
 import pytest
 import json
-from article_metrics import models, utils
+import requests
+from article_metrics import models, utils, logic, api_v2_cache, api_v2_logic
 from django.test import Client
 from . import base
 from django.urls import reverse
+from django.test import override_settings
 
 def test_ping():
     resp = Client().get(reverse('v2:ping'))
@@ -502,13 +504,17 @@ def test_citations_by_version():
 
     crossref_response = pathlib.Path(base.fixture_path("crossref-request-response-for-56789.1.xml")).read_text()
 
-    with mock.patch('article_metrics.crossref.citations.fetch', side_effect=[crossref_response]):
+    with mock.patch('article_metrics.crossref.citations.fetch', side_effect=[crossref_response]) as fetch_mock:
         url = reverse('v2:alm-for-version', kwargs={'msid': 56789, 'metric': 'citations', 'version': 1})
         resp = Client().get(url)
         assert resp.status_code == 200
         actual_response = resp.data
         assert expected_response == actual_response
 
+    # citations are fetched with a plain session and never from the requests cache
+    requests_session = fetch_mock.call_args[1]['requests_session']
+    assert type(requests_session) == requests.Session
+
 @pytest.mark.django_db
 def test_citations_by_version_article_not_found_in_crossref():
     utils.create_or_update(models.Article, {'doi': '10.7554/eLife.11111'}, ['doi'])
@@ -517,3 +523,169 @@ def test_citations_by_version_article_not_found_in_crossref():
         url = reverse('v2:alm-for-version', kwargs={'msid': 11111, 'metric': 'citations', 'version': 1})
         resp = Client().get(url)
         assert resp.status_code == 404
+
+API_CACHE = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'api': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test-api-v2'},
+}
+
+@pytest.mark.django_db
+@override_settings(CACHES=API_CACHE)
+def test_cached_response():
+    "responses are served from the cache until the cache is invalidated"
+    api_v2_cache.api_cache().clear()
+    base.insert_metrics({1234: (0, 0, 1)})
+    url = reverse('v2:alm', kwargs={'msid': 1234, 'metric': 'page-views'})
+    resp = Client().get(url, {'by': models.DAY})
+    assert resp.status_code == 200
+    assert resp.data['totalValue'] == 1
+
+    base.insert_metrics({1234: (0, 0, 2)})
+    resp = Client().get(url, {'by': models.DAY})
+    assert resp.data['totalValue'] == 1
+    assert resp['Content-Type'] == 'application/vnd.elife.metric-time-period+json;version=1'
+
+    api_v2_cache.invalidate(api_v2_cache.ARTICLE_METRICS)
+    resp = Client().get(url, {'by': models.DAY})
+    assert resp.data['totalValue'] == 2
+
+@pytest.mark.django_db
+@override_settings(CACHES=API_CACHE)
+def test_cached_response_keys():
+    "requests with different arguments are cached separately and bad requests are not cached"
+    api_v2_cache.api_cache().clear()
+    base.insert_metrics({1234: (0, 1, 1)})
+    url = reverse('v2:alm', kwargs={'msid': 1234, 'metric': 'page-views'})
+    assert Client().get(url, {'by': models.DAY}).data['totalValue'] == 1
+    assert Client().get(url, {'by': models.MONTH}).data['totalPeriods'] == 0
+
+    url = reverse('v2:alm', kwargs={'msid': 1234, 'metric': 'downloads'})
+    assert Client().get(url, {'by': models.DAY}).data['totalValue'] == 1
+    assert Client().get(url, {'page': 'foo'}).status_code == 400
+
+@pytest.mark.django_db
+@override_settings(CACHES=API_CACHE)
+def test_cached_response_invalidated_by_import():
+    "importing GA metrics invalidates cached article metrics"
+    api_v2_cache.api_cache().clear()
+    base.insert_metrics({1234: (0, 0, 1)})
+    url = reverse('v2:alm', kwargs={'msid': 1234, 'metric': 'page-views'})
+    assert Client().get(url, {'by': models.DAY}).data['totalValue'] == 1
+    base.insert_metrics({1234: (0, 0, 2)})
+    with mock.patch('article_metrics.ga_metrics.core.daily_metrics_between', return_value={}):
+        logic.import_ga_metrics('daily')
+    assert Client().get(url, {'by': models.DAY}).data['totalValue'] == 2
+
+@pytest.mark.django_db
+def test_article_metrics_etag():
+    "a request with a matching ETag gets a '304 Not Modified' without the metrics being queried"
+    base.insert_metrics({1234: (0, 0, 1)})
+    url = reverse('v2:alm', kwargs={'msid': 1234, 'metric': 'page-views'})
+    resp = Client().get(url, {'by': models.DAY})
+    assert resp.status_code == 200
+    etag = resp['ETag']
+
+    with mock.patch('article_metrics.api_v2_logic.article_stats') as mock_stats:
+        resp = Client().get(url, {'by': models.DAY}, HTTP_IF_NONE_MATCH=etag)
+        assert resp.status_code == 304
+        assert not mock_stats.called
+
+    # different arguments, different ETag
+    resp = Client().get(url, {'by': models.MONTH}, HTTP_IF_NONE_MATCH=etag)
+    assert resp.status_code == 200
+    assert resp['ETag'] != etag
+
+@pytest.mark.django_db
+def test_article_metrics_last_modified_single_query(django_assert_num_queries):
+    "the ETag for an article's metrics is found with a single query"
+    base.insert_metrics({1234: (0, 0, 1)})
+    with django_assert_num_queries(1) as captured:
+        latest, count = api_v2_logic.article_metrics_last_modified(1234, 'page-views')
+    assert latest is not None
+    assert count == 1
+    # an exact doi lookup, 'iexact' compares the UPPER() of the doi and can't use it's index
+    assert 'UPPER' not in captured.captured_queries[0]['sql']
+
+@pytest.mark.django_db
+def test_article_metrics_etag_changes():
+    "the ETag changes when the article's metrics change"
+    base.insert_metrics({1234: (0, 0, 1)})
+    url = reverse('v2:alm', kwargs={'msid': 1234, 'metric': 'page-views'})
+    etag = Client().get(url, {'by': models.DAY})['ETag']
+
+    base.insert_metrics({1234: (0, 0, 2)})
+    resp = Client().get(url, {'by': models.DAY}, HTTP_IF_NONE_MATCH=etag)
+    assert resp.status_code == 200
+    assert resp['ETag'] != etag
+    assert resp.data['totalValue'] == 2
+
+@pytest.mark.django_db
+def test_article_metrics_no_etag():
+    "articles without metrics have no ETag"
+    utils.create_or_update(models.Article, {'doi': utils.msid2doi(1234)}, ['doi'])
+    url = reverse('v2:alm', kwargs={'msid': 1234, 'metric': 'citations'})
+    resp = Client().get(url)
+    assert resp.status_code == 200
+    assert 'ETag' not in resp
+
+@pytest.mark.django_db
+def test_cursor_pagination():
+    "pages of results can be fetched using the cursor returned with the previous page"
+    for day, views in [('2001-01-01', 1), ('2001-01-02', 2), ('2001-01-03', 3)]:
+        logic.insert_row({'doi': utils.msid2doi(1234), 'date': day, 'period': models.DAY, 'source': models.GA,
+                          'full': views, 'abstract': 0, 'digest': 0, 'pdf': 0})
+    url = reverse('v2:alm', kwargs={'msid': 1234, 'metric': 'page-views'})
+    cases = [
+        ('ASC', [
+            ('', ['2001-01-01', '2001-01-02'], '2001-01-02'),
+            ('2001-01-02', ['2001-01-03'], None),
+        ]),
+        ('DESC', [
+            ('', ['2001-01-03', '2001-01-02'], '2001-01-02'),
+            ('2001-01-02', ['2001-01-01'], None),
+        ]),
+    ]
+    for order, pages in cases:
+        for cursor, expected_periods, expected_cursor in pages:
+            resp = Client().get(url, {'cursor': cursor, 'per-page': 2, 'order': order})
+            assert resp.status_code == 200
+            assert resp.data['totalPeriods'] == 3
+            assert [period['period'] for period in resp.data['periods']] == expected_periods
+            assert resp.data['nextCursor'] == expected_cursor
+
+    # no cursor, no 'nextCursor'
+    resp = Client().get(url, {'per-page': 2})
+    assert 'nextCursor' not in resp.data
+
+@pytest.mark.django_db
+def test_bad_cursor():
+    base.insert_metrics({1234: (1, 1, 1)})
+    url = reverse('v2:alm', kwargs={'msid': 1234, 'metric': 'page-views'})
+    assert Client().get(url, {'cursor': 'foo'}).status_code == 400
+
+    # citations can't be paged through with a cursor
+    url = reverse('v2:alm', kwargs={'msid': 1234, 'metric': 'citations'})
+    assert Client().get(url, {'cursor': ''}).status_code == 400
+
+@pytest.mark.django_db
+def test_summary_ignores_cursor():
+    "the summary can't be paged through with a cursor and the argument is ignored"
+    base.insert_metrics({1234: (1, 1, 1)})
+    url = reverse('v2:summary')
+    for cursor in ['', '2001-01-01', 'foo']:
+        resp = Client().get(url, {'cursor': cursor})
+        assert resp.status_code == 200
+        assert resp.json()['total'] == 1
+
+@pytest.mark.django_db
+@override_settings(CACHES=API_CACHE)
+def test_cached_count():
+    "the total number of results is cached until the cache is invalidated"
+    api_v2_cache.api_cache().clear()
+    base.insert_metrics({1234: (0, 0, 1)})
+    qobj = models.Metric.objects.all()
+    assert api_v2_logic.count(qobj) == 1
+    base.insert_metrics({1234: (0, 0, 1, models.MONTH)})
+    assert api_v2_logic.count(qobj) == 1
+    api_v2_cache.invalidate(api_v2_cache.ARTICLE_METRICS)
+    assert api_v2_logic.count(qobj) == 2
@@ -1,8 +1,17 @@
+import glob
+import os
+import pathlib
 import pytest
 import shutil
 import tempfile
-from unittest.mock import patch
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch, Mock
+from xml.dom.minidom import parseString
 from article_metrics.crossref import citations as crossref
+from article_metrics import utils
+from . import base
 import responses
 
 @pytest.fixture(name='temp_dump_path')
@@ -26,3 +35,62 @@ def test_fetch_401_response(temp_dump_path):
         expected_response = None
         assert expected_response == crossref.fetch(bad_doi)
         assert log_mock.warning.called
+
+def test_count_forward_links():
+    "forward links are counted as they were by the previous DOM-based parser"
+    cases = [
+        ("crossref-request-response.xml", 53),
+        ("crossref-request-response-2.xml", 3),
+        ("crossref-request-response-3.xml", 10),
+    ]
+    for fixture, expected in cases:
+        xmlbytes = pathlib.Path(base.fixture_path(fixture)).read_bytes()
+        assert crossref.count_forward_links(xmlbytes) == expected
+        assert crossref.count_forward_links(xmlbytes.decode('utf-8')) == expected
+
+def test_count_forward_links_matches_minidom():
+    "forward links are counted the same as a DOM of the whole response would count them, including large responses"
+    for path in sorted(glob.glob(os.path.join(base.FIXTURE_DIR, 'crossref-request-response*.xml'))):
+        xmlbytes = pathlib.Path(path).read_bytes()
+        # the body is repeated to simulate the response for a highly cited article
+        head, rest = xmlbytes.split(b'<body>', 1)
+        body, tail = rest.split(b'</body>', 1)
+        xmlbytes = head + b'<body>' + (body * 50) + b'</body>' + tail
+
+        dom = parseString(xmlbytes)
+        expected = len(dom.getElementsByTagName('body')[0].getElementsByTagName('forward_link'))
+        assert expected > 0
+        assert crossref.count_forward_links(xmlbytes) == expected, path
+
+def test_count_forward_links_no_body():
+    xml = '<crossref_result xmlns="http://www.crossref.org/qrschema/2.0"><query_result/></crossref_result>'
+    with pytest.raises(utils.ParseError):
+        crossref.count_forward_links(xml)
+
+def test_count_for_qs_bounded():
+    "no more than two articles per-worker are fetched or waiting to be yielded at once"
+    num_workers = 2
+    lock = threading.Lock()
+    pending, max_pending = [0], [0]
+
+    class Executor(ThreadPoolExecutor):
+        def submit(self, *args, **kwargs):
+            with lock:
+                pending[0] += 1
+                max_pending[0] = max(max_pending[0], pending[0])
+            return super().submit(*args, **kwargs)
+
+    def count_for_doi(doi, include_all_versions=False):
+        time.sleep(0.01)
+        return doi
+
+    qs = [Mock(doi='10.7554/eLife.%05d' % i) for i in range(10)]
+    results = []
+    with patch('article_metrics.crossref.citations.ThreadPoolExecutor', Executor):
+        with patch('article_metrics.crossref.citations.count_for_doi', side_effect=count_for_doi):
+            for result in crossref.count_for_qs(qs, num_workers=num_workers):
+                with lock:
+                    pending[0] -= 1
+                results.append(result)
+    assert sorted(results) == [art.doi for art in qs]
+    assert max_pending[0] <= num_workers * 2
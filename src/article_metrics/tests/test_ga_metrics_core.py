@@ -1,15 +1,18 @@
 import shutil
 import json
 import tempfile
+import time
 import pytest
 from os.path import join
 from unittest import mock
 from . import base
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from article_metrics.utils import datetime_now
 from article_metrics.ga_metrics import utils
-from article_metrics.ga_metrics import core, elife_v1, elife_v2, elife_v3, elife_v4, elife_v5, elife_v6, elife_vX, elife_v7, elife_v8
+from article_metrics.ga_metrics import store, core, elife_v1, elife_v2, elife_v3, elife_v4, elife_v5, elife_v6, elife_vX, elife_v7, elife_v8
 from django.conf import settings
+from django.test import override_settings
 import apiclient
 
 @pytest.fixture(name='test_output_dir')
@@ -266,3 +269,150 @@ def test_load_cache(temp_json_file):
         expected = {}
         actual = core.load_cache(results_type, cacheable_dt, cacheable_dt, True, True)
         assert actual == expected
+
+def test_store_path_key():
+    cases = [
+        ('/output/ga/views/2014-04-01.json', ('views', '2014-04-01', '2014-04-01')),
+        ('/output/ga/press-package/2014-01-01_2014-01-31.json', ('press-package', '2014-01-01', '2014-01-31')),
+    ]
+    for path, expected in cases:
+        assert store.path_key(path) == expected
+
+def test_store_sqlite(test_output_dir):
+    "results are stored compressed in a sqlite database and can be read back"
+    path = join(test_output_dir, 'views', '2014-04-01.json') # directory doesn't exist
+    results = {'rows': [['/articles/1234', '1']], 'totalResults': 1}
+
+    with override_settings(GA_CACHE_BACKEND=store.SQLITE, GA_CACHE_DB=join(test_output_dir, 'ga-cache.sqlite3')):
+        assert not store.exists(path)
+        assert store.read(path) is None
+        store.write(path, results)
+        assert store.exists(path)
+        assert store.read(path) == results
+
+        with mock.patch('article_metrics.ga_metrics.core.output_path_v2', return_value=path):
+            assert core.load_cache('views', datetime(2014, 4, 1), datetime(2014, 4, 1), True, True) == results
+
+def test_store_sqlite_connection_per_thread(test_output_dir):
+    "each thread connects to the sqlite database once"
+    with override_settings(GA_CACHE_BACKEND=store.SQLITE, GA_CACHE_DB=join(test_output_dir, 'ga-cache.sqlite3')):
+        conn = store.connect()
+        assert store.connect() is conn
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            assert executor.submit(store.connect).result() is not conn
+
+def test_store_sqlite_json_fallback(temp_json_file, test_output_dir):
+    "results not found in the sqlite database are read from any json file at the path"
+    with override_settings(GA_CACHE_BACKEND=store.SQLITE, GA_CACHE_DB=join(test_output_dir, 'ga-cache.sqlite3')):
+        assert store.exists(temp_json_file.name)
+        assert store.read(temp_json_file.name) == {'foo': 'bar'}
+
+# ---
+
+def test_metrics_for_range_concurrent():
+    "querying date ranges concurrently returns the same results, in the same order, as querying them one at a time"
+    dt_range_list = utils.dt_range(datetime(year=2023, month=8, day=1), datetime(year=2023, month=8, day=10))
+
+    def article_metrics(table_id, from_date, to_date, cached, only_cached, raw_data=None):
+        return {'views': {'10.7554/eLife.%05d' % from_date.day: from_date.day}, 'downloads': {}}
+
+    with mock.patch('article_metrics.ga_metrics.core.article_metrics', side_effect=article_metrics):
+        expected = core.metrics_for_range('12345', dt_range_list)
+        actual = core.metrics_for_range('12345', dt_range_list, num_workers=4)
+
+    assert len(expected) == len(dt_range_list)
+    assert actual == expected
+    assert list(actual.keys()) == list(expected.keys())
+    assert list(actual.keys())[0] == ('2023-08-01', '2023-08-01')
+
+def test_metrics_for_range_bounded():
+    "no more than two date ranges per-worker are queued at once"
+    consumed = []
+
+    def dt_range_iter():
+        for dt_pair in utils.dt_range(datetime(year=2023, month=8, day=1), datetime(year=2023, month=8, day=10)):
+            consumed.append(dt_pair)
+            yield dt_pair
+
+    queued = []
+
+    def article_metrics(table_id, from_date, to_date, cached, only_cached, raw_data=None):
+        if from_date.day == 1:
+            # the first date range is the slowest, the window is full by the time it's done
+            time.sleep(0.1)
+            queued.append(len(consumed))
+        return {'views': {}, 'downloads': {}}
+
+    with mock.patch('article_metrics.ga_metrics.core.article_metrics', side_effect=article_metrics):
+        results = core.metrics_for_range('12345', dt_range_iter(), num_workers=2)
+    assert len(results) == 10
+    assert queued == [4]
+
+def test_metrics_for_range_batched():
+    "querying GA4 date ranges in batches returns the same results as querying them one at a time, in fewer requests"
+    dt_range_list = utils.dt_range(datetime(year=2023, month=8, day=1), datetime(year=2023, month=8, day=10))
+
+    def query_ga(query, **kwargs):
+        "returns a row per date range, GA4 adds a 'dateRange' dimension when there are many date ranges"
+        batched = len(query['dateRanges']) > 1
+        rows = []
+        for i, date_range in enumerate(query['dateRanges']):
+            msid = int(date_range['startDate'][-2:])
+            dimension_values = [{'value': '/articles/%s' % msid}]
+            if 'eventName' in [dim['name'] for dim in query['dimensions']]:
+                dimension_values = [{'value': 'file_download'}, {'value': 'pdf'}] + dimension_values
+            if batched:
+                dimension_values.append({'value': 'date_range_%s' % i})
+            rows.append({'dimensionValues': dimension_values, 'metricValues': [{'value': str(msid)}]})
+        dimension_headers = query['dimensions'] + ([{'name': 'dateRange'}] if batched else [])
+        return {'dimensionHeaders': dimension_headers, 'rows': rows, 'rowCount': len(rows)}
+
+    def query_ga_many(query_list, **kwargs):
+        return [query_ga(query) for query in query_list]
+
+    with mock.patch('article_metrics.ga_metrics.core.output_path_v2', return_value=None):
+        with mock.patch('article_metrics.ga_metrics.ga4.query_ga', side_effect=query_ga) as mock_query_ga:
+            with mock.patch('article_metrics.ga_metrics.ga4.query_ga_many', side_effect=query_ga_many) as mock_query_ga_many:
+                expected = core.metrics_for_range('12345', dt_range_list)
+                assert mock_query_ga_many.call_count == 10 # views and downloads together for each of the 10 days
+                assert mock_query_ga.call_count == 0
+
+                mock_query_ga_many.reset_mock()
+                actual = core.metrics_for_range('12345', dt_range_list, batch_size=4)
+                assert mock_query_ga.call_count == 6 # 3 batches of 4, 4 and 2 days of views and downloads
+                assert mock_query_ga_many.call_count == 0
+
+    assert actual == expected
+    assert expected[('2023-08-02', '2023-08-02')]['views'] == {'10.7554/eLife.00002': {'full': 2, 'abstract': 0, 'digest': 0}}
+
+def test_article_metrics_coalesced():
+    "uncached GA4 views and downloads for a date range are requested together"
+    dt = datetime(year=2023, month=8, day=1)
+    views = {'dimensionHeaders': [{'name': 'pagePathPlusQueryString'}], 'rowCount': 1,
+             'rows': [{'dimensionValues': [{'value': '/articles/1'}], 'metricValues': [{'value': '2'}]}]}
+    downloads = {'dimensionHeaders': [{'name': 'eventName'}, {'name': 'fileExtension'}, {'name': 'pagePath'}], 'rowCount': 1,
+                 'rows': [{'dimensionValues': [{'value': 'file_download'}, {'value': 'pdf'}, {'value': '/articles/1'}], 'metricValues': [{'value': '3'}]}]}
+    with mock.patch('article_metrics.ga_metrics.core.output_path_v2', return_value=None):
+        with mock.patch('article_metrics.ga_metrics.ga4._batch_query_ga', return_value=[views, downloads]) as mock_batch_query_ga:
+            actual = core.article_metrics('12345', dt, dt)
+    assert mock_batch_query_ga.call_count == 1
+    query_list = mock_batch_query_ga.call_args[0][0]
+    assert [query['dimensions'][0]['name'] for query in query_list] == ['pagePathPlusQueryString', 'eventName']
+    assert actual == {
+        'views': {'10.7554/eLife.00001': {'full': 2, 'abstract': 0, 'digest': 0}},
+        'downloads': {'10.7554/eLife.00001': 3},
+    }
+
+def test_ga_service_per_thread():
+    "each thread creates a single service object, discarded with the thread"
+    def service_pair():
+        return (core.ga_service(), core.ga_service())
+
+    with mock.patch('article_metrics.ga_metrics.core._ga_service', side_effect=lambda: object()) as ga_service_mock:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            service1, service2 = executor.submit(service_pair).result()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            service3, _ = executor.submit(service_pair).result()
+    assert service1 is service2
+    assert service1 is not service3
+    assert ga_service_mock.call_count == 2
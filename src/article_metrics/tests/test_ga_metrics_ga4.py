@@ -1,4 +1,5 @@
 import json
+import pytest
 from unittest import mock
 from article_metrics.ga_metrics import ga4
 from .base import fixture_path
@@ -19,3 +20,60 @@ def test_query_ga():
     with mock.patch('article_metrics.ga_metrics.ga4._query_ga', return_value=fixture):
         actual = ga4.query_ga(query)
     assert expected == actual
+
+def test_batch_query():
+    "queries that differ only by their date range are combined into a single query"
+    query_list = [{'metrics': [{'name': 'sessions'}], 'dateRanges': [{'startDate': '2023-08-0%s' % i, 'endDate': '2023-08-0%s' % i}]} for i in range(1, 4)]
+    expected = {'metrics': [{'name': 'sessions'}], 'dateRanges': [q['dateRanges'][0] for q in query_list]}
+    assert ga4.batch_query(query_list) == expected
+
+def test_batch_query_bad_queries():
+    query = {'metrics': [{'name': 'sessions'}], 'dateRanges': [{'startDate': '2023-08-01', 'endDate': '2023-08-01'}]}
+    cases = [
+        [],
+        [query] * (ga4.MAX_DATE_RANGES + 1),
+        [query, dict(query, metrics=[{'name': 'eventCount'}])],
+    ]
+    for query_list in cases:
+        with pytest.raises(AssertionError):
+            ga4.batch_query(query_list)
+
+def test_split_response():
+    "a response to a query with many date ranges is split into one response per date range, without the 'dateRange' dimension"
+    query = {'dateRanges': [{'startDate': '2023-08-01', 'endDate': '2023-08-01'}, {'startDate': '2023-08-02', 'endDate': '2023-08-02'}]}
+
+    def row(path, date_range, count):
+        return {'dimensionValues': [{'value': path}, {'value': date_range}], 'metricValues': [{'value': count}]}
+
+    response = {
+        'dimensionHeaders': [{'name': 'pagePathPlusQueryString'}, {'name': 'dateRange'}],
+        'metricHeaders': [{'name': 'sessions', 'type': 'TYPE_INTEGER'}],
+        'rows': [row('/articles/1', 'date_range_0', '1'), row('/articles/1', 'date_range_1', '2'), row('/articles/2', 'date_range_1', '3')],
+        'rowCount': 3,
+    }
+    first, second = ga4.split_response(response, query)
+    assert first['dimensionHeaders'] == [{'name': 'pagePathPlusQueryString'}]
+    assert first['rows'] == [{'dimensionValues': [{'value': '/articles/1'}], 'metricValues': [{'value': '1'}]}]
+    assert first['rowCount'] == 1
+    assert [r['dimensionValues'][0]['value'] for r in second['rows']] == ['/articles/1', '/articles/2']
+    assert second['rowCount'] == 2
+
+def test_split_response_single_date_range():
+    query = {'dateRanges': [{'startDate': '2023-08-01', 'endDate': '2023-08-01'}]}
+    response = {'dimensionHeaders': [{'name': 'pagePathPlusQueryString'}], 'rows': []}
+    assert ga4.split_response(response, query) == [response]
+
+def test_query_ga_many_pages():
+    "remaining pages are fetched concurrently once the number of rows is known and their rows are returned in order"
+    row_count = 35000
+
+    def _query_ga(query, **kwargs):
+        offset = query['offset']
+        rows = [{'dimensionValues': [{'value': str(i)}]} for i in range(offset, min(offset + query['limit'], row_count))]
+        return {'rows': rows, 'rowCount': row_count}
+
+    with mock.patch('article_metrics.ga_metrics.ga4._query_ga', side_effect=_query_ga) as mock_query_ga:
+        actual = ga4.query_ga({})
+    assert mock_query_ga.call_count == 4
+    assert actual['-total-pages'] == 4
+    assert [int(row['dimensionValues'][0]['value']) for row in actual['rows']] == list(range(row_count))
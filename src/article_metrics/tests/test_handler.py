@@ -107,3 +107,43 @@ def test_network_connection_error_retry(temp_dump_path):
 
     # after dying three previous times
     assert len(responses.calls) == 3
+
+def test_pooled_session():
+    "pooled sessions keep their adapters between requests and rate limit requests to specific hosts"
+    session = handler.pooled_session(4, {'https://example.org/limited/': 1000})
+    adapter = session.get_adapter('https://example.org/')
+    limited_adapter = session.get_adapter('https://example.org/limited/foo')
+    assert adapter.rate_limit is handler.no_rate_limit
+    assert limited_adapter.rate_limit is not handler.no_rate_limit
+
+    with responses.RequestsMock() as rsps:
+        rsps.add(responses.GET, 'https://example.org/foo', body='bar')
+        with patch.object(limited_adapter, 'rate_limit') as rate_limit_mock:
+            resp = handler.requests_get('https://example.org/foo', requests_session=session)
+            assert resp.text == 'bar'
+            assert not rate_limit_mock.called
+    assert session.get_adapter('https://example.org/') is adapter
+
+def test_host_session():
+    "requests to the same host share a session, requests to different hosts don't"
+    handler.close_host_sessions()
+    session = handler.host_session('https://example.org/foo')
+    assert handler.host_session('https://example.org/bar?baz=1') is session
+    assert handler.host_session('https://example.com/foo') is not session
+
+    with responses.RequestsMock() as rsps:
+        rsps.add(responses.GET, 'https://example.org/foo', body='bar')
+        with patch.object(session, 'get', wraps=session.get) as get_mock:
+            assert handler.requests_get('https://example.org/foo').text == 'bar'
+            assert get_mock.called
+
+    handler.close_host_sessions()
+    assert handler.host_session('https://example.org/foo') is not session
+
+def test_host_session_rate_limits():
+    "hosts with a rate limit have a rate limited adapter"
+    handler.close_host_sessions()
+    session = handler.host_session('https://doi.crossref.org/servlet/getForwardLinks')
+    assert session.get_adapter('https://doi.crossref.org/servlet/getForwardLinks').rate_limit is not handler.no_rate_limit
+    assert handler.host_session('https://example.org/').get_adapter('https://example.org/').rate_limit is handler.no_rate_limit
+    handler.close_host_sessions()
@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+import pytest
+import responses
+from django.conf import settings
+from django.test import override_settings
+from article_metrics import http_cache
+
+@pytest.fixture(name='cache_dir')
+def fixture_cache_dir():
+    name = tempfile.mkdtemp()
+    with override_settings(CACHE_NAME=os.path.join(name, 'requests-cache.sqlite3'), CACHE_DIR=os.path.join(name, 'requests-cache')):
+        yield name
+    shutil.rmtree(name)
+
+def cache_responses(session, url_list):
+    with responses.RequestsMock() as rsps:
+        for url in url_list:
+            rsps.add(responses.GET, url, body=url)
+            session.get(url)
+
+def test_sqlite_remove_expired(cache_dir):
+    "only expired responses are removed, found using the `expires` index"
+    session = http_cache.create_session()
+    cache_responses(session, ['https://example.org/1', 'https://example.org/2'])
+    key_list = sorted(session.cache.responses.keys())
+    assert len(key_list) == 2
+
+    expired_key = key_list[0]
+    session.cache.save_response(session.cache.responses[expired_key], expired_key, expires=datetime(year=2000, month=1, day=1))
+
+    assert http_cache.remove_expired() == 1
+    assert list(session.cache.responses.keys()) == key_list[1:]
+
+def test_sqlite_backfill_expires(cache_dir):
+    "responses cached before the `expires` column existed have their expiry times set in batches"
+    session = http_cache.create_session()
+    cache_responses(session, ['https://example.org/1', 'https://example.org/2', 'https://example.org/3'])
+    responses_dict = session.cache.responses
+    with responses_dict.connection(commit=True) as con:
+        con.execute("UPDATE responses SET expires = NULL")
+        responses_dict.backfill_expires(con, batch_size=2)
+        expires_list = [row[0] for row in con.execute("SELECT expires FROM responses")]
+    assert len(expires_list) == 3
+    assert None not in expires_list
+
+def test_sqlite_wal(cache_dir):
+    session = http_cache.create_session()
+    with session.cache.responses.connection() as con:
+        assert con.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+
+@override_settings(CACHE_BACKEND=http_cache.FILESYSTEM)
+def test_filesystem_per_host(cache_dir):
+    "the filesystem backend keeps a directory per host"
+    session = http_cache.create_session('example.org')
+    cache_responses(session, ['https://example.org/1'])
+    assert os.listdir(settings.CACHE_DIR) == ['example.org']
+    assert http_cache.remove_expired() == 0
+
+def test_url_expiry(cache_dir):
+    "responses from urls matching a pattern in `settings.CACHE_URL_EXPIRY` expire after that many days"
+    session = http_cache.create_session()
+    lax_url = settings.LAX_URL + '/12345'
+    cache_responses(session, [lax_url, 'https://example.org/1'])
+    expiry = {resp.url: resp.expires for resp in session.cache.filter()}
+    now = datetime.utcnow()
+    assert expiry[lax_url] - now > timedelta(days=settings.CACHE_URL_EXPIRY[settings.LAX_URL] - 1)
+    assert expiry['https://example.org/1'] - now < timedelta(days=settings.CACHE_EXPIRY)
@@ -2,8 +2,10 @@ import pathlib
 from typing import Iterator
 from unittest import mock
 from article_metrics import models, logic, utils
-from datetime import datetime
+from datetime import datetime, timedelta
 from . import base
+from django.test import override_settings
+from article_metrics.ga_metrics import store
 from article_metrics.scopus import citations as scopus_citations
 import pytest
 
@@ -20,7 +22,7 @@ class TestImportCrossrefCitations:
         citations_for_articles_mock: mock.MagicMock
     ):
         logic.import_crossref_citations(msid='12345')
-        citations_for_articles_mock.assert_called_with(msid='12345')
+        citations_for_articles_mock.assert_called_with(msid='12345', num_workers=1)
 
 
 @pytest.mark.django_db
@@ -174,3 +176,211 @@ def test_data_is_updated():
     # rows have correct values
     clean_metric = models.Metric.objects.get(article__doi='10.7554/eLife.00001')
     assert clean_metric.pdf == 1
+
+@pytest.mark.django_db
+def test_upsert_many_rows():
+    "rows are created, updated only when they change and the results of each are reported"
+    row = {
+        'pdf': 0,
+        'full': 0,
+        'abstract': 0,
+        'digest': 0,
+        'period': 'day',
+        'date': '2001-01-01',
+        'source': models.GA,
+    }
+    row1 = dict(row, doi='10.7554/eLife.00001')
+    row2 = dict(row, doi='10.7554/eLife.00002')
+
+    results = logic.upsert_many_rows([row1, row2])
+    assert models.Article.objects.count() == 2
+    assert models.Metric.objects.count() == 2
+    assert [(created, updated) for _, created, updated in results] == [(True, False), (True, False)]
+
+    unchanged_metric = models.Metric.objects.get(article__doi=row1['doi'])
+
+    # row1 is unchanged, row2 has a new pdf count
+    results = logic.upsert_many_rows([row1, dict(row2, pdf=1)])
+    assert models.Metric.objects.count() == 2
+    changed_metric = models.Metric.objects.get(article__doi=row2['doi'])
+    assert results == [(changed_metric.id, False, True)]
+    assert changed_metric.pdf == 1
+
+    # unchanged rows are not touched
+    assert models.Metric.objects.get(article__doi=row1['doi']).datetime_record_updated == unchanged_metric.datetime_record_updated
+
+@pytest.mark.django_db
+def test_upsert_many_rows_bad_article():
+    "rows for bad articles are skipped"
+    row = {
+        'pdf': 0,
+        'full': 0,
+        'abstract': 0,
+        'digest': 0,
+        'period': 'day',
+        'date': '2001-01-01',
+        'source': models.GA,
+        'doi': '10.7554/eLife.00001.002', # sub-resource
+    }
+    assert logic.upsert_many_rows([row]) == []
+    assert models.Metric.objects.count() == 0
+
+@pytest.mark.django_db
+def test_import_ga_daily_stats_bulk_matches_row_by_row():
+    "the bulk upsert imports exactly the same metrics as the row by row insert"
+    day_to_import = datetime(year=2015, month=9, day=11)
+    fixture = base.fixture_path('test_import_ga_daily_stats/ga-output/views/2015-09-11.json')
+    fields = ('article__doi', 'date', 'period', 'source', 'full', 'abstract', 'digest', 'pdf')
+    with mock.patch('article_metrics.ga_metrics.core.output_path_v2', return_value=fixture):
+        logic.import_ga_metrics('daily', from_date=day_to_import, to_date=day_to_import, use_only_cached=True, bulk=False)
+        expected = sorted(models.Metric.objects.values_list(*fields))
+        models.Metric.objects.all().delete()
+        logic.import_ga_metrics('daily', from_date=day_to_import, to_date=day_to_import, use_only_cached=True, bulk=True)
+        actual = sorted(models.Metric.objects.values_list(*fields))
+    assert len(expected) > 0
+    assert actual == expected
+
+@pytest.mark.django_db
+def test_import_ga_daily_stats_sqlite_cache(tmp_path):
+    "metrics imported from results cached in the sqlite backend are the same as those cached as json"
+    day_to_import = datetime(year=2015, month=9, day=11)
+    fixture = base.fixture_path('test_import_ga_daily_stats/ga-output/views/2015-09-11.json')
+    fields = ('article__doi', 'date', 'period', 'source', 'full', 'abstract', 'digest', 'pdf')
+    with mock.patch('article_metrics.ga_metrics.core.output_path_v2', return_value=fixture):
+        logic.import_ga_metrics('daily', from_date=day_to_import, to_date=day_to_import, use_only_cached=True)
+        expected = sorted(models.Metric.objects.values_list(*fields))
+    models.Metric.objects.all().delete()
+
+    # no json file exists at this path, results can only come from the sqlite database
+    path = str(tmp_path / 'views' / '2015-09-11.json')
+    with override_settings(GA_CACHE_BACKEND=store.SQLITE, GA_CACHE_DB=str(tmp_path / 'ga-cache.sqlite3')):
+        store.write(path, store.json_read(fixture))
+        with mock.patch('article_metrics.ga_metrics.core.output_path_v2', return_value=path):
+            logic.import_ga_metrics('daily', from_date=day_to_import, to_date=day_to_import, use_only_cached=True)
+        actual = sorted(models.Metric.objects.values_list(*fields))
+    assert len(expected) > 0
+    assert actual == expected
+
+@pytest.mark.django_db
+def test_rebuild_ga_metrics_matches_import():
+    "rebuilding metrics from the cache in a pool of processes imports exactly the same metrics as an import"
+    from_date = datetime(year=2015, month=9, day=10)
+    to_date = datetime(year=2015, month=9, day=11)
+    fixture = base.fixture_path('test_import_ga_daily_stats/ga-output/views/2015-09-11.json')
+    fields = ('article__doi', 'date', 'period', 'source', 'full', 'abstract', 'digest', 'pdf')
+    with mock.patch('article_metrics.ga_metrics.core.output_path_v2', return_value=fixture):
+        logic.import_ga_metrics('daily', from_date=from_date, to_date=to_date, use_only_cached=True)
+        expected = sorted(models.Metric.objects.values_list(*fields))
+        models.Metric.objects.all().delete()
+        logic.rebuild_ga_metrics('daily', from_date=from_date, to_date=to_date, num_processes=2)
+        actual = sorted(models.Metric.objects.values_list(*fields))
+    assert len(expected) > 0
+    assert actual == expected
+
+@pytest.mark.django_db
+def test_rebuild_ga_metrics_never_queries_ga():
+    "date ranges too recent to have been cached are skipped rather than queried"
+    to_date = utils.datetime_now()
+    from_date = to_date - timedelta(days=5)
+    # workers are forked after the patch, a query in a worker is raised here
+    with mock.patch('article_metrics.ga_metrics.core.query_ga_write_results_v2', side_effect=AssertionError("GA queried")):
+        logic.rebuild_ga_metrics('daily', from_date=from_date, to_date=to_date, num_processes=2)
+        logic.rebuild_ga_metrics('monthly', from_date=from_date, to_date=to_date, num_processes=2)
+    assert models.Metric.objects.count() == 0
+
+@pytest.mark.django_db
+def test_get_create_article_ids():
+    "article ids are returned for each given doi, missing articles are created and bad dois are excluded"
+    existing = logic.get_create_article({'doi': '10.7554/eLife.01234'})
+    id_map = logic.article_id_map()
+    assert id_map == {'10.7554/eLife.01234': existing.id}
+
+    doi_list = ['10.7554/eLife.01234', '10.7554/elife.01234', '10.7554/eLife.05678', '10.7554/eLife.05678.001']
+    results = logic.get_create_article_ids(doi_list, id_map)
+    new = models.Article.objects.get(doi='10.7554/eLife.05678')
+    expected = {
+        '10.7554/eLife.01234': existing.id,
+        '10.7554/elife.01234': existing.id,
+        '10.7554/eLife.05678': new.id,
+    }
+    assert results == expected
+    assert models.Article.objects.count() == 2
+    assert id_map == {'10.7554/eLife.01234': existing.id, '10.7554/eLife.05678': new.id}
+
+@pytest.mark.django_db
+def test_insert_citation_id_map():
+    "citations can be inserted using an article id map"
+    id_map = logic.article_id_map()
+    data = {'doi': '10.7554/eLife.01234', 'source': models.CROSSREF, 'num': 1, 'source_id': 'asdf'}
+    citation, created, updated = logic.insert_citation(data, id_map=id_map)
+    assert created
+    assert citation.article.doi == '10.7554/eLife.01234'
+    assert id_map == {'10.7554/eLife.01234': citation.article.id}
+
+    citation, created, updated = logic.insert_citation(dict(data, num=2), id_map=id_map)
+    assert (created, updated) == (False, True)
+    assert models.Citation.objects.get().num == 2
+
+@pytest.mark.django_db
+def test_import_pmc_citations():
+    "each page of PMC citations is inserted against the article with that pmcid"
+    art = models.Article(doi='10.7554/eLife.09560', pmcid='PMC4559886')
+    art.save()
+    page = [{'pmcid': 'PMC4559886', 'source': models.PUBMED, 'num': 17, 'source_id': 'https://www.ncbi.nlm.nih.gov/pmc/articles/PMC4559886/'}]
+    with mock.patch('article_metrics.pm.citations.citation_pages_for_all_articles', return_value=iter([page])):
+        logic.import_pmc_citations()
+    citation = models.Citation.objects.get()
+    assert (citation.article_id, citation.source, citation.num) == (art.id, models.PUBMED, 17)
+
+# --- article summaries
+
+def _summaries():
+    return list(models.ArticleSummary.objects.order_by('article_id').values_list(
+        'article__doi', 'views', 'downloads', 'crossref', 'pubmed', 'scopus'))
+
+@pytest.mark.django_db
+def test_article_summary_maintained_by_upsert():
+    "article summaries are kept up to date as metrics are upserted and match a full recalculation"
+    row = {
+        'pdf': 1,
+        'full': 1,
+        'abstract': 1,
+        'digest': 1,
+        'period': models.DAY,
+        'date': '2001-01-01',
+        'source': models.GA,
+    }
+    doi1, doi2 = '10.7554/eLife.00001', '10.7554/eLife.00002'
+    logic.insert_citation({'doi': doi1, 'source': models.CROSSREF, 'num': 5, 'source_id': 'asdf'})
+    logic.upsert_many_rows([dict(row, doi=doi1), dict(row, doi=doi2)])
+    logic.upsert_many_rows([dict(row, doi=doi1, date='2001-01-02'),
+                            dict(row, doi=doi1, period=models.MONTH, date='2001-01', full=100)]) # monthly, ignored
+    # views go down, downloads go up
+    logic.upsert_many_rows([dict(row, doi=doi2, full=0, pdf=3)])
+    logic.insert_citation({'doi': doi2, 'source': models.SCOPUS, 'num': 2, 'source_id': 'asdf'})
+
+    expected = [
+        (doi1, 6, 2, 5, 0, 0),
+        (doi2, 2, 3, 0, 0, 2),
+    ]
+    assert _summaries() == expected
+
+    logic.refresh_article_summaries()
+    assert _summaries() == expected
+
+@pytest.mark.django_db
+def test_article_summary_maintained_by_insert_row():
+    "article summaries are kept up to date as metrics are inserted one at a time"
+    base.insert_metrics({'1234': ([1, 2, 3], 4, 5)})
+    assert _summaries() == [('10.7554/eLife.01234', 5, 4, 1, 3, 2)]
+
+@pytest.mark.django_db
+def test_article_summary_refreshed_once_by_insert_many_rows():
+    "article summaries are refreshed once per batch of inserted metrics"
+    row = {'pdf': 1, 'full': 1, 'abstract': 1, 'digest': 1, 'period': models.DAY, 'source': models.GA}
+    doi = '10.7554/eLife.00001'
+    row_list = [dict(row, doi=doi, date='2001-01-0%s' % day) for day in range(1, 4)]
+    with mock.patch('article_metrics.logic.refresh_article_summaries', wraps=logic.refresh_article_summaries) as mock_refresh:
+        logic.insert_many_rows(row_list)
+    assert mock_refresh.call_count == 1
+    assert _summaries() == [(doi, 9, 3, 0, 0, 0)]
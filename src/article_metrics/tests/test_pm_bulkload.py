@@ -1,7 +1,8 @@
 from django.conf import settings
 from article_metrics.pm import bulkload_pmids
 from . import base
-from article_metrics import models
+from article_metrics import models, logic
+from django.core.exceptions import ValidationError
 import pytest
 
 @pytest.mark.django_db
@@ -32,3 +33,43 @@ def test_load_missing():
     art = models.Article.objects.get(doi=doi)
     assert art.pmid is None
     assert art.pmcid == pmcid
+
+@pytest.mark.django_db
+def test_load_existing():
+    "existing articles are updated in place"
+    fixture = base.fixture_path('pm-fixture.csv')
+    bulkload_pmids.load_csv(fixture)
+    art = models.Article.objects.all()[0]
+    expected_pmid, expected_pmcid = art.pmid, art.pmcid
+    models.Article.objects.update(pmid=None, pmcid=None)
+
+    results = bulkload_pmids.load_csv(fixture)
+    assert models.Article.objects.count() == 9
+    assert all(updated for _, created, updated in results)
+    art = models.Article.objects.get(id=art.id)
+    assert art.pmid == expected_pmid
+    assert art.pmcid == expected_pmcid
+
+    # nothing is updated when nothing has changed
+    results = bulkload_pmids.load_csv(fixture)
+    assert not any(updated for _, created, updated in results)
+
+@pytest.mark.django_db
+def test_update_article_id_map():
+    "known articles are found using their normalised doi, validated, and returned the same way as new articles"
+    art = models.Article(doi='10.7554/eLife.00013')
+    art.save()
+    id_map = logic.article_id_map()
+    row = {'DOI': '10.7554/elife.13', 'PMCID': 'PMC3463246', 'PMID': '23066504'}
+    assert bulkload_pmids.update_article(row, id_map) == (art.id, False, True)
+    art = models.Article.objects.get(id=art.id)
+    assert (art.pmid, art.pmcid) == (23066504, 'PMC3463246')
+
+    row = {'DOI': '10.7554/eLife.00240', 'PMCID': 'PMC3463247', 'PMID': '23066507'}
+    new_art_id, created, _ = bulkload_pmids.update_article(row, id_map)
+    assert created
+    assert id_map['10.7554/eLife.00240'] == new_art_id
+
+    row = {'DOI': '10.7554/eLife.00013', 'PMCID': 'PMC3463246', 'PMID': 'foo'}
+    with pytest.raises(ValidationError):
+        bulkload_pmids.update_article(row, id_map)
@@ -4,6 +4,7 @@ import responses
 from . import base
 from article_metrics.pm import citations
 from article_metrics import models
+from django.core.exceptions import ValidationError
 
 def test_norm_pmcid():
     cases = [
@@ -155,3 +156,66 @@ def test_count_response():
 
     assert expected == citations.count_for_msid(msid)
     assert expected == citations.count_for_doi(doi)
+
+@responses.activate
+def test_fetch_pmids_many():
+    "many pmids and pmcids can be fetched with a single request, dois without a pmcid are excluded"
+    fixture = base.fixture_json('pm-fetch-pmids-response.json')
+    fixture['records'].append({'doi': '10.7554/eLife.00000', 'status': 'error', 'errmsg': 'invalid article id'})
+    responses.add(responses.GET, citations.PMID_URL, json=fixture)
+    expected = {'10.7554/elife.09560': {'pmid': '26354291', 'pmcid': 'PMC4559886'}}
+    assert expected == citations._fetch_pmids_many(['10.7554/elife.09560', '10.7554/eLife.00000'])
+    assert len(responses.calls) == 1
+
+@responses.activate
+@pytest.mark.django_db
+def test_citation_pages():
+    "missing pmcids are looked up and saved and citations are fetched for all articles"
+    models.Article(doi='10.7554/eLife.09560').save()
+    responses.add(responses.GET, citations.PMID_URL, json=base.fixture_json('pm-fetch-pmids-response.json'))
+    responses.add(responses.GET, citations.PM_URL, json=base.fixture_json('pm-citation-request-response-09560.json'))
+
+    expected = [[{
+        'source': 'pubmed',
+        'pmcid': 'PMC4559886',
+        'num': 17,
+        'source_id': 'https://www.ncbi.nlm.nih.gov/pmc/articles/PMC4559886/'}]]
+    assert expected == list(citations.citation_pages_for_all_articles(num_workers=2))
+    art = models.Article.objects.get(doi='10.7554/eLife.09560')
+    assert (art.pmid, art.pmcid) == (26354291, 'PMC4559886')
+
+@responses.activate
+@pytest.mark.django_db
+def test_citation_pages_error():
+    "errors in other stages of the pipeline are raised in the caller"
+    models.Article(doi='10.7554/eLife.09560').save()
+    responses.add(responses.GET, citations.PMID_URL, status=500)
+    with pytest.raises(requests.exceptions.RequestException):
+        list(citations.citation_pages_for_all_articles(num_workers=2))
+
+@responses.activate
+@pytest.mark.django_db
+def test_resolve_missing_pmcids():
+    "articles missing a pmcid are looked up in chunks and updated in bulk"
+    models.Article(doi='10.7554/eLife.09560').save()
+    models.Article(doi='10.7554/eLife.00001', pmcid='PMC1').save()
+    models.Article(doi='10.7554/eLife.00002', pmcid='').save()
+    responses.add(responses.GET, citations.PMID_URL, json=base.fixture_json('pm-fetch-pmids-response.json'))
+
+    assert citations.resolve_missing_pmcids(chunk_size=1) == 1
+    # one request per article missing a pmcid
+    assert len(responses.calls) == 2
+    assert 'ids=10.7554%2FeLife.09560' in responses.calls[0].request.url
+    assert models.Article.objects.get(doi='10.7554/eLife.09560').pmcid == 'PMC4559886'
+    assert models.Article.objects.get(doi='10.7554/eLife.00001').pmcid == 'PMC1'
+
+@pytest.mark.django_db
+def test_update_pmids():
+    "pmids and pmcids are validated and updated in bulk, the number of articles updated is returned"
+    models.Article(doi='10.7554/eLife.09560').save()
+    assert citations.update_pmids({'10.7554/eLife.09560': {'pmid': '26354291', 'pmcid': 'PMC4559886'}}) == 1
+    art = models.Article.objects.get(doi='10.7554/eLife.09560')
+    assert (art.pmid, art.pmcid) == (26354291, 'PMC4559886')
+
+    with pytest.raises(ValidationError):
+        citations.update_pmids({'10.7554/eLife.09560': {'pmid': 'foo', 'pmcid': 'PMC4559886'}})
@@ -3,7 +3,7 @@ import pytest
 import time
 import json
 from os.path import join
-from article_metrics import utils
+from article_metrics import utils, handler
 import responses
 from unittest.mock import patch
 from . import base
@@ -72,7 +72,21 @@ def test_scopus_request():
 
 def test_scopus_search_exits_early():
     "we stop talking to scopus when they start returning results with 0 citations"
-    pass
+    citation_counts = {0: 10, 1: 5, 2: 3, 3: 0, 4: 0, 5: 0}
+
+    def fetch_page(api_key, doi_prefix, page=0, per_page=25):
+        results = {'opensearch:totalResults': 100, 'opensearch:startIndex': str(page),
+                   'entry': [{'citedby-count': str(citation_counts.get(page, 0))}]}
+        return type('mock', (object,), {'json': lambda: {'search-results': results}})
+
+    with patch('article_metrics.scopus.citations.fetch_page', side_effect=fetch_page) as mock:
+        results = list(citations.search(window=3))
+
+    # pages are yielded in order, up to and including the first page with 0 citations
+    expected = ['0', '1', '2', '3']
+    assert expected == [r['opensearch:startIndex'] for r in results]
+    # no more pages are requested than those yielded plus a window's worth
+    assert len(mock.mock_calls) <= len(expected) + 3
 
 def test_scopus_search():
 
@@ -142,3 +156,9 @@ def test_many_scopus_requests():
         assert elapsed > 1
         expected = citations.MAX_PER_SECOND + 1
         assert expected == len(mock.mock_calls)
+
+def test_scopus_requests_rate_limited_once():
+    "requests to scopus are limited by `fetch_page` and not again by the shared session for the host"
+    handler.close_host_sessions()
+    session = handler.host_session(citations.URL)
+    assert session.get_adapter(citations.URL).rate_limit is handler.no_rate_limit
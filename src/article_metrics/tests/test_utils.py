@@ -1,11 +1,13 @@
+import time
 import typing
+from concurrent.futures import ThreadPoolExecutor
 from article_metrics import utils, models
 import pytz
 from datetime import datetime, date
 from django.conf import settings
 import pytest
 import requests
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 @pytest.mark.django_db
 def test_create_or_update():
@@ -199,22 +201,47 @@ def test_flatten():
 def test_get_article_versions():
     article_id = '85111'
 
-    requests.get = Mock()
+    session = Mock()
     mock_response = Mock()
     mock_response.json.return_value = {'doiVersion': f'10.7554/eLife.{article_id}.3'}
     mock_response.raise_for_status.return_value = None
-    requests.get.return_value = mock_response
+    session.get.return_value = mock_response
 
-    versions = utils.get_article_versions(article_id)
+    with patch('article_metrics.handler.host_session', return_value=session):
+        versions = utils.get_article_versions(article_id)
 
     assert versions == [1, 2, 3]
-    requests.get.assert_called_once_with(f"{settings.LAX_URL}/{article_id}")
+    session.get.assert_called_once_with(f"{settings.LAX_URL}/{article_id}")
 
 def test_get_article_versions_error():
     article_id = '85111'
-    requests.get = Mock(side_effect=requests.exceptions.RequestException)
+    session = Mock()
+    session.get = Mock(side_effect=requests.exceptions.RequestException)
 
-    versions = utils.get_article_versions(article_id)
+    with patch('article_metrics.handler.host_session', return_value=session):
+        versions = utils.get_article_versions(article_id)
 
     assert versions == []
-    requests.get.assert_called_once_with(f"{settings.LAX_URL}/{article_id}")
+    session.get.assert_called_once_with(f"{settings.LAX_URL}/{article_id}")
+
+def test_rate_limiter():
+    "calls are spaced at least `1/max_per_second` apart"
+    max_per_second = 20
+    wait = utils.rate_limiter(max_per_second)
+    start = time.perf_counter()
+    for _ in range(5):
+        wait()
+    elapsed = time.perf_counter() - start
+    # the first call proceeds immediately, the following four each wait 1/20th of a second.
+    assert elapsed >= 4 * (1.0 / max_per_second)
+
+def test_rate_limiter_threaded():
+    "calls made from many threads share the same limit"
+    max_per_second = 20
+    wait = utils.rate_limiter(max_per_second)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        list(executor.map(lambda _: wait(), range(5)))
+    elapsed = time.perf_counter() - start
+    assert elapsed >= 4 * (1.0 / max_per_second)
+
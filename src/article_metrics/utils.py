@@ -5,12 +5,12 @@ import os, json, copy
 import tempfile, shutil
 from functools import wraps, partial, reduce
 import logging
-from datetime import datetime, date, timedelta
+from datetime import datetime, date
 import dateutil
 import dateutil.parser
 from django.conf import settings
 import pytz
-import requests, requests_cache
+import requests
 
 LOG = logging.getLogger(__name__)
 
@@ -382,6 +382,26 @@ def simple_rate_limiter2(max_per_second):
 
 simple_rate_limiter = simple_rate_limiter2
 
+def rate_limiter(max_per_second):
+    """returns a function that blocks the calling thread until it is allowed to proceed.
+    thread-safe. unlike `simple_rate_limiter2` the lock is only held while a slot is reserved
+    and not for the duration of the rate limited call, so many calls may be in-flight at once."""
+    lock = threading.Lock()
+    min_interval = 1.0 / max_per_second
+    next_slot = time.perf_counter()
+
+    def wait():
+        nonlocal next_slot
+        with lock:
+            now = time.perf_counter()
+            slot = max(now, next_slot)
+            next_slot = slot + min_interval
+        left_to_wait = slot - now
+        if left_to_wait > 0:
+            time.sleep(left_to_wait)
+
+    return wait
+
 #
 #
 #
@@ -399,19 +419,19 @@ def merge(*dicts):
         return c
     return reduce(_merge, dicts)
 
-def create_caching_session():
-    return requests_cache.CachedSession(
-        cache_name=settings.CACHE_NAME,
-        backend='sqlite',
-        expire_after=timedelta(hours=24 * settings.CACHE_EXPIRY)
-    )
+def create_caching_session(host=None):
+    "returns a session that caches responses, see `http_cache.py`."
+    from article_metrics import http_cache # avoids a circular import
+    return http_cache.create_session(host)
 
-def get_article_versions(article_id):
+def get_article_versions(article_id, requests_session=None):
     """
     Fetches the versions of a given article based on the latest doiVersion.
 
     Parameters:
     article_id (str): The ID of the article for which versions are to be fetched.
+    requests_session (requests.Session): An optional session to fetch the versions with.
+        Defaults to the shared session for the LAX host, see `handler.host_session`.
 
     Returns:
     list: A list of integers representing the versions of the article.
@@ -421,12 +441,10 @@ def get_article_versions(article_id):
     >>> get_article_versions('85111')
     [1, 2, 3]
     """
+    from article_metrics import handler # avoids a circular import
+    url = f"{settings.LAX_URL}/{article_id}"
     try:
-        if not settings.TESTING:
-            with create_caching_session() as session:
-                response = session.get(f"{settings.LAX_URL}/{article_id}")
-        else:
-            response = requests.get(f"{settings.LAX_URL}/{article_id}")
+        response = (requests_session or handler.host_session(url)).get(url)
         response.raise_for_status()
         data = response.json()
         doi_version = data.get('doiVersion')
@@ -60,6 +60,10 @@ OUTPUT_PATH = join(EXT_DIR if USE_EXT else PROJECT_DIR, 'output')
 # TODO: rename 'GA_OUTPUT_PATH'. we have a path here not a dirname
 GA_OUTPUT_SUBDIR = join(OUTPUT_PATH, 'ga')
 
+# how GA responses are cached, 'sqlite' or 'json'. see `article_metrics/ga_metrics/store.py`
+GA_CACHE_BACKEND = cfg('general.ga-cache-backend', None) or 'sqlite'
+GA_CACHE_DB = join(GA_OUTPUT_SUBDIR, 'ga-cache.sqlite3')
+
 GA3_TABLE_ID = "82618489"
 GA4_TABLE_ID = "316514145"
 
@@ -71,9 +75,12 @@ CROSSREF_USER = cfg('crossref.user')
 CROSSREF_PASS = cfg('crossref.pass')
 
 # requests-cache, permanent
+# how responses to outbound requests are cached, 'sqlite' or 'filesystem'. see `article_metrics/http_cache.py`
+CACHE_BACKEND = cfg('general.requests-cache-backend', None) or 'sqlite'
 # time in days before the cached requests expires
 CACHE_EXPIRY = 2 # days
 CACHE_NAME = join(OUTPUT_PATH, 'db.sqlite3')
+CACHE_DIR = join(OUTPUT_PATH, 'requests-cache')
 CACHE_NAME_JOURNAL_REQUESTS = join(OUTPUT_PATH, 'db.journal-requests.sqlite3')
 
 # SECURITY WARNING: keep the secret key used in production secret!
@@ -155,6 +162,28 @@ DATABASES = {
     }
 }
 
+# Caching
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # API responses, shared between processes. see `article_metrics/api_v2_cache.py`
+    'api': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': cfg('general.api-cache-dir', None) or join(OUTPUT_PATH, 'api-cache'),
+        # responses are invalidated after each import, this is just an upper limit.
+        'TIMEOUT': 60 * 60 * 24, # 1 day
+        'OPTIONS': {
+            'MAX_ENTRIES': 20000,
+        },
+    },
+}
+if TESTING:
+    CACHES['api'] = {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}
+    GA_CACHE_BACKEND = 'json'
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
 
@@ -309,3 +338,12 @@ GA_SECRETS_LOCATION = os.getenv(
 assert os.path.exists(GA_SECRETS_LOCATION), "client-secrets.json not found. I looked here: %s" % GA_SECRETS_LOCATION
 
 LAX_URL = "https://prod--gateway.elifesciences.org/articles"
+
+# time in days before cached requests to urls matching a pattern expire, overriding `CACHE_EXPIRY`.
+# - https://requests-cache.readthedocs.io/en/v0.9.8/user_guide/expiration.html#url-patterns
+CACHE_URL_EXPIRY = {
+    # new article versions are rare
+    LAX_URL: 7,
+    # citations change daily
+    "doi.crossref.org": 1,
+}
@@ -10,7 +10,8 @@ import logging
 
 LOG = logging.getLogger(__name__)
 
-def ingest_command(ptype_list, replace_cache_files=False):
+def ingest_command(ptype_list, replace_cache_files=False, num_workers=1):
+    "returns a map of `{ptype: seconds-taken}` for each page type ingested."
     if ptype_list:
         known_type_list = ", ".join(models.PAGE_TYPES)
         for ptype in ptype_list:
@@ -18,9 +19,10 @@ def ingest_command(ptype_list, replace_cache_files=False):
     else:
         ptype_list = models.PAGE_TYPES
     try:
-        [logic.update_ptype(ptype, replace_cache_files=replace_cache_files) for ptype in ptype_list]
+        return logic.update_ptypes(logic.update_ptype, ptype_list, num_workers, replace_cache_files=replace_cache_files)
     except BaseException as err:
         LOG.exception(str(err))
+        return {}
 
 def update_test_fixtures():
     # ga-response-events-frame2.json
@@ -5,9 +5,8 @@ from functools import partial
 from collections import OrderedDict
 import importlib
 from article_metrics.utils import ensure, lmap, lfilter
-from article_metrics.ga_metrics import core as ga_core
+from article_metrics.ga_metrics import core as ga_core, store
 from django.conf import settings
-import json
 import os
 import logging
 
@@ -44,10 +43,10 @@ def query_ga(ptype, query, results_pp=MAX_GA_RESULTS, replace_cache_files=False)
     LOG.info("querying GA for %ss between %s and %s" % (ptype, sd, ed))
     dump_path = ga_core.output_path(ptype, sd, ed)
     # TODO: this settings.TESTING check is a code smell.
-    if os.path.exists(dump_path) and not settings.TESTING:
+    if store.exists(dump_path) and not settings.TESTING:
         if not replace_cache_files:
             LOG.info("(cache hit)")
-            return json.load(open(dump_path, 'r'))
+            return store.read(dump_path)
         # cache file will be replaced with results
         pass
 
@@ -46,10 +46,18 @@ def build_ga4_query__queries_for_frame(_, frame, start_date, end_date):
             "limit": "10000"}
 
 def query_ga(ptype, query, replace_cache_files=False):
-    start_dt = ga_utils.todt(query['dateRanges'][0]['startDate'])
-    end_dt = ga_utils.todt(query['dateRanges'][0]['endDate'])
+    """returns the GA results for the given `query`, reading them from the cache if they exist.
+    results for date ranges that have closed are cached, see `ga_core.output_path_v2`."""
+    start_dt = ga_utils.todt_notz(query['dateRanges'][0]['startDate'])
+    end_dt = ga_utils.todt_notz(query['dateRanges'][0]['endDate'])
 
     results_type = ptype
+    if not replace_cache_files:
+        results = ga_core.load_cache(results_type, start_dt, end_dt, cached=True, only_cached=False)
+        if results is not None:
+            LOG.info("(cache hit)")
+            return results
+
     results, _ = ga_core.query_ga_write_results_v2(query, start_dt, end_dt, results_type)
     return results
 
@@ -10,9 +10,9 @@ LOG = logging.getLogger(__name__)
 
 one_day = datetime.timedelta(days=1)
 
-# note: these frames, without caching (because of partial output path logic),
-# will eventually grow very large and risk sampling or GA 'other' grouping.
-# artifical frames here would be one solution to query partitioning.
+# note: GA4 frames are queried a month at a time (see `logic.partition_frame`) so results don't
+# grow very large and risk sampling or GA 'other' grouping as frames get longer.
+# GA3 frames are closed and their results are cached for the whole frame.
 # *article* metrics do this naturally with monthly ranges.
 # GA4_SWITCH = 2023-03-20
 
@@ -1,10 +1,12 @@
 from . import models, history, ga3, ga4
-from article_metrics.utils import ensure, lmap, create_or_update, first, ymd, lfilter
-from article_metrics.ga_metrics import core as ga_core
+from article_metrics.utils import ensure, create_or_update, first, ymd, lfilter, paginate, date_today
+from article_metrics.ga_metrics import core as ga_core, utils as ga_utils
+from article_metrics import api_v2_cache
 from django.db.models import Sum, F
-from django.db.models.functions import TruncMonth
-from datetime import date
-from django.db import transaction
+from datetime import date, timedelta
+from django.db import transaction, connection, connections
+from concurrent.futures import ThreadPoolExecutor
+import time
 import logging
 
 LOG = logging.getLogger(__name__)
@@ -13,6 +15,21 @@ DAY, MONTH = 'day', 'month'
 
 MAX_GA_RESULTS = 10000
 
+# maximum number of page counts upserted per-statement
+PAGE_COUNT_CHUNK_SIZE = 5000
+
+# GA4 results for the most recent days may be partial, see `ga_core.cacheable`.
+# an incremental update re-imports these days from the previous update.
+PARTIAL_DATA_WINDOW = timedelta(days=3)
+
+# number of month-sized queries sent to GA at once for a page type.
+# all GA requests share the same rate limit, see `ga_core.ga4.rate_limit`.
+MAX_QUERY_WORKERS = 4
+
+# number of page types updated at once by the nightly import.
+# GA requests from every page type share the same rate and concurrency limits, see `ga_core.ga4`.
+MAX_PTYPE_WORKERS = 4
+
 def is_pid(pid):
     return isinstance(pid, str) and len(pid) < 256
 
@@ -79,8 +96,7 @@ def build_ga_query__queries_for_frame(ptype, frame, start_date, end_date):
 
     The new ga4 frames align with the switch to GA4 so all we need to do here is check
     if the given frame starts on the `GA4_SWITCH` date."""
-    era = ga_core.GA4 if frame['starts'] >= ga_core.GA4_SWITCH.date() else ga_core.GA3
-    if era == ga_core.GA3:
+    if frame_era(frame) == ga_core.GA3:
         return ga3.build_ga3_query__queries_for_frame(ptype, frame, start_date, end_date)
     return ga4.build_ga4_query__queries_for_frame(ptype, frame, start_date, end_date)
 
@@ -104,10 +120,26 @@ def interesting_frames(start_date, end_date, frame_list):
     return lfilter(_interesting_frame, frame_list)
 
 
+def frame_era(frame):
+    "returns the GA era of the given `frame`, GA4 frames start on or after the `GA4_SWITCH` date."
+    return ga_core.GA4 if frame['starts'] >= ga_core.GA4_SWITCH.date() else ga_core.GA3
+
+def partition_frame(frame, start_date, end_date):
+    """returns a list of `(start-date, end-date)` pairs for each month the given `frame` and date range have in common.
+    the first and last pairs may be partial months. a frame's results are queried a month at a time so
+    results stay small and the results for closed months can be cached.
+    GA3 frames are not partitioned. GA3 can no longer be queried and it's results are cached for the whole frame."""
+    start_date = max(start_date, frame['starts'])
+    end_date = min(end_date, frame['ends'])
+    if frame_era(frame) == ga_core.GA3:
+        return [(start_date, end_date)]
+    return [(dt1.date(), dt2.date()) for dt1, dt2 in ga_utils.dt_month_range(start_date, end_date, preserve_caps=True)]
+
 def build_ga_query(ptype, start_date=None, end_date=None):
     """As we go further back in history the query will change as known epochs
     overlap. These overlaps will truncate the current period to the epoch
-    boundaries."""
+    boundaries.
+    returns a list of `(frame, query)` pairs with a query for each month in each GA4 frame, see `partition_frame`."""
 
     ensure(is_ptype(ptype), "bad page type: %s" % ptype)
 
@@ -136,53 +168,187 @@ def build_ga_query(ptype, start_date=None, end_date=None):
     #frame_list = frame_list[::-1]
 
     # each timeframe requires it's own pattern generation, post processing and normalisation
-    query_list = [(frame, build_ga_query__queries_for_frame(ptype, frame, start_date, end_date)) for frame in frame_list]
+    query_list = []
+    for frame in frame_list:
+        for month_start, month_end in partition_frame(frame, start_date, end_date):
+            query_list.append((frame, build_ga_query__queries_for_frame(ptype, frame, month_start, month_end)))
     return query_list
 
 #
 #
 #
 
+# recalculates the monthly totals for the given pairs of `(page-id, first-day-of-month)`
+UPDATE_MONTHLY_PAGE_COUNTS_SQL = """
+INSERT INTO metrics_pagecountmonth (page_id, date, views)
+SELECT
+    pc.page_id,
+    date_trunc('month', pc.date)::date AS month,
+    sum(pc.views)
+FROM
+    metrics_pagecount pc
+WHERE
+    (pc.page_id, date_trunc('month', pc.date)::date) IN (SELECT * FROM unnest(%s::integer[], %s::date[]))
+GROUP BY
+    pc.page_id, month
+ON CONFLICT (page_id, date) DO UPDATE SET
+    views = EXCLUDED.views
+"""
+
+def update_monthly_page_counts(page_month_list):
+    "recalculates the `models.PageCountMonth` totals for each pair of `(page-id, first-day-of-month)` in `page_month_list`."
+    if not page_month_list:
+        return
+    page_id_list, month_list = zip(*page_month_list)
+    with connection.cursor() as cursor:
+        cursor.execute(UPDATE_MONTHLY_PAGE_COUNTS_SQL, [list(page_id_list), list(month_list)])
+
+def get_create_page_ids(ptypeobj, identifier_list):
+    """returns a map of `{identifier: page-id}` for each identifier in `identifier_list`.
+    the pages of the given page type are fetched with a single query and missing pages are created in bulk."""
+    id_map = dict(models.Page.objects.filter(type=ptypeobj).values_list('identifier', 'id'))
+    missing = set(identifier_list) - set(id_map.keys())
+    if missing:
+        page_list = [models.Page(type=ptypeobj, identifier=identifier) for identifier in missing]
+        # `clean_fields` validates the page without the database lookups `full_clean` would do.
+        for page in page_list:
+            page.clean_fields(exclude=['type'])
+        models.Page.objects.bulk_create(page_list, ignore_conflicts=True)
+        id_map.update(models.Page.objects.filter(type=ptypeobj, identifier__in=missing).values_list('identifier', 'id'))
+    return id_map
+
+# page counts are only updated if their views have changed.
+# `xmax` is zero for rows that were inserted rather than updated.
+# - https://www.postgresql.org/docs/current/sql-insert.html#SQL-ON-CONFLICT
+UPSERT_PAGE_COUNTS_SQL = """
+INSERT INTO metrics_pagecount (page_id, date, views)
+SELECT * FROM unnest(%s::integer[], %s::date[], %s::integer[])
+ON CONFLICT (page_id, date) DO UPDATE SET
+    views = EXCLUDED.views
+WHERE
+    metrics_pagecount.views IS DISTINCT FROM EXCLUDED.views
+RETURNING id, page_id, date, (xmax = 0) AS created
+"""
+
+def _upsert_page_counts(row_list):
+    """creates or updates a `models.PageCount` for each `(page-id, date, views)` triple in `row_list` using a single statement.
+    returns a list of `(pagecount-id, page-id, date, created)` for just those rows that were created or updated."""
+    if not row_list:
+        return []
+    page_id_list, date_list, views_list = zip(*row_list)
+    with connection.cursor() as cursor:
+        cursor.execute(UPSERT_PAGE_COUNTS_SQL, [list(page_id_list), list(date_list), list(views_list)])
+        return cursor.fetchall()
+
 @transaction.atomic
-def update_page_counts(ptype, page_counts):
+def update_page_counts(ptype, page_counts, chunk_size=PAGE_COUNT_CHUNK_SIZE):
+    """creates or updates a `models.PageCount` for each row in `page_counts`, creating any missing `models.Page`.
+    page counts are upserted `chunk_size` rows per-statement and unchanged page counts are skipped.
+    returns a list of `(pagecount-id, created, updated)` triples for just those rows that were created or updated."""
+    # cached API responses are stale once these counts are committed.
+    api_v2_cache.invalidate_on_commit(api_v2_cache.NON_ARTICLE_METRICS)
     ptypeobj = first(create_or_update(models.PageType, {"name": ptype}, update=False))
 
-    def do(row):
-        page_data = {
-            'type': ptypeobj,
-            'identifier': row['identifier'],
-        }
-        pageobj = first(create_or_update(models.Page, page_data, update=False))
-
-        pagecount_data = {
-            'page': pageobj,
-            'views': row['views'],
-            'date': row['date']
-        }
-        key_list = ['page', 'date']
-        pagecountobj = first(create_or_update(models.PageCount, pagecount_data, key_list, update=True))
-        return pagecountobj
-    return lmap(do, page_counts)
+    page_id_map = get_create_page_ids(ptypeobj, [row['identifier'] for row in page_counts])
+
+    # a row may only be upserted once per-statement, last row wins.
+    row_idx = {}
+    for row in page_counts:
+        pagecount = models.PageCount(page_id=page_id_map[row['identifier']], views=row['views'], date=row['date'])
+        pagecount.clean_fields(exclude=['page'])
+        row_idx[(pagecount.page_id, pagecount.date)] = pagecount.views
+
+    results = []
+    # months with new or modified page counts
+    changed_months = set()
+    for chunk in paginate(list(row_idx.items()), chunk_size):
+        row_list = [(page_id, dt, views) for (page_id, dt), views in chunk]
+        for pagecount_id, page_id, dt, created in _upsert_page_counts(row_list):
+            changed_months.add((page_id, dt.replace(day=1)))
+            results.append((pagecount_id, created, not created))
+    update_monthly_page_counts(changed_months)
+
+    num_created = len([result for result in results if result[1]])
+    LOG.info("%s '%s' page counts created, %s changed and were updated, %s unchanged" % (
+        num_created, ptype, len(results) - num_created, len(row_idx) - len(results)))
+    return results
 
 #
 #
 #
 
-def update_ptype(ptype, start_date=None, end_date=None, replace_cache_files=False):
-    "query GA about a page-type, then process and store the results."
-    try:
-        for frame, query in build_ga_query(ptype, start_date, end_date):
-            response = query_ga(ptype, query, replace_cache_files=replace_cache_files)
+def _update_ptype(ptype, start_date=None, end_date=None, replace_cache_files=False, num_workers=MAX_QUERY_WORKERS):
+    """queries GA for each month in the date range, up to `num_workers` months at once.
+    responses are processed and stored in month order as they arrive."""
+    frame_query_list = build_ga_query(ptype, start_date, end_date)
+
+    def _query_ga(frame_query):
+        return query_ga(ptype, frame_query[1], replace_cache_files=replace_cache_files)
+
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        for (frame, _), response in zip(frame_query_list, executor.map(_query_ga, frame_query_list)):
             normalised_rows = process_response(ptype, frame, response)
             counts = aggregate(normalised_rows)
             LOG.info("inserting/updating %s '%s' rows" % (len(counts), ptype))
             update_page_counts(ptype, counts)
+
+def update_ptype(ptype, start_date=None, end_date=None, replace_cache_files=False):
+    "query GA about a page-type, then process and store the results."
+    try:
+        _update_ptype(ptype, start_date, end_date, replace_cache_files)
     except AssertionError as err:
         LOG.error(err)
 
-def update_all_ptypes(start_date=None, end_date=None, replace_cache_files=False):
-    for ptype in models.PAGE_TYPES:
-        update_ptype(ptype, start_date, end_date, replace_cache_files)
+def incremental_start_date(ptype, ingested_to=None):
+    """returns the date to query GA from for the given `ptype`, the page type's high-water mark `ingested_to`
+    less the `PARTIAL_DATA_WINDOW`. the first day of that month is returned so a closed month is always
+    queried whole and it's cached results are used. nothing earlier than the start of the latest frame is queried."""
+    start_date = history.ptype_history(ptype)['frames'][-1]['starts']
+    if ingested_to:
+        start_date = max(start_date, (ingested_to - PARTIAL_DATA_WINDOW).replace(day=1))
+    return start_date
+
+def update_ptype_incremental(ptype, replace_cache_files=False):
+    """query GA about a page-type since it was last updated, then process and store the results.
+    the page type's high-water mark is only moved once all results have been stored."""
+    ptypeobj = first(create_or_update(models.PageType, {"name": ptype}, update=False))
+    start_date = incremental_start_date(ptype, ptypeobj.ingested_to)
+    end_date = date_today()
+    if start_date > end_date:
+        return
+    try:
+        _update_ptype(ptype, start_date, end_date, replace_cache_files)
+    except AssertionError as err:
+        LOG.error(err)
+        return
+    ptypeobj.ingested_to = end_date
+    ptypeobj.save()
+
+def update_ptypes(update_fn, ptype_list, num_workers=1, **kwargs):
+    """calls `update_fn` with each page type in `ptype_list` and the given `kwargs`, up to `num_workers` page types at once.
+    each page type's page counts are stored in their own transactions.
+    returns a map of `{ptype: seconds-taken}` in the order of `ptype_list`."""
+
+    def _update(ptype):
+        start = time.perf_counter()
+        try:
+            update_fn(ptype, **kwargs)
+        finally:
+            if num_workers > 1:
+                # each thread opens it's own database connection.
+                connections.close_all()
+        elapsed = time.perf_counter() - start
+        LOG.info("timing for page type %r: %.2f seconds" % (ptype, elapsed))
+        return ptype, elapsed
+
+    if num_workers > 1:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            return dict(executor.map(_update, ptype_list))
+    return dict(map(_update, ptype_list))
+
+def update_all_ptypes(start_date=None, end_date=None, replace_cache_files=False, num_workers=1):
+    kwargs = {'start_date': start_date, 'end_date': end_date, 'replace_cache_files': replace_cache_files}
+    return update_ptypes(update_ptype, models.PAGE_TYPES, num_workers, **kwargs)
 
 def update_all_ptypes_latest_frame():
     for ptype in models.PAGE_TYPES:
@@ -190,6 +356,9 @@ def update_all_ptypes_latest_frame():
         latest_frame = history_data['frames'][-1]
         update_ptype(ptype, start_date=latest_frame['starts'], end_date=None)
 
+def update_all_ptypes_incremental(num_workers=MAX_PTYPE_WORKERS):
+    return update_ptypes(update_ptype_incremental, models.PAGE_TYPES, num_workers)
+
 #
 #
 #
@@ -202,13 +371,13 @@ def daily_page_views(pobj):
     return sums['views_sum'] or 0, qobj
 
 def monthly_page_views(pobj):
-    qobj = pobj.pagecount_set \
-        .annotate(date_field=TruncMonth('date')) \
-        .values('date_field') \
-        .annotate(views_sum=Sum('views')) \
+    # monthly totals are maintained by `update_page_counts`.
+    # aliases match those of the daily results.
+    qobj = pobj.pagecountmonth_set \
+        .annotate(date_field=F('date'), views_sum=F('views')) \
         .values('date_field', 'views_sum') \
         .order_by()
-    sums = pobj.pagecount_set.all().aggregate(views_sum=Sum('views'))
+    sums = pobj.pagecountmonth_set.all().aggregate(views_sum=Sum('views'))
     return sums['views_sum'], qobj
 
 #
@@ -10,10 +10,15 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('--type', nargs='+', dest='just_type', type=str, default=[])
         parser.add_argument('--replace-cache-files', dest='replace_cache_files', action='store_const', const=True, default=False)
+        # number of page types to ingest concurrently.
+        # all workers share the same GA rate limit.
+        parser.add_argument('--workers', nargs='?', type=int, default=1)
 
     def handle(self, *args, **options):
         try:
-            cmds.ingest_command(ptype_list=options['just_type'], replace_cache_files=options['replace_cache_files'])
+            timings = cmds.ingest_command(ptype_list=options['just_type'], replace_cache_files=options['replace_cache_files'], num_workers=options['workers'])
+            for ptype, seconds in timings.items():
+                self.stdout.write("%s: %.2f seconds" % (ptype, seconds))
         except BaseException as err:
             LOG.error("uncaught exception calling command 'ingest': %s" % err, extra={'cli-args': options})
             sys.exit(1)
@@ -0,0 +1,37 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# populate the new table from existing page counts
+POPULATE_SQL = """
+INSERT INTO metrics_pagecountmonth (page_id, date, views)
+SELECT page_id, date_trunc('month', date)::date AS month, sum(views)
+FROM metrics_pagecount
+GROUP BY page_id, month
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metrics', '0004_alter_pagetype_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PageCountMonth',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('views', models.PositiveIntegerField()),
+                ('date', models.DateField(help_text='the first day of the month')),
+                ('page', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='metrics.page')),
+            ],
+            options={
+                'unique_together': {('page', 'date')},
+            },
+        ),
+        migrations.RunSQL(
+            sql=POPULATE_SQL,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
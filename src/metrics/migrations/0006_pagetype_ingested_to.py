@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metrics', '0005_pagecountmonth'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pagetype',
+            name='ingested_to',
+            field=models.DateField(blank=True, help_text='the last day page counts were imported for', null=True),
+        ),
+    ]
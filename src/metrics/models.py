@@ -18,6 +18,8 @@ def page_type_choices():
 
 class PageType(Model):
     name = CharField(primary_key=True, max_length=255, choices=page_type_choices())
+    # maintained by `logic.update_ptype_incremental`
+    ingested_to = DateField(null=True, blank=True, help_text="the last day page counts were imported for")
 
     def __str__(self):
         return str(self.name)
@@ -54,3 +56,19 @@ class PageCount(Model):
 
     def __repr__(self):
         return "<PageCount '%s:%s'>" % (self.date.strftime('%Y-%m-%d'), self.views) # ll: <PageCount '2018-01-01:12'>
+
+class PageCountMonth(Model):
+    "the sum of a page's `PageCount` views for a month. maintained by `logic.update_page_counts`."
+    # when a Page is deleted, delete it's monthly page counts
+    page = ForeignKey(Page, on_delete=CASCADE)
+    views = PositiveIntegerField()
+    date = DateField(help_text="the first day of the month")
+
+    class Meta:
+        unique_together = (('page', 'date'),) # one result per-page, per-month
+
+    def __str__(self):
+        return "%s: %d views" % (self.date.strftime('%Y-%m'), int(self.views)) # "2018-01: 12 views"
+
+    def __repr__(self):
+        return "<PageCountMonth '%s:%s'>" % (self.date.strftime('%Y-%m'), self.views) # ll: <PageCountMonth '2018-01:12'>
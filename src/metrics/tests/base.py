@@ -1,6 +1,6 @@
 import os
 import json
-from metrics import models
+from metrics import models, logic
 from article_metrics.utils import lmap
 
 THIS_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -22,5 +22,7 @@ def insert_metrics(list_of_rows):
         ptype, _ = models.PageType.objects.get_or_create(name=ptype)
         page, _ = models.Page.objects.get_or_create(type=ptype, identifier=pid)
         pcount, _ = models.PageCount.objects.get_or_create(page=page, views=views, date=date)
+        # `full_clean` has converted the date string to a date
+        logic.update_monthly_page_counts([(page.id, pcount.date.replace(day=1))])
         return (ptype, page, pcount)
     return lmap(_insert, list_of_rows)
@@ -5,6 +5,7 @@ import os
 from article_metrics import utils
 from article_metrics.utils import lmap, first, second, subdict, date_today
 from metrics import logic, ga3, models, history
+from article_metrics.ga_metrics import core as ga_core, store
 from datetime import date, timedelta
 from unittest.mock import patch
 from django.test import override_settings
@@ -183,6 +184,22 @@ def test_query_ga(test_output_dir):
             assert len(contents) == 1
             assert fixture == json.load(open(dumpfile, 'r'))
 
+@pytest.mark.django_db
+@override_settings(TESTING=False) # urgh, caching in elife-metrics needs an overhaul
+def test_update_ptype_frame_cache(test_output_dir):
+    "GA3 frames are read from the results cached for the whole frame and GA is not queried"
+    frame = [frame for frame in history.ptype_history(models.EVENT)['frames'] if frame['id'] == '2'][0]
+    fixture = base.fixture_json('ga-response-events-frame2.json')
+    with patch('article_metrics.ga_metrics.core.output_dir', return_value=test_output_dir):
+        path = ga_core.output_path(models.EVENT, frame['starts'], frame['ends'])
+        os.makedirs(os.path.dirname(path))
+        store.write(path, fixture)
+        with patch('article_metrics.ga_metrics.core.query_ga') as query_ga_mock:
+            logic.update_ptype(models.EVENT, frame['starts'], frame['ends'])
+    assert not query_ga_mock.called
+    # not the same as len(fixture.rows) because of aggregation
+    assert models.PageCount.objects.count() == 138
+
 def test_process_response_generic_processor():
     "response is processed predictably, views are ints, dates are dates, results retain their order, etc"
     frame = {'id': '2', 'prefix': '/events'}
@@ -281,3 +298,18 @@ def test_parse_redirect_map():
         ('/u-k-panel-backs-open-access-for-all-publicly-funded-research-papers', 'fbbcdd2b'),
         ('/elife-news/uk-panel-backs-open-access-all-publicly-funded-research-papers', 'fbbcdd2b')])
     assert expected == results
+
+def test_query_ga_pagination_order():
+    "pages fetched concurrently are returned in order"
+    query = {'ids': '12345', 'start_date': '2012-01-01', 'end_date': '2013-01-01', 'filters': 'ga:pagePath==/pants'}
+    total_results = 25
+
+    def _query_ga(query, num_attempts):
+        start = query['start_index']
+        rows = [[str(i)] for i in range(start, min(start + query['max_results'], total_results + 1))]
+        return {'totalResults': total_results, 'rows': rows}
+
+    with patch('article_metrics.ga_metrics.core._query_ga', side_effect=_query_ga):
+        response = logic.query_ga(models.EVENT, query, 10)
+    assert response['totalPages'] == 3
+    assert [int(row[0]) for row in response['rows']] == list(range(1, total_results + 1))
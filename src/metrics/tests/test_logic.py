@@ -1,6 +1,7 @@
 import pytest
+import time
 from . import base
-from article_metrics.utils import tod
+from article_metrics.utils import tod, ymd
 from metrics import logic, models
 from datetime import date, timedelta
 from unittest.mock import patch
@@ -158,6 +159,34 @@ def test_double_insert():
     expected_total = 16
     assert expected_total == actual_total()
 
+@pytest.mark.django_db
+def test_update_page_counts_skips_unchanged():
+    "only new and changed page counts are written, in chunks"
+    aggregated_rows = logic.asmaps([
+        ("/events/foo", tod("2018-01-01"), 1),
+        ("/events/foo", tod("2018-01-02"), 2),
+        ("/events/foo", tod("2018-01-03"), 4),
+        ("/events/bar", tod("2018-01-03"), 1)
+    ])
+    results = logic.update_page_counts(models.EVENT, aggregated_rows, chunk_size=3)
+    assert len(results) == 4
+    assert all(created for _, created, _ in results)
+
+    # nothing changed
+    assert logic.update_page_counts(models.EVENT, aggregated_rows, chunk_size=3) == []
+
+    # one count changed, one page is new
+    aggregated_rows = logic.asmaps([
+        ("/events/foo", tod("2018-01-01"), 1),
+        ("/events/foo", tod("2018-01-02"), 3),
+        ("/events/baz", tod("2018-01-03"), 1),
+    ])
+    results = logic.update_page_counts(models.EVENT, aggregated_rows, chunk_size=3)
+    assert sorted((created, updated) for _, created, updated in results) == [(False, True), (True, False)]
+    assert models.Page.objects.count() == 3
+    assert models.PageCount.objects.count() == 5
+    assert models.PageCount.objects.get(page__identifier="/events/foo", date=tod("2018-01-02")).views == 3
+
 @pytest.mark.django_db
 def test_update_ptype():
     "`update_ptype` convenience function behaves as expected"
@@ -177,3 +206,119 @@ def test_update_ptype():
     assert models.PageType.objects.count() == 1 # 'event'
     # not the same as len(fixture.rows) because of aggregation
     assert models.PageCount.objects.count() == 138
+
+def test_incremental_start_date():
+    "an incremental update queries from the high-water mark less the partial data window"
+    # never updated, the whole latest frame is queried
+    assert logic.incremental_start_date(models.EVENT) == date(2023, 3, 20)
+    # updated recently, only the current month is queried
+    assert logic.incremental_start_date(models.EVENT, date(2023, 6, 9)) == date(2023, 6, 1)
+    # partial data window reaches into the previous month, it's queried whole
+    assert logic.incremental_start_date(models.EVENT, date(2023, 6, 2)) == date(2023, 5, 1)
+
+@pytest.mark.django_db
+def test_update_ptype_incremental():
+    "the high-water mark is moved once all results are stored and not when an update fails"
+    with patch('metrics.logic.date_today', return_value=date(2023, 6, 10)):
+        with patch('metrics.logic._update_ptype') as mock:
+            logic.update_ptype_incremental(models.EVENT)
+        mock.assert_called_once_with(models.EVENT, date(2023, 3, 20), date(2023, 6, 10), False)
+        assert models.PageType.objects.get(name=models.EVENT).ingested_to == date(2023, 6, 10)
+
+    with patch('metrics.logic.date_today', return_value=date(2023, 6, 12)):
+        with patch('metrics.logic._update_ptype', side_effect=AssertionError("bad GA response")) as mock:
+            logic.update_ptype_incremental(models.EVENT)
+        mock.assert_called_once_with(models.EVENT, date(2023, 6, 1), date(2023, 6, 12), False)
+        assert models.PageType.objects.get(name=models.EVENT).ingested_to == date(2023, 6, 10)
+
+def test_build_ga_query_partitions_frames():
+    "GA4 frames are queried a month at a time, GA3 frames are queried whole"
+    frame_query_list = logic.build_ga_query(models.EVENT, date(2023, 3, 1), date(2023, 5, 15))
+    # march is split between the GA3 and GA4 frames
+    expected = [
+        ('2023-03-01', '2023-03-19'),
+        ('2023-03-20', '2023-03-31'),
+        ('2023-04-01', '2023-04-30'),
+        ('2023-05-01', '2023-05-15'),
+    ]
+    actual = []
+    for frame, query in frame_query_list:
+        if 'dateRanges' in query:
+            actual.append((query['dateRanges'][0]['startDate'], query['dateRanges'][0]['endDate']))
+        else:
+            actual.append((ymd(query['start_date']), ymd(query['end_date'])))
+    assert expected == actual
+
+@pytest.mark.django_db
+def test_update_ptype_months_in_order():
+    "months queried concurrently are stored in order"
+    frame = {'id': '2', 'prefix': '/events'}
+    frame_query_list = [(frame, {'month': 1}), (frame, {'month': 2}), (frame, {'month': 3})]
+
+    def query_ga(ptype, query, replace_cache_files=False):
+        # the first month is the slowest to respond
+        time.sleep(0.1 if query['month'] == 1 else 0)
+        return query
+
+    def process_response(ptype, frame, response):
+        return [{'identifier': 'foo', 'date': date(2018, response['month'], 1), 'views': 1}]
+
+    with patch('metrics.logic.build_ga_query', return_value=frame_query_list):
+        with patch('metrics.logic.query_ga', side_effect=query_ga):
+            with patch('metrics.logic.process_response', side_effect=process_response):
+                with patch('metrics.logic.update_page_counts') as mock:
+                    logic.update_ptype(models.EVENT)
+    assert [call[1][1][0]['date'].month for call in mock.mock_calls] == [1, 2, 3]
+
+def test_update_ptypes_concurrently():
+    "page types are updated concurrently and the time each page type took is returned"
+    ptype_list = ['a', 'b', 'c']
+
+    def update_fn(ptype, **kwargs):
+        time.sleep(0.2)
+
+    with patch('metrics.logic.connections') as connections_mock:
+        start = time.perf_counter()
+        timings = logic.update_ptypes(update_fn, ptype_list, num_workers=3)
+        elapsed = time.perf_counter() - start
+
+    assert list(timings.keys()) == ptype_list
+    assert all(seconds >= 0.2 for seconds in timings.values())
+    # as long as the slowest page type rather than the sum
+    assert elapsed < 0.2 * len(ptype_list)
+    # database connections opened by each thread are closed
+    assert connections_mock.close_all.call_count == len(ptype_list)
+
+def test_update_ptypes_failure():
+    "a page type that fails doesn't stop the other page types being updated, it's error is raised once they are done"
+    updated = []
+
+    def update_fn(ptype, **kwargs):
+        if ptype == 'a':
+            raise ValueError(ptype)
+        updated.append(ptype)
+
+    with patch('metrics.logic.connections'):
+        with pytest.raises(ValueError) as err:
+            logic.update_ptypes(update_fn, ['a', 'b', 'c'], num_workers=2)
+    assert str(err.value) == 'a'
+    assert sorted(updated) == ['b', 'c']
+
+@pytest.mark.django_db
+def test_update_page_counts_monthly_rollup():
+    "monthly totals are maintained as page counts are created and updated"
+    rows = [
+        {'identifier': 'pants', 'date': date(2016, 1, 30), 'views': 1},
+        {'identifier': 'pants', 'date': date(2016, 1, 31), 'views': 2},
+        {'identifier': 'pants', 'date': date(2016, 2, 1), 'views': 3},
+    ]
+    logic.update_page_counts(models.EVENT, rows)
+
+    def monthly():
+        return [(row.date, row.views) for row in models.PageCountMonth.objects.order_by('date')]
+
+    assert monthly() == [(date(2016, 1, 1), 3), (date(2016, 2, 1), 3)]
+
+    # only a count in January changes
+    logic.update_page_counts(models.EVENT, [{'identifier': 'pants', 'date': date(2016, 1, 31), 'views': 5}])
+    assert monthly() == [(date(2016, 1, 1), 6), (date(2016, 2, 1), 3)]
@@ -1,8 +1,8 @@
 from . import base
 from metrics import models, views, logic, history
-from article_metrics import utils
+from article_metrics import utils, api_v2_cache
 from django.urls import reverse
-from django.test import Client
+from django.test import Client, override_settings
 import pytest
 
 @pytest.mark.django_db
@@ -96,3 +96,46 @@ def test_content_types():
         resp = client.get(reverse(views.metrics, kwargs={'ptype': sct, 'pid': dummy_id}))
         assert resp.status_code == 200
         assert expected == resp.json()
+
+@pytest.mark.django_db
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'api': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test-metrics-views'},
+})
+def test_cached_response_invalidated_by_update(django_capture_on_commit_callbacks):
+    "cached responses are invalidated when page counts are updated"
+    api_v2_cache.api_cache().clear()
+    fixture = base.fixture_json('ga-response-events-frame2.json')
+    frame = {'id': '2', 'prefix': '/events'}
+    rows = logic.aggregate(logic.process_response(models.EVENT, frame, fixture))
+    logic.update_page_counts(models.EVENT, rows)
+
+    url = reverse(views.metrics, kwargs={'ptype': models.EVENT})
+    assert Client().get(url).json()['totalValue'] == 79
+
+    models.PageCount.objects.all().update(views=0) # bypasses invalidation
+    assert Client().get(url).json()['totalValue'] == 79
+
+    with django_capture_on_commit_callbacks(execute=True):
+        logic.update_page_counts(models.EVENT, [])
+    assert Client().get(url).json()['totalValue'] == 0
+
+@pytest.mark.django_db
+def test_request_cursor_periods():
+    "paging through results with a cursor returns the same results as a single page"
+    fixture = base.fixture_json('ga-response-events-frame2.json')
+    frame = {'id': '2', 'prefix': '/events'}
+    rows = logic.aggregate(logic.process_response(models.EVENT, frame, fixture))
+    logic.update_page_counts(models.EVENT, rows)
+    client = Client()
+
+    url = reverse(views.metrics, kwargs={'ptype': models.EVENT})
+    for period in [logic.DAY, logic.MONTH]:
+        expected = client.get(url, {'by': period, 'per-page': 100}).json()['periods']
+        actual = []
+        cursor = ''
+        while cursor is not None:
+            resp = client.get(url, {'by': period, 'per-page': 5, 'cursor': cursor}).json()
+            actual.extend(resp['periods'])
+            cursor = resp['nextCursor']
+        assert expected == actual
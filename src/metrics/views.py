@@ -3,7 +3,7 @@ from django.http import Http404
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework.exceptions import ValidationError
-from article_metrics import api_v2_views as v2, api_v2_logic as v2_logic, utils
+from article_metrics import api_v2_views as v2, api_v2_logic as v2_logic, api_v2_cache, utils
 from . import models, logic
 import logging
 
@@ -37,14 +37,17 @@ def serialise(total, sum_value, obj_list, period):
     }
 
 @api_view(["GET"])
+@api_v2_cache.cached(api_v2_cache.NON_ARTICLE_METRICS, v2.cursor_request_args)
 def metrics(request, ptype, pid=models.LANDING_PAGE):
     try:
         # /metrics/press-packages/12345/page-views?by=month
-        kwargs = v2.request_args(request)
+        kwargs = v2.cursor_request_args(request)
         get_object_or_404(models.Page, identifier=pid, type=ptype)
         sum_value, qobj = logic.page_views(pid, ptype, kwargs['period'])
         total_results, qpage = v2_logic.chop(qobj, **utils.exsubdict(kwargs, ['period']))
         payload = serialise(total_results, sum_value, qpage, kwargs['period'])
+        if kwargs['cursor'] is not None:
+            payload['nextCursor'] = v2_logic.next_cursor(payload['periods'], kwargs['per_page'])
         ctype = 'application/vnd.elife.metric-time-period+json;version=1'
         return Response(payload, content_type=ctype)
 